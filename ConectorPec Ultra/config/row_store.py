@@ -0,0 +1,95 @@
+import sqlite3
+import threading
+from array import array
+from contextlib import closing, contextmanager
+from bisect import bisect_left
+from pathlib import Path
+
+
+class RowProbe:
+    """
+    Conjunto somente-leitura dos hashes já aceitos de uma coleção, para consulta linha a linha.
+    Guarda os primeiros 64 bits de cada hash num array ordenado (8 bytes por linha, contra
+    ~100 num set de strings) e responde `hash in sonda` por busca binária.
+    """
+    def __init__(self, hashes=()):
+        self._valores = array("Q", sorted({int(h[:16], 16) for h in hashes}))
+
+    def __len__(self):
+        return len(self._valores)
+
+    def __contains__(self, hash_linha):
+        valor = int(hash_linha[:16], 16)
+        i = bisect_left(self._valores, valor)
+        return i < len(self._valores) and self._valores[i] == valor
+
+
+class RowHashStore:
+    """
+    Hash de cada linha já aceita pela API, por conexão, coleção e chave natural, guardado em
+    row_hashes.db (SQLite) ao lado do settings.json. Serve para descobrir, sem consultar a
+    nuvem, quais linhas mudaram desde o último envio e quais sumiram da origem.
+
+    Uma chave pode ter mais de uma linha no resultado (ex: cidadão com mais de um registro
+    na tb_fat_cidadao_pec); por isso o valor é o conjunto de hashes daquela chave.
+    """
+    def __init__(self, app_name="ProBPA_Conector_Ultra"):
+        self.state_dir = Path.home() / f".{app_name}"
+        self.db_file = self.state_dir / "row_hashes.db"
+        self._lock = threading.Lock()
+        if not self.state_dir.exists():
+            self.state_dir.mkdir(parents=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS linhas (
+                    conexao TEXT NOT NULL,
+                    colecao TEXT NOT NULL,
+                    chave TEXT NOT NULL,
+                    hashes TEXT NOT NULL,
+                    PRIMARY KEY (conexao, colecao, chave)
+                )
+            """)
+
+    @contextmanager
+    def _connect(self):
+        # with sqlite3.connect() só encerra a transação: closing fecha a conexão ao sair
+        with closing(sqlite3.connect(self.db_file, timeout=30)) as conn, conn:
+            yield conn
+
+    def load(self, connection_id, colecao):
+        """Retorna {chave: set(hashes)} da coleção (vazio na primeira execução)."""
+        with self._lock, self._connect() as conn:
+            cur = conn.execute(
+                "SELECT chave, hashes FROM linhas WHERE conexao = ? AND colecao = ?",
+                (str(connection_id), colecao)
+            )
+            return {chave: set(hashes.split(",")) for chave, hashes in cur}
+
+    def load_probe(self, connection_id, colecao):
+        """RowProbe com todos os hashes da coleção, sem montar o dicionário por chave."""
+        with self._lock, self._connect() as conn:
+            cur = conn.execute(
+                "SELECT hashes FROM linhas WHERE conexao = ? AND colecao = ?",
+                (str(connection_id), colecao)
+            )
+            return RowProbe(h for (hashes,) in cur for h in hashes.split(","))
+
+    def apply(self, connection_id, colecao, alteradas, removidas):
+        """Grava as chaves enviadas ({chave: set(hashes)}) e apaga as removidas, numa transação."""
+        conexao = str(connection_id)
+        with self._lock, self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO linhas (conexao, colecao, chave, hashes) VALUES (?, ?, ?, ?)",
+                ((conexao, colecao, chave, ",".join(sorted(hashes))) for chave, hashes in alteradas.items())
+            )
+            conn.executemany(
+                "DELETE FROM linhas WHERE conexao = ? AND colecao = ? AND chave = ?",
+                ((conexao, colecao, chave) for chave in removidas)
+            )
+
+    def clear(self, connection_id, colecao):
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM linhas WHERE conexao = ? AND colecao = ?", (str(connection_id), colecao))
+
+# Singleton instance
+row_store = RowHashStore()
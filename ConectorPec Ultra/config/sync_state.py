@@ -0,0 +1,67 @@
+import os
+import json
+import threading
+from pathlib import Path
+
+class SyncStateStore:
+    """
+    Estado de sincronização por conexão (posição de paginação, marcas d'água etc.), guardado em
+    sync_state.json ao lado do settings.json. Fica separado das conexões para que editar um
+    município na interface não apague o progresso das extrações.
+
+    Estrutura: { connection_id: { secao: { chave: valor } } }
+    """
+    def __init__(self, app_name="ProBPA_Conector_Ultra"):
+        self.state_dir = Path.home() / f".{app_name}"
+        self.state_file = self.state_dir / "sync_state.json"
+        self._lock = threading.Lock()
+        self._cache = None
+        if not self.state_dir.exists():
+            self.state_dir.mkdir(parents=True)
+
+    def get(self, connection_id, secao, chave, default=None):
+        with self._lock:
+            data = self._load()
+            return data.get(str(connection_id), {}).get(secao, {}).get(chave, default)
+
+    def get_section(self, connection_id, secao):
+        with self._lock:
+            data = self._load()
+            return dict(data.get(str(connection_id), {}).get(secao, {}))
+
+    def set(self, connection_id, secao, chave, valor):
+        with self._lock:
+            data = self._load()
+            data.setdefault(str(connection_id), {}).setdefault(secao, {})[chave] = valor
+            self._save(data)
+
+    def delete(self, connection_id, secao, chave):
+        with self._lock:
+            data = self._load()
+            secao_data = data.get(str(connection_id), {}).get(secao, {})
+            if chave in secao_data:
+                del secao_data[chave]
+                self._save(data)
+
+    def _load(self):
+        # Chamado com o lock adquirido
+        if self._cache is not None:
+            return self._cache
+        self._cache = {}
+        if self.state_file.exists():
+            try:
+                with open(self.state_file, "r") as f:
+                    self._cache = json.load(f)
+            except Exception as e:
+                print(f"Erro ao carregar estado de sincronização: {e}")
+        return self._cache
+
+    def _save(self, data):
+        # Grava em arquivo temporário e troca de uma vez: uma queda no meio não corrompe o estado
+        tmp_file = self.state_file.with_suffix(".tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_file, self.state_file)
+
+# Singleton instance
+sync_state = SyncStateStore()
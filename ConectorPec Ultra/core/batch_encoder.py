@@ -0,0 +1,243 @@
+import datetime
+import decimal
+import hashlib
+import json
+import math
+
+import numpy as np
+import pandas as pd
+
+from core.columnar_payload import encode_columns
+
+# Mesmo escape de string do json.dumps padrão (ensure_ascii=True)
+_texto = json.encoder.encode_basestring_ascii
+
+
+def _float(valor):
+    # json.dumps usa o repr do float; Infinity/NaN saem como literais do JavaScript
+    if valor != valor:
+        return "NaN"
+    if valor in (math.inf, -math.inf):
+        return "Infinity" if valor > 0 else "-Infinity"
+    return float.__repr__(valor)
+
+
+def _float_canonico(valor):
+    # _valor_canonico do extrator: float inteiro vira int
+    if valor.is_integer():
+        return str(int(valor))
+    return _float(valor)
+
+
+def _texto_canonico(valor):
+    # _valor_canonico do extrator: data com hora zerada (astype(str) de uma coluna mista) vira só a data
+    if len(valor) == 19 and valor.endswith(" 00:00:00"):
+        return _texto(valor[:10])
+    return _texto(valor)
+
+
+# Tipos que o json.dumps(default=str) escreve como str(valor)
+_TIPOS_TEXTO = {str, decimal.Decimal, datetime.date, datetime.datetime, datetime.time}
+
+
+def _valor(valor):
+    """(JSON do payload, JSON canônico do hash) de um valor de coluna object."""
+    if isinstance(valor, np.generic):
+        # to_dict devolvia os escalares do numpy como tipos do Python
+        valor = valor.item()
+    tipo = type(valor)
+    if tipo is str:
+        return _texto(valor), _texto_canonico(valor)
+    if tipo is bool:
+        return ("true", "true") if valor else ("false", "false")
+    if tipo is int:
+        texto = int.__repr__(valor)
+        return texto, texto
+    if tipo is float:
+        return _float(valor), _float_canonico(valor)
+    if tipo in _TIPOS_TEXTO:
+        texto = _texto(str(valor))
+        return texto, texto
+    return json.dumps(valor, default=str), json.dumps(valor, sort_keys=True, default=str)
+
+
+def _coluna(serie, com_canonico):
+    """
+    Codifica uma coluna inteira: (JSON de cada valor no payload, JSON canônico de cada valor,
+    ou None se não foi pedido ou é igual ao do payload). Segue exatamente o caminho anterior:
+    datas do pandas em texto (astype(str)), nulos viram "" (fillna) e o resto passa pelo
+    json.dumps(default=str).
+    """
+    dtype = serie.dtype
+    if pd.api.types.is_bool_dtype(dtype):
+        return ["true" if v else "false" for v in serie.tolist()], None
+    if pd.api.types.is_integer_dtype(dtype):
+        return list(map(int.__repr__, serie.tolist())), None
+
+    valores = _valores(serie)
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return list(map(_texto, valores)), (list(map(_texto_canonico, valores)) if com_canonico else None)
+    if pd.api.types.is_float_dtype(dtype):
+        payload = ['""' if v == "" else _float(v) for v in valores]
+        return payload, (['""' if v == "" else _float_canonico(v) for v in valores] if com_canonico else None)
+
+    tipos = set(map(type, valores))
+    if tipos <= {str}:
+        # Caso mais comum (textos, com "" nos nulos): sem despacho por valor
+        payload = list(map(_texto, valores))
+        if com_canonico and any(len(v) == 19 and v.endswith(" 00:00:00") for v in valores):
+            return payload, list(map(_texto_canonico, valores))
+        return payload, None
+    if tipos <= _TIPOS_TEXTO:
+        # Datas, Decimal e textos: json.dumps(default=str) escreve str(valor)
+        payload = [_texto(v) if type(v) is str else _texto(str(v)) for v in valores]
+        if com_canonico:
+            return payload, [_texto_canonico(v) if type(v) is str else p for v, p in zip(valores, payload)]
+        return payload, None
+    pares = [_valor(v) for v in valores]
+    return [p for p, _ in pares], ([c for _, c in pares] if com_canonico else None)
+
+
+def _valores(serie):
+    """Valores da coluna como ficavam nos registros do to_dict depois do astype(str)/fillna("")."""
+    if pd.api.types.is_datetime64_any_dtype(serie.dtype):
+        # NaT pode sair do astype(str) como NaN, que o fillna("") trocava por ""
+        return [v if type(v) is str else "" for v in serie.astype(str).tolist()]
+    valores = serie.tolist()
+    if pd.api.types.is_bool_dtype(serie.dtype) or pd.api.types.is_integer_dtype(serie.dtype):
+        return valores
+    nulos = pd.isna(serie).to_numpy()
+    if nulos.any():
+        return ["" if nulo else v for v, nulo in zip(valores, nulos.tolist())]
+    return valores
+
+
+class EncodedBatch:
+    """
+    Lote de um DataFrame codificado coluna a coluna, numa passada, direto para JSON. Substitui
+    o copy + astype(str) + fillna("") + replace + to_dict + json.dumps(default=str) do lote:
+    o corpo enviado à API e o hash de cada linha (_row_hash) saem idênticos aos de antes.
+    Com `com_hash`, os hashes são calculados na mesma passada; só as linhas prontas, os hashes
+    e o DataFrame (para `valor`) ficam guardados. Com `colunar`, as linhas não são montadas:
+    ficam os valores em JSON de cada coluna (`payloads`), para o corpo colunar.
+    """
+    def __init__(self, df, com_hash=False, colunar=False):
+        self.df = df
+        self.colunas = [str(c) for c in df.columns]
+        self._chaves = [_texto(c) + ": " for c in self.colunas]
+        self._valores = {}
+        self.hashes = None
+        self.linhas = None
+        self.payloads = None
+        payloads = []
+        canonicos = []
+        for coluna in df.columns:
+            payload, canonico = _coluna(df[coluna], com_hash)
+            payloads.append(payload)
+            canonicos.append(canonico or payload)
+        if colunar:
+            self.payloads = payloads
+        elif not payloads:
+            self.linhas = ["{}"] * len(df)
+            return
+        else:
+            chaves = self._chaves
+            self.linhas = ["{" + ", ".join(map(str.__add__, chaves, valores)) + "}" for valores in zip(*payloads)]
+        if com_hash and payloads:
+            self._calcular_hashes(canonicos)
+
+    def _calcular_hashes(self, canonicos):
+        # Mesmo texto do json.dumps(canonico, sort_keys=True, default=str) usado em _row_hash
+        ordem = sorted(range(len(self.colunas)), key=lambda i: self.colunas[i])
+        chaves = [self._chaves[i] for i in ordem]
+        blake2b = hashlib.blake2b
+        self.hashes = [
+            blake2b(("{" + ", ".join(map(str.__add__, chaves, valores)) + "}").encode(), digest_size=16).hexdigest()
+            for valores in zip(*(canonicos[i] for i in ordem))
+        ]
+
+    def __len__(self):
+        return len(self.df)
+
+    def records(self):
+        return [EncodedRow(self, i) for i in range(len(self.df))]
+
+    def linha(self, i):
+        if self.linhas is not None:
+            return self.linhas[i]
+        return "{" + ", ".join(map(str.__add__, self._chaves, (payload[i] for payload in self.payloads))) + "}"
+
+    def valor(self, coluna, i, default=None):
+        valores = self._valores.get(coluna)
+        if valores is None:
+            if coluna not in self.colunas:
+                return default
+            valores = self._valores[coluna] = _valores(self.df[self.df.columns[self.colunas.index(coluna)]])
+        return valores[i]
+
+    def hash(self, i):
+        if self.hashes is None:
+            self._calcular_hashes([canonico or payload for payload, canonico in (_coluna(self.df[c], True) for c in self.df.columns)])
+        return self.hashes[i]
+
+
+class EncodedRow:
+    """Uma linha de EncodedBatch: `json` é o documento pronto; `get` dá os valores das colunas."""
+    __slots__ = ("lote", "i")
+
+    def __init__(self, lote, i):
+        self.lote = lote
+        self.i = i
+
+    @property
+    def json(self):
+        return self.lote.linha(self.i)
+
+    def get(self, coluna, default=None):
+        return self.lote.valor(coluna, self.i, default)
+
+    def hash(self):
+        return self.lote.hash(self.i)
+
+
+def encode_records(df, com_hash=False, colunar=False):
+    """Registros do DataFrame prontos para envio (EncodedRow), na ordem das linhas."""
+    return EncodedBatch(df, com_hash, colunar).records()
+
+
+def _referencias(referencias):
+    # Chaves de dimensões sincronizadas nos registros (ver dimension_cache.referencias)
+    return ', "refs": ' + json.dumps(referencias) if referencias else ""
+
+
+def batch_body(colecao, registros, municipio_id, referencias=None):
+    """
+    Corpo do POST, igual ao json.dumps({"collection", "data", "municipio_id"}, default=str),
+    com "refs" quando os registros levam chaves de dimensões sincronizadas.
+    """
+    return (
+        '{"collection": ' + json.dumps(colecao, default=str)
+        + ', "data": [' + ", ".join(r.json for r in registros) + "]"
+        + _referencias(referencias)
+        + ', "municipio_id": ' + json.dumps(municipio_id, default=str) + "}"
+    )
+
+
+def columnar_batch_body(colecao, registros, municipio_id, referencias=None):
+    """
+    Corpo do POST no formato colunar (ver core.columnar_payload) para registros de um mesmo
+    lote codificado com `colunar`, na ordem em que vêm (o filtro de inalteradas pode ter
+    tirado linhas do meio).
+    """
+    lote = registros[0].lote
+    indices = [r.i for r in registros]
+    if indices == list(range(indices[0], indices[-1] + 1)):
+        colunas = [payload[indices[0]:indices[-1] + 1] for payload in lote.payloads]
+    else:
+        colunas = [[payload[i] for i in indices] for payload in lote.payloads]
+    return (
+        '{"collection": ' + json.dumps(colecao, default=str)
+        + ', "columnar": ' + encode_columns(lote.colunas, colunas)
+        + _referencias(referencias)
+        + ', "municipio_id": ' + json.dumps(municipio_id, default=str) + "}"
+    )
@@ -0,0 +1,81 @@
+"""
+Formato colunar dos lotes (extracao_payload_colunar): em vez de
+{"collection", "data": [{...}, ...], "municipio_id"}, que repete o nome de todas as colunas em
+cada linha, o lote vai como
+
+    {"collection": "...",
+     "columnar": {"count": 500,
+                  "columns": ["id_procedimento", "cbo", ...],
+                  "data": [[...], [...], ...],
+                  "dictionaries": {"cbo": ["225142", "223505", ""], ...}},
+     "municipio_id": "..."}
+
+com um array por coluna, na ordem das linhas. Uma coluna listada em "dictionaries" traz
+índices do seu dicionário (null continua null): textos de baixa cardinalidade (CBO, CNES,
+sexo, códigos de procedimento) saem uma vez por lote.
+
+decode_payload é o decodificador de referência: devolve o corpo no formato de linhas que o
+envio anterior mandaria e só depende do json, para poder ser usado como está num servidor
+local de teste (ver tools/servidor_local.py). O ingestUltraData decodifica do mesmo jeito
+(functions/src/utils/columnarPayload.ts): mudanças no formato valem para os dois.
+"""
+import json
+
+# Uma coluna de textos vai como dicionário quando no máximo esta fração dos valores é distinta
+DICIONARIO_FRACAO_MAX = 0.5
+
+_texto = json.encoder.encode_basestring_ascii
+
+
+def encode_columns(nomes, colunas):
+    """
+    Bloco colunar (texto JSON) de `colunas`, listas de valores já em JSON (mesmo tamanho, uma
+    por nome em `nomes`).
+    """
+    total = len(colunas[0]) if colunas else 0
+    limite = total * DICIONARIO_FRACAO_MAX
+    dados = []
+    dicionarios = []
+    for nome, valores in zip(nomes, colunas):
+        distintos = dict.fromkeys(valores)
+        if total > 1 and len(distintos) <= limite and all(v[0] == '"' or v == "null" for v in distintos):
+            distintos.pop("null", None)
+            codigos = {v: str(i) for i, v in enumerate(distintos)}
+            codigos["null"] = "null"
+            dados.append("[" + ", ".join(map(codigos.__getitem__, valores)) + "]")
+            dicionarios.append(f'{_texto(nome)}: [{", ".join(distintos)}]')
+        else:
+            dados.append("[" + ", ".join(valores) + "]")
+    return (
+        f'{{"count": {total}, "columns": [{", ".join(map(_texto, nomes))}], '
+        f'"data": [{", ".join(dados)}], "dictionaries": {{{", ".join(dicionarios)}}}}}'
+    )
+
+
+def decode_columns(bloco):
+    """Linhas de um bloco colunar como dicts ({coluna: valor}), na ordem."""
+    nomes = bloco["columns"]
+    dicionarios = bloco.get("dictionaries") or {}
+    colunas = []
+    for nome, valores in zip(nomes, bloco["data"]):
+        dicionario = dicionarios.get(nome)
+        if dicionario is not None:
+            valores = [None if codigo is None else dicionario[codigo] for codigo in valores]
+        colunas.append(valores)
+    if not colunas:
+        return [{} for _ in range(bloco.get("count", 0))]
+    return [dict(zip(nomes, linha)) for linha in zip(*colunas)]
+
+
+def decode_payload(corpo):
+    """
+    Corpo do POST (JSON já lido) no formato de linhas: os lotes colunares viram
+    {"collection", "data": [...], "municipio_id"}; qualquer outro corpo volta sem alteração.
+    """
+    bloco = corpo.get("columnar")
+    if bloco is None:
+        return corpo
+    decodificado = {"collection": corpo.get("collection"), "data": decode_columns(bloco), "municipio_id": corpo.get("municipio_id")}
+    if corpo.get("refs"):
+        decodificado["refs"] = corpo["refs"]
+    return decodificado
@@ -3,13 +3,22 @@ import time
 import schedule
 from config.settings import config_manager
 from core.extractor import MunicipalityExtractor
+from database.pool import connection_pool
+
+# Segundos entre dois ciclos de uma conexão em modo CDC (extracao_cdc), salvo se configurado
+CDC_INTERVALO_SEGUNDOS = 5
 
 class ExtractionEngine:
     def __init__(self):
         self._stop_event = threading.Event()
         self.engine_thread = None
+        self.cdc_thread = None
         # Por padrão, agendamento de 24 em 24 horas
         self.schedule_frequency_hours = 24
+        # Extração em andamento por conexão (agendada, manual ou CDC). Slot de replicação,
+        # sync_state e row_store são da conexão: dois extratores dela nunca rodam juntos
+        self._extracoes = {}
+        self._extracoes_lock = threading.Lock()
         self._setup_schedule()
 
     def _setup_schedule(self):
@@ -17,15 +26,45 @@ class ExtractionEngine:
         # Agenda para rodar o job
         schedule.every(self.schedule_frequency_hours).hours.do(self._run_all_scheduled_extractions)
 
+    def _reservar(self, conn_config):
+        """
+        Cria e registra o extrator da conexão, ou devolve None se ela já está em extração.
+        Registrado, ele é alcançado por cancel_manual_extraction e por stop().
+        """
+        connection_id = conn_config.get("id")
+        with self._extracoes_lock:
+            if connection_id in self._extracoes:
+                return None
+            extractor = MunicipalityExtractor(conn_config)
+            extractor.cancel_event = threading.Event()
+            self._extracoes[connection_id] = extractor
+            return extractor
+
+    def _liberar(self, connection_id):
+        with self._extracoes_lock:
+            self._extracoes.pop(connection_id, None)
+
     def _run_all_scheduled_extractions(self):
         print(f"[ENGINE] Iniciando varredura agendada para todos os municípios...")
         connections = config_manager.load_connections()
         for conn_config in connections:
+            connection_id = conn_config.get("id")
+            if self._stop_event.is_set():
+                break
+            if conn_config.get("extracao_cdc"):
+                # Conexões em modo CDC rodam no _cdc_loop, não no agendamento
+                continue
             # Em modo agendado, poderíamos usar um thread pool para paralelizar,
             # mas para iniciar, rodamos de forma sequencial, município por município.
-            print(f"[ENGINE] [AGENDAMENTO] Iniciando extração do município ID: {conn_config.get('id')} / Host: {conn_config.get('db_host')}")
-            extractor = MunicipalityExtractor(conn_config)
-            extractor.run_extraction()
+            extractor = self._reservar(conn_config)
+            if extractor is None:
+                print(f"[ENGINE] [AGENDAMENTO] Município ID {connection_id} já está em extração. Pulando.")
+                continue
+            print(f"[ENGINE] [AGENDAMENTO] Iniciando extração do município ID: {connection_id} / Host: {conn_config.get('db_host')}")
+            try:
+                extractor.run_extraction()
+            finally:
+                self._liberar(connection_id)
         print(f"[ENGINE] Varredura agendada finalizada.")
 
     def trigger_manual_extraction(self, connection_id):
@@ -40,32 +79,34 @@ class ExtractionEngine:
             print(f"[ENGINE] Erro: Conexão com ID {connection_id} não encontrada.")
             return
 
-        cancel_event = threading.Event()
-        if not hasattr(self, 'active_manual_extractions'):
-            self.active_manual_extractions = {}
-            
-        self.active_manual_extractions[connection_id] = cancel_event
+        extractor = self._reservar(target_config)
+        if extractor is None:
+            print(f"[ENGINE] [MANUAL] Município ID {connection_id} já está em extração.")
+            return
 
         def _run_manual():
-            print(f"[ENGINE] [MANUAL] Iniciando extração sob demanda do município ID: {connection_id} / Host: {target_config.get('db_host')}")
-            extractor = MunicipalityExtractor(target_config)
-            extractor.cancel_event = cancel_event
-            success = extractor.run_extraction()
-            if success:
-                print(f"[ENGINE] [MANUAL] Extração concluída com sucesso para o ID: {connection_id}.")
-            elif cancel_event.is_set():
-                print(f"[ENGINE] [MANUAL] Extração cancelada para o ID: {connection_id}.")
-            else:
-                print(f"[ENGINE] [MANUAL] Falha na extração para o ID: {connection_id}.")
-            self.active_manual_extractions.pop(connection_id, None)
+            try:
+                print(f"[ENGINE] [MANUAL] Iniciando extração sob demanda do município ID: {connection_id} / Host: {target_config.get('db_host')}")
+                success = extractor.run_extraction()
+                if success:
+                    print(f"[ENGINE] [MANUAL] Extração concluída com sucesso para o ID: {connection_id}.")
+                elif extractor.cancel_event.is_set():
+                    print(f"[ENGINE] [MANUAL] Extração cancelada para o ID: {connection_id}.")
+                else:
+                    print(f"[ENGINE] [MANUAL] Falha na extração para o ID: {connection_id}.")
+            finally:
+                self._liberar(connection_id)
 
         thread = threading.Thread(target=_run_manual, daemon=True)
         thread.start()
 
     def cancel_manual_extraction(self, connection_id):
-        if hasattr(self, 'active_manual_extractions') and connection_id in self.active_manual_extractions:
+        with self._extracoes_lock:
+            extractor = self._extracoes.get(connection_id)
+        if extractor is not None:
             print(f"[ENGINE] Solicitando cancelamento da extração para o ID {connection_id}...")
-            self.active_manual_extractions[connection_id].set()
+            # Marca o cancel_event e interrompe no servidor a query em andamento
+            extractor.cancel()
 
     def _engine_loop(self):
         print("[ENGINE] Motor em segundo plano iniciado.")
@@ -74,13 +115,51 @@ class ExtractionEngine:
             time.sleep(1)
         print("[ENGINE] Motor desligado.")
 
+    def _cdc_loop(self):
+        """
+        Conexões em modo CDC rodam um ciclo curto (só as alterações do slot) a cada
+        extracao_cdc_intervalo segundos, em vez de esperar o agendamento.
+        """
+        proximos = {}
+        while not self._stop_event.is_set():
+            for conn_config in config_manager.load_connections():
+                connection_id = conn_config.get("id")
+                if not conn_config.get("extracao_cdc") or time.monotonic() < proximos.get(connection_id, 0):
+                    continue
+                extractor = self._reservar(conn_config)
+                if extractor is None:
+                    # Extração manual em andamento: o ciclo volta depois dela
+                    continue
+                try:
+                    extractor.run_extraction()
+                except Exception as e:
+                    print(f"[ENGINE] [CDC] Erro no ciclo do município ID {connection_id}: {e}")
+                finally:
+                    self._liberar(connection_id)
+                proximos[connection_id] = time.monotonic() + int(conn_config.get("extracao_cdc_intervalo", CDC_INTERVALO_SEGUNDOS))
+                if self._stop_event.is_set():
+                    break
+            self._stop_event.wait(1)
+
     def start(self):
         if self.engine_thread is None or not self.engine_thread.is_alive():
             self._stop_event.clear()
             self.engine_thread = threading.Thread(target=self._engine_loop, daemon=True)
             self.engine_thread.start()
+        if self.cdc_thread is None or not self.cdc_thread.is_alive():
+            self.cdc_thread = threading.Thread(target=self._cdc_loop, daemon=True)
+            self.cdc_thread.start()
 
     def stop(self):
+        self._stop_event.set()
+        # Interrompe as extrações em andamento (agendada, manual ou ciclo CDC) em vez de esperar o fim
+        with self._extracoes_lock:
+            extractors = list(self._extracoes.values())
+        for extractor in extractors:
+            extractor.cancel()
         if self.engine_thread and self.engine_thread.is_alive():
-            self._stop_event.set()
             self.engine_thread.join(timeout=3)
+        if self.cdc_thread and self.cdc_thread.is_alive():
+            self.cdc_thread.join(timeout=3)
+        # Fecha as conexões ociosas mantidas entre execuções
+        connection_pool.close_all()
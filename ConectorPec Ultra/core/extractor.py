@@ -1,11 +1,22 @@
+import re
 import json
+import hashlib
 import requests
 import datetime
-import math
+import threading
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from core.batch_encoder import EncodedRow, encode_records, batch_body, columnar_batch_body
 from database.connection import DatabaseConnection
+from database.pool import connection_pool
+from database.dimension_cache import dimension_cache, DIMENSOES_SINCRONIZADAS
+from database.change_feed import LogicalChangeFeed
+from database.load_monitor import SourceLoadMonitor, OCUPADO
 from config.settings import config_manager
+from config.sync_state import sync_state
+from config.row_store import row_store, RowProbe
 
-from queries.queries_atendimentos import QUERY_ATENDIMENTO_INDIVIDUAL
+from queries.queries_atendimentos import QUERY_ATENDIMENTO_INDIVIDUAL, QUERY_ATENDIMENTO_INDIVIDUAL_AGREGADA
 from queries.queries_atividade_coletiva import QUERY_ATIVIDADE_COLETIVA
 from queries.queries_cadastros import QUERY_CIDADANIA_BASE, QUERY_CADASTRO_DOMICILIAR
 from queries.queries_condicoes import QUERY_CONDICOES_CLINICAS, QUERY_ANTECEDENTES_OBSTETRICOS
@@ -13,7 +24,166 @@ from queries.queries_imunizacao import QUERY_VACINAS_APLICADAS
 from queries.queries_odontologia import QUERY_ATENDIMENTO_ODONTO
 from queries.queries_procedimentos import QUERY_PROCEDIMENTOS_FATURADOS
 
+# Tamanho do lote enviado à API (limite de 500 operações por batch do Firestore)
+BATCH_SIZE = 500
+
+# Coleções lidas em páginas pela chave co_seq_* da tabela fato (coluna já exposta pela query).
+# Só entram aqui queries em que essa chave é única por linha do resultado.
+CHAVES_KEYSET = {
+    "cadastro_domiciliar": "id_cadastro_domiciliar",
+    "atendimento_individual": "id_atendimento",
+    "atividade_coletiva": "id_atividade",
+    "condicoes_clinicas": "id_condicao",
+    "vacinas_aplicadas": "id_vacina",
+    "atendimento_odonto": "id_atendimento_odonto",
+    "procedimentos_faturados": "id_procedimento",
+}
+
+SQL_KEYSET = """
+SELECT * FROM (
+{sql}
+) AS pagina
+{filtro}
+ORDER BY pagina.{chave}
+LIMIT {limite}
+"""
+
+# Coleções sem filtro de data (retrato do cadastro). Em modo delta só vão as linhas novas ou
+# alteradas, mais a lista de chaves que saíram do resultado (ex: óbito, st_faleceu = 1).
+# "marcas" são colunas de data de alteração usadas para nem ler do banco o que não mudou;
+# sem elas, a coleção é lida inteira e comparada pelo hash de cada linha.
+COLECOES_DELTA = {
+    "cidadania_base": {"chave": "id_paciente", "marcas": ("data_atualizacao", "data_ultima_ficha")},
+    "antecedentes_obstetricos": {"chave": "id_antecedente", "marcas": ()},
+}
+
+# Campos que identificam o documento na API, na mesma ordem do ingestUltraData (id_paciente
+# por último: nas demais coleções é chave estrangeira). É a chave natural do row_store.
+CAMPOS_ID = (
+    "id", "id_atendimento", "id_atividade", "id_condicao", "id_antecedente", "id_vacina",
+    "id_atendimento_odonto", "id_procedimento", "id_cadastro_domiciliar", "id_paciente",
+)
+
+# Tabela fato filtrada por co_dim_tempo em cada coleção; usada para estimar a densidade de
+# linhas por dia (pg_class.reltuples + histograma do pg_stats) ao planejar as janelas da carga.
+TABELAS_FATO = {
+    "cadastro_domiciliar": "tb_fat_cad_domiciliar",
+    "atendimento_individual": "tb_fat_atendimento_individual",
+    "atividade_coletiva": "tb_fat_atividade_coletiva",
+    "condicoes_clinicas": "tb_fat_atd_ind_problemas",
+    "vacinas_aplicadas": "tb_fat_vacinacao",
+    "atendimento_odonto": "tb_fat_atendimento_odonto",
+    "procedimentos_faturados": "tb_fat_proced_atend_proced",
+}
+
+# Sequência co_seq_* de cada coleção de fatos (a mesma coluna de CHAVES_KEYSET, na tabela em que
+# nasce) e de onde vem o co_dim_tempo das linhas. Depois da primeira carga completa, cada execução
+# lê só as linhas com sequência acima da última gravada, qualquer que seja a data do atendimento:
+# fichas digitadas ou sincronizadas com atraso entram sem reler períodos antigos.
+SEQUENCIAS = {
+    "cadastro_domiciliar": {"tabela": "tb_fat_cad_domiciliar", "coluna": "co_seq_fat_cad_domiciliar"},
+    "atendimento_individual": {"tabela": "tb_fat_atendimento_individual", "coluna": "co_seq_fat_atd_ind"},
+    "atividade_coletiva": {"tabela": "tb_fat_atividade_coletiva", "coluna": "co_seq_fat_atividade_coletiva"},
+    "condicoes_clinicas": {"tabela": "tb_fat_atd_ind_problemas", "coluna": "co_seq_fat_atend_ind_problemas"},
+    "vacinas_aplicadas": {
+        "tabela": "tb_fat_vacinacao_vacina", "coluna": "co_seq_fat_vacinacao_vacina",
+        "juncao": "JOIN tb_fat_vacinacao v ON v.co_seq_fat_vacinacao = s.co_fat_vacinacao",
+        "tempo": "v.co_dim_tempo",
+    },
+    "atendimento_odonto": {"tabela": "tb_fat_atendimento_odonto", "coluna": "co_seq_fat_atendimento_odonto"},
+    "procedimentos_faturados": {"tabela": "tb_fat_proced_atend_proced", "coluna": "co_seq_fat_proced_atend_proced"},
+}
+
+# Período (co_dim_tempo) e maior sequência das linhas selecionadas (novas, ou alteradas no modo
+# CDC): a query da coleção continua filtrada por data, mas só no intervalo em que elas caem
+SQL_PERIODO_LINHAS = """
+SELECT min({tempo}), max({tempo}), max(s.{coluna})
+FROM {tabela} s
+{juncao}
+WHERE {condicao}
+"""
+
+# Sequências abaixo da última gravada que são relidas a cada execução: transações abertas durante
+# a leitura anterior podem ter gravado ids menores depois dela (as linhas repetidas são descartadas
+# pelo row_store antes do envio)
+SEQUENCIA_MARGEM = 1000
+
+# Modo CDC (replicação lógica): tabelas cujas alterações chegam pelo slot e, para cada uma,
+# as coleções afetadas com a coluna do evento que dá a chave da coleção (CHAVES_KEYSET).
+# Além da própria sequência de cada coleção, um problema/condição novo altera os CIAP/CID
+# agregados do atendimento individual a que pertence. Um DELETE só traz a chave primária da
+# linha, a menos que a tabela tenha REPLICA IDENTITY FULL: sem isso, apagar um problema não
+# reenvia o atendimento.
+CDC_CHAVES = {spec["tabela"]: ((nome, spec["coluna"]),) for nome, spec in SEQUENCIAS.items()}
+CDC_CHAVES["tb_fat_atd_ind_problemas"] += (("atendimento_individual", "co_fat_atd_ind"),)
+
+# Chaves por consulta ao reler as linhas alteradas (= ANY(array))
+CDC_CHAVES_POR_CONSULTA = 5000
+# Alterações lidas do slot por ciclo (o slot devolve sempre transações inteiras)
+CDC_LIMITE_ALTERACOES = 20000
+
+SQL_DENSIDADE = """
+SELECT c.reltuples, s.histogram_bounds::text AS limites
+FROM pg_class c
+LEFT JOIN pg_stats s
+       ON s.schemaname = c.relnamespace::regnamespace::text
+      AND s.tablename = c.relname
+      AND s.attname = 'co_dim_tempo'
+WHERE c.relname = %(tabela)s
+  AND c.relkind IN ('r', 'p')
+  AND pg_table_is_visible(c.oid)
+LIMIT 1
+"""
+
+# Partições por unidade de saúde (extracao_particoes_unidade > 1): alias da tabela fato na query
+# e coluna do co_dim_unidade_saude. Nos municípios em que nem um mês cabe em JANELA_ALVO_LINHAS,
+# as janelas de cada coleção são lidas por grupos de unidades equilibrados pela estimativa de
+# linhas de cada uma (pg_stats), em paralelo e cada grupo com a sua posição salva.
+PARTICAO_UNIDADE = {
+    "cadastro_domiciliar": ("fat_dom", "co_dim_unidade_saude"),
+    "atendimento_individual": ("fat", "co_dim_unidade_saude_1"),
+    "atividade_coletiva": ("fat_ac", "co_dim_unidade_saude"),
+    "vacinas_aplicadas": ("fat_vac", "co_dim_unidade_saude"),
+    "atendimento_odonto": ("fat_od", "co_dim_unidade_saude_1"),
+    "procedimentos_faturados": ("fat_proc", "co_dim_unidade_saude"),
+}
+
+SQL_UNIDADES = """
+SELECT c.reltuples, s.null_frac, s.n_distinct,
+       s.most_common_vals::text AS valores, s.most_common_freqs::text AS frequencias,
+       (SELECT array_agg(co_seq_dim_unidade_saude ORDER BY co_seq_dim_unidade_saude)::text
+          FROM tb_dim_unidade_saude) AS unidades
+FROM pg_class c
+LEFT JOIN pg_stats s
+       ON s.schemaname = c.relnamespace::regnamespace::text
+      AND s.tablename = c.relname
+      AND s.attname = %(coluna)s
+WHERE c.relname = %(tabela)s
+  AND c.relkind IN ('r', 'p')
+  AND pg_table_is_visible(c.oid)
+LIMIT 1
+"""
+
+# Linhas estimadas por janela da carga inicial: períodos maiores são quebrados em quadrimestres
+# ou, se nem o quadrimestre couber, em meses
+JANELA_ALVO_LINHAS = 200000
+
+# Preflight (EXPLAIN): volume de cada busca do cursor nomeado e limites para o modo paralelo.
+# Abaixo de PREFLIGHT_LINHAS_PARALELO linhas estimadas no total não vale abrir mais conexões;
+# acima de PREFLIGHT_CUSTO_ALTO (unidades de custo do planejador) limita a 2 conexões
+# para não derrubar o servidor do município.
+PREFLIGHT_BYTES_POR_BUSCA = 4 * 1024 * 1024
+PREFLIGHT_LINHAS_PARALELO = 20000
+PREFLIGHT_CUSTO_ALTO = 10000000
+
+# Controle de carga: com o PEC ocupado cada busca do cursor cai para 1/CARGA_FATOR_BUSCA
+CARGA_FATOR_BUSCA = 4
+
 class MunicipalityExtractor:
+    # Modo CDC: por conexão, (sincronizar_dimensoes, dimensões sincronizadas) da última vez que
+    # um ciclo preparou as dimensões; os ciclos seguintes reaproveitam enquanto elas não mudarem
+    _dimensoes_cdc = {}
+
     def __init__(self, db_config):
         self.config = db_config
         self.municipality_id = self.config.get('municipio_id') or self.config.get('id')
@@ -21,12 +191,66 @@ class MunicipalityExtractor:
         # API dedicada solicitada pelo usuário
         self.api_url = "https://southamerica-east1-probpa-025.cloudfunctions.net/ingestUltraData"
         self.db = DatabaseConnection(db_config)
+        # Conexões com query possivelmente em andamento (cancel() interrompe todas no servidor)
+        self._bancos_ativos = {self.db}
+        self._bancos_lock = threading.Lock()
+
+        # Streaming via cursor nomeado: mantém o pico de memória no tamanho do lote
+        self.streaming = bool(self.config.get("extracao_streaming", True))
+        self.streaming_itersize = int(self.config.get("extracao_streaming_itersize", 2000))
+        # Backend de leitura: "cursor" (padrão) ou "copy" (COPY TO STDOUT, menos overhead por linha)
+        self.backend = self.config.get("extracao_backend", "cursor")
+        # Número de coleções extraídas ao mesmo tempo (1 = sequencial, comportamento original)
+        self.paralelismo = int(self.config.get("extracao_paralelismo", 1))
+        # Paginação keyset com posição salva em disco (retomada de cargas interrompidas)
+        self.paginacao = bool(self.config.get("extracao_paginacao", True))
+        self.tamanho_pagina = int(self.config.get("extracao_tamanho_pagina", 50000))
+        # Janelas da carga: "auto" (pela densidade da tabela), "mes", "quad" ou "desligado"
+        self.janelas = self.config.get("extracao_janelas", "auto")
+        # Delta das coleções de cadastro (COLECOES_DELTA) em vez de reenviar tudo a cada execução
+        self.delta = bool(self.config.get("extracao_delta", True))
+        # Demais coleções: linhas idênticas à última versão aceita pela API não são reenviadas
+        # (as janelas incrementais se sobrepõem ao último dia já enviado)
+        self.suprimir_inalteradas = bool(self.config.get("extracao_suprimir_inalteradas", True))
+        self._sondas = {}
+        # Incremental das coleções de fatos pela sequência co_seq_* (SEQUENCIAS) em vez da data
+        self.sequencia = bool(self.config.get("extracao_sequencia", True))
+        self.sequencia_margem = int(self.config.get("extracao_sequencia_margem", SEQUENCIA_MARGEM))
+        # Modo CDC: alterações lidas de um slot de replicação lógica em vez das queries por período
+        # (exige wal_level = logical no PEC); o ExtractionEngine repete o ciclo a cada poucos segundos
+        self.cdc = bool(self.config.get("extracao_cdc", False))
+        self.cdc_plugin = self.config.get("extracao_cdc_plugin", "test_decoding")
+        self.cdc_slot = self.config.get("extracao_cdc_slot") or ("probpa_ultra_" + re.sub(r"\W", "_", str(self.config.get('id'))).lower())[:63]
+        self.cdc_limite = int(self.config.get("extracao_cdc_limite", CDC_LIMITE_ALTERACOES))
+        # Controle de carga: o pg_stat_activity do PEC é consultado antes de cada query e entre os
+        # lotes; ocupado, as buscas encolhem e as coleções do modo paralelo leem uma de cada vez;
+        # saturado, a extração pausa até o banco aliviar
+        self.carga = None
+        if self.config.get("extracao_controle_carga", True):
+            self.carga = SourceLoadMonitor(
+                self.config,
+                ativas=int(self.config.get("extracao_carga_sessoes", 6)),
+                locks=int(self.config.get("extracao_carga_locks", 3)),
+                pausa_max=int(self.config.get("extracao_carga_pausa_max", 600))
+            )
+        self._vez_carga = threading.Lock()
+        self.particoes_unidade = int(self.config.get("extracao_particoes_unidade", 1))
+        self.janela_alvo_linhas = int(self.config.get("extracao_janela_alvo_linhas", JANELA_ALVO_LINHAS))
+        # Preflight com EXPLAIN antes da extração: calibra busca, janelas e paralelismo
+        self.preflight = bool(self.config.get("extracao_preflight", True))
+        self.estimativas = {}   # coleção -> {"linhas", "custo", "largura", "periodo"}
+        self.periodos = {}      # coleção -> (data_inicio, data_fim) já calculado no preflight
+        self.lidos = {}         # coleção -> linhas efetivamente lidas do banco nesta execução
         
+        # Atendimento individual com os problemas num agregado LATERAL por linha (padrão) ou na forma
+        # original, com duas subqueries correlacionadas por linha
+        atendimento_agregado = bool(self.config.get("extracao_atendimento_agregado", True))
+
         # Define queries a serem executadas
         self.queries_map = {
             "cidadania_base": QUERY_CIDADANIA_BASE,
             "cadastro_domiciliar": QUERY_CADASTRO_DOMICILIAR,
-            "atendimento_individual": QUERY_ATENDIMENTO_INDIVIDUAL,
+            "atendimento_individual": QUERY_ATENDIMENTO_INDIVIDUAL_AGREGADA if atendimento_agregado else QUERY_ATENDIMENTO_INDIVIDUAL,
             "atividade_coletiva": QUERY_ATIVIDADE_COLETIVA,
             "condicoes_clinicas": QUERY_CONDICOES_CLINICAS,
             "antecedentes_obstetricos": QUERY_ANTECEDENTES_OBSTETRICOS,
@@ -35,22 +259,36 @@ class MunicipalityExtractor:
             "procedimentos_faturados": QUERY_PROCEDIMENTOS_FATURADOS
         }
 
-    def _get_date_range(self):
+        # Cache local das dimensões: as queries trazem só as chaves e a junção é feita no cliente
+        self.cache_dimensoes = bool(self.config.get("extracao_cache_dimensoes", True))
+        self.planos_dimensoes = {}
+        # Sincronização de dimensões: profissionais, unidades, CBOs, procedimentos e equipes vão
+        # à API como documentos versionados e os registros levam só a chave (ref_*)
+        self.sincronizar_dimensoes = bool(self.config.get("extracao_sincronizar_dimensoes", False))
+        self.dimensoes_sincronizadas = set()
+        if self.cache_dimensoes or self.sincronizar_dimensoes:
+            self.planos_dimensoes = {nome: dimension_cache.compile_query(sql) for nome, sql in self.queries_map.items()}
+        # Formato colunar dos lotes: nomes das colunas uma vez e um array por coluna, com
+        # dicionário para textos repetidos (ver core.columnar_payload)
+        self.payload_colunar = bool(self.config.get("extracao_payload_colunar", False))
+
+    def _get_date_range(self, nome_query):
         """
-        Determina o data_inicio e data_fim com base nas configurações da conexão
-        e da última sincronização bem-sucedida.
+        Determina o data_inicio e data_fim da coleção com base nas configurações da conexão
+        e na marca d'água da coleção (último envio aceito por completo).
         """
         data_fim_dt = datetime.datetime.now()
         data_fim = int(data_fim_dt.strftime("%Y%m%d"))  # Formato do co_dim_tempo no PEC
         
-        # Pega a última execução
-        last_run_str = config_manager.get_municipality_last_run(self.config.get('id'))
+        # Marca d'água da coleção; conexões antigas ainda só têm o last_run_success geral
+        last_run_str = sync_state.get(self.config.get('id'), "marcas_dagua", nome_query) \
+            or config_manager.get_municipality_last_run(self.config.get('id'))
         
         if last_run_str:
-            # Incremental (desde a última execução)
+            # Incremental (desde o último envio completo desta coleção)
             last_run_dt = datetime.datetime.fromisoformat(last_run_str)
             data_inicio = int(last_run_dt.strftime("%Y%m%d"))
-            print(f"[EXTRACTOR] Extração Incremental: desde {last_run_dt.strftime('%d/%m/%Y %H:%M')}")
+            print(f"[EXTRACTOR] {nome_query}: Extração Incremental desde {last_run_dt.strftime('%d/%m/%Y %H:%M')}")
         else:
             # Carga Inicial
             tipo = self.config.get("extracao_tipo", "dias")
@@ -58,14 +296,14 @@ class MunicipalityExtractor:
                 dias = int(self.config.get("extracao_dias", "30"))
                 data_inicio_dt = data_fim_dt - datetime.timedelta(days=dias)
                 data_inicio = int(data_inicio_dt.strftime("%Y%m%d"))
-                print(f"[EXTRACTOR] Carga Inicial: Retroagindo {dias} dias ({data_inicio_dt.strftime('%d/%m/%Y')})")
+                print(f"[EXTRACTOR] {nome_query}: Carga Inicial retroagindo {dias} dias ({data_inicio_dt.strftime('%d/%m/%Y')})")
             elif tipo == "quad":
                 ano = self.config.get("extracao_ano", "2024")
                 quad = self.config.get("extracao_quad", "Q1")
                 # Q1: 01/01 a 30/04, Q2: 01/05 a 31/08, Q3: 01/09 a 31/12
                 mes_inicio = "01" if quad == "Q1" else ("05" if quad == "Q2" else "09")
                 data_inicio = int(f"{ano}{mes_inicio}01")
-                print(f"[EXTRACTOR] Carga Inicial: Quadrimestre {quad}/{ano}")
+                print(f"[EXTRACTOR] {nome_query}: Carga Inicial do Quadrimestre {quad}/{ano}")
             elif tipo == "custom":
                 dt_ini_str = self.config.get("dt_ini", data_fim_dt.strftime("%Y-%m-%d"))
                 data_inicio = int(dt_ini_str.replace("-", ""))
@@ -74,14 +312,1087 @@ class MunicipalityExtractor:
                 dt_fim_str = self.config.get("dt_fim", "")
                 if dt_fim_str:
                     data_fim = int(dt_fim_str.replace("-", ""))
-                print(f"[EXTRACTOR] Carga Inicial: Período personalizado de {dt_ini_str} até {dt_fim_str or 'hoje'}")
+                print(f"[EXTRACTOR] {nome_query}: Carga Inicial do período personalizado de {dt_ini_str} até {dt_fim_str or 'hoje'}")
 
         return data_inicio, data_fim
 
+    @staticmethod
+    def _to_date(valor):
+        return datetime.datetime.strptime(str(valor), "%Y%m%d").date()
+
+    @staticmethod
+    def _to_tempo(data):
+        return int(data.strftime("%Y%m%d"))
+
+    def _estimate_rows_per_day(self, nome_query, db=None):
+        """
+        Estima quantas linhas por dia a coleção traz: pela estimativa do preflight, quando houver,
+        senão só com estatísticas do catálogo da tabela fato (sem varrer a tabela).
+        Retorna None quando não há estatística utilizável.
+        """
+        estimativa = self.estimativas.get(nome_query)
+        if estimativa and estimativa["periodo"]:
+            inicio, fim = estimativa["periodo"]
+            dias = (self._to_date(fim) - self._to_date(inicio)).days + 1
+            return estimativa["linhas"] / max(dias, 1)
+
+        tabela = TABELAS_FATO.get(nome_query)
+        if not tabela:
+            return None
+        db = db or self.db
+        try:
+            df = db.execute_query_df(SQL_DENSIDADE, params={"tabela": tabela})
+        except Exception as e:
+            print(f"[EXTRACTOR] -> {nome_query}: sem estatísticas de {tabela} ({e}).")
+            return None
+        if df is None or df.empty or df["reltuples"].iloc[0] is None:
+            return None
+
+        linhas = float(df["reltuples"].iloc[0])
+        if linhas < 0:
+            # Tabela nunca analisada (PostgreSQL 14+ devolve -1)
+            return None
+        limites = df["limites"].iloc[0]
+        if not limites:
+            return None
+        valores = limites.strip("{}").split(",")
+        try:
+            dias = (self._to_date(valores[-1]) - self._to_date(valores[0])).days + 1
+        except ValueError:
+            return None
+        return linhas / max(dias, 1)
+
+    def _plan_windows(self, nome_query, data_inicio, data_fim, db=None):
+        """
+        Divide o período [data_inicio, data_fim] (AAAAMMDD) em janelas de mês ou quadrimestre.
+        No modo "auto" o tamanho sai da densidade estimada da tabela: o período inteiro vai de
+        uma vez se couber em JANELA_ALVO_LINHAS, senão usa quadrimestres e, se ainda for muito, meses.
+        """
+        inicio = self._to_date(data_inicio)
+        fim = self._to_date(data_fim)
+        if inicio > fim or self.janelas == "desligado":
+            return [(data_inicio, data_fim)]
+
+        tamanho = self.janelas
+        if tamanho == "auto":
+            por_dia = self._estimate_rows_per_day(nome_query, db=db)
+            dias = (fim - inicio).days + 1
+            if por_dia is None:
+                tamanho = "mes" if dias > 31 else None
+            elif por_dia * dias <= self.janela_alvo_linhas:
+                tamanho = None
+            elif por_dia * 123 <= self.janela_alvo_linhas:
+                tamanho = "quad"
+            else:
+                tamanho = "mes"
+            if por_dia is not None:
+                print(f"[EXTRACTOR] -> {nome_query}: ~{por_dia * dias:.0f} linhas estimadas no período ({por_dia:.0f}/dia).")
+        if tamanho not in ("mes", "quad"):
+            return [(data_inicio, data_fim)]
+
+        meses = 1 if tamanho == "mes" else 4
+        janelas = []
+        atual = inicio
+        while atual <= fim:
+            # Mês/quadrimestre seguinte no calendário (Q1: jan-abr, Q2: mai-ago, Q3: set-dez)
+            mes_seguinte = ((atual.month - 1) // meses + 1) * meses + 1
+            ano_seguinte = atual.year + (mes_seguinte - 1) // 12
+            proximo = datetime.date(ano_seguinte, (mes_seguinte - 1) % 12 + 1, 1)
+            fim_janela = min(fim, proximo - datetime.timedelta(days=1))
+            janelas.append((self._to_tempo(atual), self._to_tempo(fim_janela)))
+            atual = proximo
+        return janelas
+
+    def _sql_da_colecao(self, nome_query):
+        plano = self.planos_dimensoes.get(nome_query)
+        return plano["sql"] if plano else self.queries_map[nome_query]
+
+    def _run_preflight(self):
+        """
+        Roda EXPLAIN (FORMAT JSON) de cada query com o período que será extraído e guarda as
+        linhas, o custo e a largura estimados. Nada é executado de fato no banco.
+        """
+        conn = self.db.get_connection()
+        try:
+            with conn.cursor() as cur:
+                for nome_query in self.queries_map:
+                    sql = self._sql_da_colecao(nome_query)
+                    periodo = None
+                    params = None
+                    if "%(data_inicio)s" in sql:
+                        periodo = self._get_date_range(nome_query)
+                        self.periodos[nome_query] = periodo
+                        params = {"data_inicio": periodo[0], "data_fim": periodo[1]}
+                    try:
+                        cur.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+                        plano = cur.fetchone()[0][0]["Plan"]
+                    except Exception as e:
+                        conn.rollback()
+                        print(f"[PREFLIGHT] {nome_query}: EXPLAIN falhou ({e}).")
+                        continue
+                    self.estimativas[nome_query] = {
+                        "linhas": plano["Plan Rows"],
+                        "custo": plano["Total Cost"],
+                        "largura": plano["Plan Width"],
+                        "periodo": periodo,
+                    }
+                    print(f"[PREFLIGHT] {nome_query}: ~{plano['Plan Rows']} linhas, custo {plano['Total Cost']:.0f}, {plano['Plan Width']} bytes/linha")
+        finally:
+            conn.rollback()
+
+    def _itersize(self, nome_query):
+        """Linhas por busca do cursor nomeado: ~PREFLIGHT_BYTES_POR_BUSCA, salvo se configurado."""
+        estimativa = self.estimativas.get(nome_query)
+        if not estimativa or "extracao_streaming_itersize" in self.config:
+            itersize = self.streaming_itersize
+        else:
+            por_busca = PREFLIGHT_BYTES_POR_BUSCA // max(estimativa["largura"], 1)
+            itersize = max(BATCH_SIZE, min(20000, por_busca))
+        if self.carga and self.carga.nivel() >= OCUPADO:
+            return max(BATCH_SIZE, itersize // CARGA_FATOR_BUSCA)
+        return itersize
+
+    def _respeitar_carga(self):
+        """
+        Chamado antes de cada lote lido do banco: pausa enquanto o PEC estiver saturado e,
+        ocupado, devolve a vez compartilhada pelos workers (um lê por vez); livre, não trava nada.
+        """
+        if not self.carga or self.carga.aguardar(self._is_cancelled) < OCUPADO:
+            return nullcontext()
+        return self._vez_carga
+
+    def _choose_concurrency(self):
+        """Paralelismo desta execução: o configurado, reduzido conforme o peso estimado."""
+        if not self.estimativas or self.paralelismo <= 1:
+            return self.paralelismo
+        linhas = sum(e["linhas"] for e in self.estimativas.values())
+        custo = sum(e["custo"] for e in self.estimativas.values())
+        if linhas < PREFLIGHT_LINHAS_PARALELO:
+            print(f"[PREFLIGHT] ~{linhas} linhas no total: extração sequencial.")
+            return 1
+        if custo > PREFLIGHT_CUSTO_ALTO and self.paralelismo > 2:
+            print(f"[PREFLIGHT] Custo estimado alto ({custo:.0f}): paralelismo limitado a 2.")
+            return 2
+        return self.paralelismo
+
+    def _log_estimate_vs_actual(self, nome_query, segundos):
+        estimativa = self.estimativas.get(nome_query)
+        if estimativa:
+            print(f"[PREFLIGHT] {nome_query}: estimado {estimativa['linhas']} linhas (custo {estimativa['custo']:.0f}), "
+                  f"real {self.lidos.get(nome_query, 0)} linhas em {segundos:.1f}s")
+
     def _chunk_list(self, lst, chunk_size):
         for i in range(0, len(lst), chunk_size):
             yield lst[i:i + chunk_size]
 
+    def _is_cancelled(self):
+        return hasattr(self, 'cancel_event') and self.cancel_event and self.cancel_event.is_set()
+
+    def cancel(self):
+        """
+        Cancela a extração: marca o cancel_event e interrompe no servidor as queries em andamento,
+        sem esperar o fim do lote ou da query atual.
+        """
+        if not getattr(self, 'cancel_event', None):
+            self.cancel_event = threading.Event()
+        self.cancel_event.set()
+        with self._bancos_lock:
+            bancos = list(self._bancos_ativos)
+        for db in bancos:
+            db.cancel()
+
+    def _iter_query_chunks(self, sql, query_params, db=None, itersize=None):
+        """
+        Gera DataFrames de no máximo BATCH_SIZE linhas para a query.
+        Backend "copy" usa COPY TO STDOUT; em modo streaming (padrão) usa cursor nomeado
+        no servidor; caso contrário carrega o resultado inteiro com pandas, como antes.
+        """
+        db = db or self.db
+        if self.backend == "copy":
+            yield from db.iter_query_copy_df(sql, params=query_params, chunk_size=BATCH_SIZE)
+            return
+
+        if self.streaming:
+            yield from db.iter_query_df(sql, params=query_params, chunk_size=BATCH_SIZE, itersize=itersize or self.streaming_itersize)
+            return
+
+        df = db.execute_query_df(sql, params=query_params)
+        if df is None or df.empty:
+            return
+        for inicio in range(0, len(df), BATCH_SIZE):
+            yield df.iloc[inicio:inicio + BATCH_SIZE]
+
+    def _prepare_records(self, df, com_hash=False):
+        """
+        Codifica o DataFrame em registros já em JSON (ver core.batch_encoder), numa passada
+        por coluna: datas em texto, nulos e NaN como "", Decimal e demais tipos como texto.
+        `com_hash` calcula junto o hash de cada linha (para os filtros de inalteradas).
+        """
+        return encode_records(df, com_hash, self.payload_colunar)
+
+    def _post_chunk(self, nome_query, chunk, headers, referencias=None):
+        try:
+            corpo = columnar_batch_body if self.payload_colunar else batch_body
+            payload_str = corpo(nome_query, chunk, self.municipality_id, referencias)
+            response = requests.post(self.api_url, data=payload_str, headers=headers, timeout=60)
+            if response.status_code not in [200, 201]:
+                print(f"[EXTRACTOR] -> Erro na API ({response.status_code}): {response.text}")
+                return False
+            return True
+        except Exception as req_e:
+            print(f"[EXTRACTOR] -> Falha na requisição web: {req_e}")
+            return False
+
+    def _post_dimensao(self, documento, headers):
+        """Envia o documento de referência de uma dimensão (modo de sincronização de dimensões)."""
+        try:
+            payload_str = json.dumps({"dimensao": documento, "municipio_id": self.municipality_id}, default=str)
+            response = requests.post(self.api_url, data=payload_str, headers=headers, timeout=60)
+            if response.status_code not in [200, 201]:
+                print(f"[DIMENSOES] -> Erro na API ({response.status_code}): {response.text}")
+                return False
+            return True
+        except Exception as req_e:
+            print(f"[DIMENSOES] -> Falha na requisição web: {req_e}")
+            return False
+
+    def _preparar_dimensoes(self, headers):
+        """Atualiza o cache local das dimensões e, no modo de sincronização, as envia à API."""
+        if self.planos_dimensoes:
+            try:
+                dimension_cache.refresh(self.db, self.planos_dimensoes.values())
+            except Exception as e:
+                # Sem as dimensões locais, volta para as queries com junção no servidor
+                print(f"[EXTRACTOR] Cache de dimensões indisponível ({e}). Usando junções no banco.")
+                self.planos_dimensoes = {}
+        if self.sincronizar_dimensoes and self.planos_dimensoes:
+            self._sincronizar_dimensoes(headers)
+
+    def _tabelas_dimensoes(self):
+        """Dimensões juntadas no cliente pelas queries desta conexão."""
+        return {juncao["tabela"] for plano in self.planos_dimensoes.values() for juncao in plano["juncoes"]}
+
+    def _preparar_dimensoes_cdc(self, headers, tocadas):
+        """
+        O ciclo CDC roda a cada poucos segundos: as dimensões só são relidas (e reenviadas à API)
+        no primeiro ciclo, quando o slot mostra alteração nelas ou quando o cache do banco não as
+        tem. Nos demais ciclos valem o cache e as dimensões sincronizadas do ciclo anterior.
+        """
+        connection_id = self.config.get('id')
+        anterior = MunicipalityExtractor._dimensoes_cdc.get(connection_id)
+        if (
+            anterior is None
+            or anterior[0] != self.sincronizar_dimensoes
+            or tocadas & self._tabelas_dimensoes()
+            or not dimension_cache.carregadas(self.db.config, self.planos_dimensoes.values())
+        ):
+            self._preparar_dimensoes(headers)
+            MunicipalityExtractor._dimensoes_cdc[connection_id] = (self.sincronizar_dimensoes, set(self.dimensoes_sincronizadas))
+        else:
+            self.dimensoes_sincronizadas = set(anterior[1])
+
+    def _sincronizar_dimensoes(self, headers):
+        """
+        Envia cada dimensão sincronizada usada pelas queries cuja versão difere da registrada
+        no sync_state (seção "dimensoes") e marca em `dimensoes_sincronizadas` as que a API tem
+        na versão atual. Uma dimensão que falhar segue juntada normalmente nesta execução.
+        """
+        connection_id = self.config.get('id')
+        try:
+            versoes = dimension_cache.versoes(self.db, self.planos_dimensoes.values())
+            for tabela, info in versoes.items():
+                if sync_state.get(connection_id, "dimensoes", tabela) == info["versao"]:
+                    self.dimensoes_sincronizadas.add(tabela)
+                    continue
+                documento = dimension_cache.documento(self.db, tabela, info)
+                if self._post_dimensao(documento, headers):
+                    sync_state.set(connection_id, "dimensoes", tabela, info["versao"])
+                    self.dimensoes_sincronizadas.add(tabela)
+                    print(f"[DIMENSOES] {documento['dimensao']}: versão {info['versao'][:8]} enviada ({len(documento['linhas'])} linhas).")
+                else:
+                    print(f"[DIMENSOES] {documento['dimensao']}: envio falhou, os registros seguem com os valores nesta execução.")
+        except Exception as e:
+            print(f"[DIMENSOES] Sincronização indisponível ({e}). Registros seguem com os valores das dimensões.")
+            self.dimensoes_sincronizadas = set()
+            return
+        if self.dimensoes_sincronizadas:
+            nomes = ", ".join(DIMENSOES_SINCRONIZADAS[t][0] for t in sorted(self.dimensoes_sincronizadas))
+            print(f"[DIMENSOES] Registros levam só a chave de: {nomes}.")
+
+    def _post_tombstones(self, nome_query, chaves, headers):
+        """Envia, em lotes, as chaves que deixaram de existir na origem (sem dados)."""
+        for inicio in range(0, len(chaves), BATCH_SIZE):
+            payload = {
+                "collection": nome_query,
+                "data": [],
+                "tombstones": chaves[inicio:inicio + BATCH_SIZE],
+                "municipio_id": self.municipality_id
+            }
+            try:
+                response = requests.post(self.api_url, data=json.dumps(payload), headers=headers, timeout=60)
+                if response.status_code not in [200, 201]:
+                    print(f"[EXTRACTOR] -> Erro na API ao enviar remoções ({response.status_code}): {response.text}")
+                    return False
+            except Exception as req_e:
+                print(f"[EXTRACTOR] -> Falha na requisição web: {req_e}")
+                return False
+        return True
+
+    @staticmethod
+    def _valor_canonico(valor):
+        # O mesmo valor muda de forma conforme o lote: inteiro vira float numa coluna com NULL e
+        # uma coluna de datas só com meia-noite perde a hora no astype(str)
+        if isinstance(valor, float) and valor.is_integer():
+            return int(valor)
+        if isinstance(valor, str) and len(valor) == 19 and valor.endswith(" 00:00:00"):
+            return valor[:10]
+        return valor
+
+    @classmethod
+    def _row_hash(cls, registro):
+        if isinstance(registro, EncodedRow):
+            return registro.hash()
+        canonico = {coluna: cls._valor_canonico(valor) for coluna, valor in registro.items()}
+        return hashlib.blake2b(json.dumps(canonico, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+
+    @staticmethod
+    def _chave_str(valor):
+        # Chaves inteiras podem chegar como float (coluna com NaN no DataFrame)
+        if isinstance(valor, float) and valor.is_integer():
+            valor = int(valor)
+        return str(valor)
+
+    def _chave_natural(self, registro, campo=None):
+        """Chave do documento na API: `campo`, ou o primeiro de CAMPOS_ID preenchido (None se nenhum)."""
+        for nome in ((campo,) if campo else CAMPOS_ID):
+            valor = registro.get(nome)
+            if valor not in (None, ""):
+                return self._chave_str(valor)
+        return None
+
+    def _filtro_inalteradas(self, sonda, vistas, campo_chave=None):
+        """
+        Filtro para _stream_and_send: descarta as linhas cujo hash está na sonda (já aceitas
+        pela API) e anota em `vistas` {chave: set(hashes)} todas as linhas lidas. Linhas sem
+        chave natural viram documentos novos na API e vão sempre.
+        """
+        def _filtrar(registros):
+            enviar = []
+            for registro in registros:
+                hash_reg = self._row_hash(registro)
+                chave_reg = self._chave_natural(registro, campo_chave)
+                if chave_reg is None:
+                    enviar.append(registro)
+                    continue
+                vistas.setdefault(chave_reg, set()).add(hash_reg)
+                if hash_reg not in sonda:
+                    enviar.append(registro)
+            return enviar
+        return _filtrar
+
+    def _stream_and_send(self, nome_query, sql, query_params, headers, db=None, chave=None, filtro=None):
+        """
+        Executa a query e envia os lotes à medida que chegam do banco.
+        `filtro`, se informado, recebe os registros de cada lote e devolve só os que devem ir à API.
+        Retorna (sucesso, total_registros, lotes, último valor da coluna `chave`, linhas lidas do banco).
+        """
+        sucesso = True
+        total_registros = 0
+        total_lidos = 0
+        idx = 0
+        ultima_chave = None
+        descartadas = 0
+        plano = self.planos_dimensoes.get(nome_query)
+        referencias = dimension_cache.referencias(plano, self.dimensoes_sincronizadas) if plano else None
+        sonda = self._sondas.get(nome_query)
+        vistas = None
+        if filtro is None and sonda is not None:
+            vistas = {}
+            filtro = self._filtro_inalteradas(sonda, vistas)
+        lotes = self._iter_query_chunks(sql, query_params, db=db, itersize=self._itersize(nome_query))
+        while True:
+            with self._respeitar_carga():
+                df = next(lotes, None)
+            if df is None:
+                break
+            if self._is_cancelled():
+                print("[EXTRACTOR] Extração interrompida pelo usuário.")
+                return False, total_registros, idx, ultima_chave, total_lidos
+
+            total_lidos += len(df)
+            self.lidos[nome_query] = self.lidos.get(nome_query, 0) + len(df)
+            if chave is not None:
+                ultima_chave = df[chave].iloc[-1]
+            if plano:
+                df = dimension_cache.apply(self.config, df, plano, self.dimensoes_sincronizadas)
+                if df.empty:
+                    continue
+            chunk = self._prepare_records(df, com_hash=filtro is not None)
+            if filtro:
+                lidas = len(chunk)
+                chunk = filtro(chunk)
+                descartadas += lidas - len(chunk)
+                if not chunk:
+                    continue
+            idx += 1
+            total_registros += len(chunk)
+            print(f"[EXTRACTOR]    -> Enviando lote {idx} ({len(chunk)} registros)...", flush=True)
+            if not self._post_chunk(nome_query, chunk, headers, referencias):
+                sucesso = False
+
+        if descartadas:
+            print(f"[EXTRACTOR]    -> {descartadas} linhas iguais às já enviadas não foram reenviadas.")
+        if sucesso and vistas:
+            # Só chega aqui com todos os lotes aceitos: grava as chaves que tiveram linha nova
+            novas = {k: v for k, v in vistas.items() if any(h not in sonda for h in v)}
+            row_store.apply(self.config.get('id'), nome_query, novas, [])
+        return sucesso, total_registros, idx, ultima_chave, total_lidos
+
+    def _extract_collection(self, nome_query, sql, headers, db=None):
+        """
+        Extrai uma coleção e envia os lotes à medida que chegam do banco.
+        Quando todos os lotes são aceitos pela API, grava a marca d'água da coleção;
+        as demais coleções seguem independentes. Retorna True em caso de sucesso.
+        """
+        inicio_coleta = datetime.datetime.now()
+        sql = self._sql_da_colecao(nome_query)
+
+        # Somente calcula/passa os parâmetros se a query os contiver
+        if self.delta and nome_query in COLECOES_DELTA:
+            sucesso = self._extract_collection_delta(nome_query, sql, headers, db=db)
+        else:
+            if self.suprimir_inalteradas:
+                self._sondas[nome_query] = row_store.load_probe(self.config.get('id'), nome_query)
+            try:
+                sequencia = self._sequencia_gravada(nome_query) if "%(data_inicio)s" in sql else None
+                if sequencia is not None:
+                    sucesso = self._extract_collection_sequence(nome_query, sql, headers, sequencia, db=db)
+                elif "%(data_inicio)s" in sql:
+                    # Sequência lida antes da carga: o que for inserido durante ela fica para a próxima
+                    inicio_sequencia = self._sequencia_atual(nome_query, db=db)
+                    grupos = self._plan_unit_partitions(nome_query, sql, db=db)
+                    if grupos:
+                        sucesso = self._extract_collection_partitions(nome_query, sql, headers, grupos, db=db)
+                    else:
+                        sucesso = self._extract_collection_windows(nome_query, sql, headers, db=db)
+                    if sucesso and inicio_sequencia is not None and not self._is_cancelled():
+                        sync_state.set(self.config.get('id'), "sequencias", SEQUENCIAS[nome_query]["tabela"], inicio_sequencia)
+                else:
+                    sucesso = self._extract_collection_full(nome_query, sql, None, headers, db=db)
+            finally:
+                self._sondas.pop(nome_query, None)
+
+        self._log_estimate_vs_actual(nome_query, (datetime.datetime.now() - inicio_coleta).total_seconds())
+        if sucesso and not self._is_cancelled():
+            sync_state.set(self.config.get('id'), "marcas_dagua", nome_query, inicio_coleta.isoformat())
+        return sucesso
+
+    def _sequencia_gravada(self, nome_query):
+        """Última sequência co_seq_* já enviada da coleção, ou None (modo desligado / sem carga completa)."""
+        if not self.sequencia or nome_query not in SEQUENCIAS:
+            return None
+        return sync_state.get(self.config.get('id'), "sequencias", SEQUENCIAS[nome_query]["tabela"])
+
+    def _sequencia_atual(self, nome_query, db=None):
+        """Maior co_seq_* da tabela da coleção agora (0 se vazia), ou None se não der para ler."""
+        if not self.sequencia or nome_query not in SEQUENCIAS:
+            return None
+        spec = SEQUENCIAS[nome_query]
+        db = db or self.db
+        try:
+            df = db.execute_query_df(f"SELECT max({spec['coluna']}) AS ultima FROM {spec['tabela']}")
+        except Exception as e:
+            print(f"[EXTRACTOR] -> {nome_query}: sequência de {spec['tabela']} indisponível ({e}); incremental segue por data.")
+            return None
+        ultima = df["ultima"].iloc[0]
+        return 0 if ultima is None or ultima != ultima else int(ultima)
+
+    def _periodo_linhas(self, nome_query, condicao, params, db):
+        """(menor co_dim_tempo, maior co_dim_tempo, maior sequência) das linhas da coleção que atendem `condicao`."""
+        spec = SEQUENCIAS[nome_query]
+        sql = SQL_PERIODO_LINHAS.format(
+            tabela=spec["tabela"], coluna=spec["coluna"], condicao=condicao,
+            juncao=spec.get("juncao", ""), tempo=spec.get("tempo", "s.co_dim_tempo")
+        )
+        valores = db.execute_query_df(sql, params=params).iloc[0].tolist()
+        if valores[0] is None or valores[0] != valores[0]:
+            return None, None, None
+        return tuple(int(v) for v in valores)
+
+    def _extract_collection_sequence(self, nome_query, sql, headers, sequencia, db=None):
+        """
+        Incremental pela sequência co_seq_* (SEQUENCIAS): lê as linhas inseridas desde a última
+        execução, em páginas keyset a partir da sequência gravada (menos a margem), com o filtro
+        de data reduzido ao período em que essas linhas caem. A nova sequência só é gravada
+        quando todos os lotes foram aceitos.
+        """
+        spec = SEQUENCIAS[nome_query]
+        connection_id = self.config.get('id')
+        db = db or self.db
+        desde = max(int(sequencia) - self.sequencia_margem, 0)
+
+        data_inicio, data_fim, ultima = self._periodo_linhas(nome_query, f"s.{spec['coluna']} > %(seq_desde)s", {"seq_desde": desde}, db)
+        if data_inicio is None:
+            print(f"[EXTRACTOR] -> {nome_query}: nenhuma linha nova desde a sequência {sequencia}.")
+            return True
+
+        params = {"data_inicio": int(data_inicio), "data_fim": int(data_fim)}
+        print(f"[EXTRACTOR] -> {nome_query}: linhas com sequência acima de {desde} (período {params['data_inicio']} a {params['data_fim']})")
+        sucesso = self._extract_collection_keyset(nome_query, sql, params, headers, CHAVES_KEYSET[nome_query], db=db, desde=desde)
+        if sucesso and not self._is_cancelled():
+            sync_state.set(connection_id, "sequencias", spec["tabela"], max(int(ultima), int(sequencia)))
+        return sucesso
+
+    def _extract_collection_changes(self, nome_query, sql, chaves, removidas, headers):
+        """
+        Modo CDC: relê da query da coleção só as chaves alteradas (= ANY, em blocos), com o filtro
+        de data reduzido ao período delas, e envia as chaves apagadas na origem como remoções.
+        """
+        spec = SEQUENCIAS[nome_query]
+        chave = CHAVES_KEYSET[nome_query]
+        connection_id = self.config.get('id')
+        if self.suprimir_inalteradas:
+            self._sondas[nome_query] = row_store.load_probe(connection_id, nome_query)
+        try:
+            total_registros = 0
+            total_lotes = 0
+            # Chaves co_seq_* não voltam a existir depois de apagadas: as removidas não são relidas
+            lista = sorted(chaves - removidas)
+            for inicio in range(0, len(lista), CDC_CHAVES_POR_CONSULTA):
+                if self._is_cancelled():
+                    return False
+                parte = lista[inicio:inicio + CDC_CHAVES_POR_CONSULTA]
+                data_inicio, data_fim, _ = self._periodo_linhas(nome_query, f"s.{spec['coluna']} = ANY(%(cdc_chaves)s)", {"cdc_chaves": parte}, self.db)
+                if data_inicio is None:
+                    continue
+                sql_cdc = f"SELECT * FROM (\n{sql}\n) AS cdc\nWHERE cdc.{chave} = ANY(%(cdc_chaves)s)"
+                params = {"data_inicio": data_inicio, "data_fim": data_fim, "cdc_chaves": parte}
+                sucesso, registros, lotes, _, _ = self._stream_and_send(nome_query, sql_cdc, params, headers)
+                total_registros += registros
+                total_lotes += lotes
+                if not sucesso:
+                    return False
+        finally:
+            self._sondas.pop(nome_query, None)
+
+        remover = sorted(self._chave_str(v) for v in removidas)
+        if remover and self.suprimir_inalteradas:
+            # Linha inserida e apagada entre dois ciclos nunca chegou à API: não vira remoção
+            enviadas = row_store.load(connection_id, nome_query)
+            remover = [k for k in remover if k in enviadas]
+        if remover:
+            if not self._post_tombstones(nome_query, remover, headers):
+                return False
+            row_store.apply(connection_id, nome_query, {}, remover)
+        print(f"[CDC] -> {nome_query}: {len(lista)} chaves alteradas, {total_registros} registros enviados em {total_lotes} lote(s), {len(remover)} removidos.")
+        return True
+
+    @staticmethod
+    def _tabelas_fonte(sql):
+        """Tabelas (fora as dimensões) lidas por uma query."""
+        return {t for t in re.findall(r"\b(?:FROM|JOIN)\s+(tb_\w+)", sql, re.IGNORECASE) if not t.startswith("tb_dim_")}
+
+    @staticmethod
+    def _agrupar_eventos_cdc(eventos):
+        """
+        Agrupa os eventos do slot por coleção de fatos (CDC_CHAVES): ({coleção: chaves a reenviar},
+        {coleção: chaves apagadas na própria tabela}, tabelas tocadas).
+        """
+        chaves = {}
+        removidas = {}
+        tocadas = set()
+        for tabela, operacao, colunas in eventos:
+            tocadas.add(tabela)
+            for nome_query, coluna in CDC_CHAVES.get(tabela, ()):
+                valor = colunas.get(coluna)
+                if valor is None:
+                    continue
+                if operacao == "DELETE" and coluna == SEQUENCIAS[nome_query]["coluna"]:
+                    removidas.setdefault(nome_query, set()).add(int(valor))
+                else:
+                    chaves.setdefault(nome_query, set()).add(int(valor))
+        return chaves, removidas, tocadas
+
+    def _cdc_feed(self):
+        # As dimensões do cache também vêm pelo slot: alteradas, o ciclo as relê
+        tabelas = set(CDC_CHAVES) | self._tabelas_dimensoes()
+        for nome_query in COLECOES_DELTA:
+            tabelas |= self._tabelas_fonte(self.queries_map[nome_query])
+        return LogicalChangeFeed(self.db, self.cdc_slot, self.cdc_plugin, tabelas)
+
+    def _run_cdc(self, headers):
+        """
+        Um ciclo do modo CDC: lê as alterações pendentes no slot, reenvia as linhas afetadas de cada
+        coleção de fatos (CDC_CHAVES) e roda o delta das coleções de cadastro cujas tabelas mudaram.
+        O slot só avança quando tudo foi aceito. Retorna None quando a extração deve seguir por
+        consulta (slot indisponível, ou recém-criado: a carga normal cobre o que veio antes dele).
+        """
+        connection_id = self.config.get('id')
+        feed = self._cdc_feed()
+        try:
+            criado = feed.ensure()
+        except Exception as e:
+            print(f"[CDC] Replicação lógica indisponível ({e}). Seguindo com a extração por consulta.")
+            return None
+        sync_state.set(connection_id, "cdc", "slot", {"nome": feed.slot, "plugin": feed.plugin})
+        if criado:
+            print(f"[CDC] Slot {feed.slot} ({feed.plugin}) criado: esta execução extrai por consulta, as próximas leem as alterações do slot.")
+            return None
+
+        lsn, eventos = feed.peek(self.cdc_limite)
+        if lsn is None:
+            print("[CDC] Nenhuma alteração pendente no slot.")
+            return True
+
+        chaves, removidas, tocadas = self._agrupar_eventos_cdc(eventos)
+        if eventos:
+            self._preparar_dimensoes_cdc(headers, tocadas)
+        try:
+            retido = f" (WAL retido pelo slot: {feed.lag_bytes() / 1e6:.1f} MB)"
+        except Exception:
+            retido = ""
+        print(f"[CDC] {len(eventos)} alterações até {lsn} em {', '.join(sorted(tocadas)) or 'nenhuma tabela acompanhada'}{retido}.")
+
+        sucesso_total = True
+        for nome_query, sql in self.queries_map.items():
+            if self._is_cancelled():
+                return False
+            try:
+                if nome_query in COLECOES_DELTA:
+                    if tocadas & self._tabelas_fonte(sql):
+                        sucesso = self._extract_collection(nome_query, sql, headers)
+                    else:
+                        continue
+                elif nome_query in chaves or nome_query in removidas:
+                    sucesso = self._extract_collection_changes(
+                        nome_query, self._sql_da_colecao(nome_query), chaves.get(nome_query, set()), removidas.get(nome_query, set()), headers
+                    )
+                else:
+                    continue
+            except Exception as e:
+                print(f"[CDC] Erro ao processar {nome_query}: {e}")
+                sucesso = False
+            sucesso_total = sucesso_total and sucesso
+
+        if sucesso_total and not self._is_cancelled():
+            feed.advance(lsn)
+        else:
+            print(f"[CDC] Alterações mantidas no slot (até {lsn}) para a próxima execução.")
+        return sucesso_total
+
+    def _drop_cdc_slot(self):
+        """Modo CDC desligado: remove o slot criado antes para o servidor não reter WAL à toa."""
+        connection_id = self.config.get('id')
+        registro = sync_state.get(connection_id, "cdc", "slot")
+        if not registro:
+            return
+        try:
+            LogicalChangeFeed(self.db, registro["nome"], registro["plugin"]).drop()
+            sync_state.delete(connection_id, "cdc", "slot")
+            print(f"[CDC] Modo CDC desligado: slot {registro['nome']} removido do servidor.")
+        except Exception as e:
+            print(f"[CDC] Não foi possível remover o slot {registro['nome']} ({e}).")
+
+    def _extract_collection_delta(self, nome_query, sql, headers, db=None):
+        """
+        Envia só o que mudou numa coleção de cadastro desde o último envio aceito.
+        Cada linha é comparada com o hash guardado em row_store; com colunas de alteração
+        (COLECOES_DELTA["marcas"]) a query já filtra no banco as linhas alteradas desde a última
+        marca e as chaves atuais são lidas à parte (só inteiros) para achar as remoções.
+        A primeira execução envia tudo e registra os hashes.
+        """
+        spec = COLECOES_DELTA[nome_query]
+        chave = spec["chave"]
+        connection_id = self.config.get('id')
+        db = db or self.db
+
+        conhecidas = row_store.load(connection_id, nome_query)
+        marca = sync_state.get(connection_id, "delta", nome_query)
+        filtrar_no_banco = bool(spec["marcas"] and marca and conhecidas)
+
+        params = None
+        sql_delta = sql
+        if filtrar_no_banco:
+            condicao = " OR ".join(f"delta.{coluna} >= %(delta_marca)s" for coluna in spec["marcas"])
+            sql_delta = f"SELECT * FROM (\n{sql}\n) AS delta\nWHERE {condicao}"
+            params = {"delta_marca": marca}
+            print(f"[EXTRACTOR] -> {nome_query}: delta desde {marca} ({len(conhecidas)} chaves conhecidas)")
+        elif conhecidas:
+            print(f"[EXTRACTOR] -> {nome_query}: delta por hash ({len(conhecidas)} chaves conhecidas)")
+
+        vistas = {}          # chave -> hashes de todas as linhas lidas nesta execução
+        nova_marca = [marca]
+        filtrar = self._filtro_inalteradas(RowProbe(h for hs in conhecidas.values() for h in hs), vistas, chave)
+
+        def _somente_alteradas(registros):
+            for registro in registros:
+                for coluna in spec["marcas"]:
+                    valor = registro.get(coluna)
+                    if valor not in (None, "", "NaT") and (nova_marca[0] is None or str(valor) > nova_marca[0]):
+                        nova_marca[0] = str(valor)
+            return filtrar(registros)
+
+        sucesso, total_registros, lotes, _, lidos = self._stream_and_send(
+            nome_query, sql_delta, params, headers, db=db, filtro=_somente_alteradas
+        )
+        if not sucesso or self._is_cancelled():
+            return False
+
+        # Chaves presentes hoje: com filtro no banco, lê só a coluna chave da query completa
+        if filtrar_no_banco:
+            df_chaves = db.execute_query_df(f"SELECT delta.{chave} FROM (\n{sql}\n) AS delta")
+            atuais = {self._chave_str(v) for v in df_chaves[chave].tolist()}
+        else:
+            atuais = set(vistas)
+        removidas = sorted(set(conhecidas) - atuais)
+
+        if removidas and not self._post_tombstones(nome_query, removidas, headers):
+            return False
+
+        # Linhas filtradas no banco não foram lidas: preserva os hashes que já estavam guardados
+        alteradas = {k: v for k, v in vistas.items() if conhecidas.get(k) != v}
+        row_store.apply(connection_id, nome_query, alteradas, removidas)
+        if nova_marca[0]:
+            sync_state.set(connection_id, "delta", nome_query, nova_marca[0])
+
+        print(f"[EXTRACTOR] -> {nome_query}: {lidos} lidos, {total_registros} novos/alterados enviados em {lotes} lote(s), {len(removidas)} removidos.")
+        return True
+
+    def _extract_collection_windows(self, nome_query, sql, headers, db=None, estado=None, extras=None):
+        """
+        Extrai o período da coleção janela a janela (ver _plan_windows). Cada janela é lida,
+        enviada e registrada em disco antes da próxima, então uma carga inicial longa não prende
+        um único snapshot no banco do município e, se cair, recomeça da janela pendente.
+        `estado` é a chave das posições salvas (uma por partição) e `extras`, parâmetros da query.
+        """
+        connection_id = self.config.get('id')
+        estado = estado or nome_query
+        progresso = sync_state.get(connection_id, "janelas", estado)
+        if progresso:
+            data_inicio, data_fim = progresso["proxima"], progresso["data_fim"]
+            print(f"[EXTRACTOR] -> {nome_query}: retomando carga em janelas a partir de {data_inicio}")
+        elif nome_query in self.periodos:
+            data_inicio, data_fim = self.periodos[nome_query]
+        else:
+            data_inicio, data_fim = self._get_date_range(nome_query)
+
+        chave = CHAVES_KEYSET.get(nome_query) if self.paginacao else None
+        cursor = sync_state.get(connection_id, "cursores", estado) if chave else None
+        if cursor and data_inicio <= cursor["data_inicio"] <= cursor["data_fim"] <= data_fim:
+            # Página interrompida: a primeira janela precisa terminar onde ela terminava
+            janelas = [(data_inicio, cursor["data_fim"])]
+            if cursor["data_fim"] < data_fim:
+                proxima = self._to_tempo(self._to_date(cursor["data_fim"]) + datetime.timedelta(days=1))
+                janelas += self._plan_windows(nome_query, proxima, data_fim, db=db)
+        else:
+            janelas = self._plan_windows(nome_query, data_inicio, data_fim, db=db)
+
+        if len(janelas) > 1:
+            print(f"[EXTRACTOR] -> {nome_query}: período dividido em {len(janelas)} janelas.")
+
+        for idx, (inicio_janela, fim_janela) in enumerate(janelas, 1):
+            if self._is_cancelled():
+                return False
+            if len(janelas) > 1:
+                print(f"[EXTRACTOR] -> {nome_query}: janela {idx}/{len(janelas)} ({inicio_janela} a {fim_janela})")
+
+            params = {
+                "data_inicio": inicio_janela,
+                "data_fim": fim_janela,
+                **(extras or {})
+            }
+            if chave:
+                sucesso = self._extract_collection_keyset(nome_query, sql, params, headers, chave, db=db, estado=estado)
+            else:
+                sucesso = self._extract_collection_full(nome_query, sql, params, headers, db=db)
+            if not sucesso:
+                return False
+
+            if idx < len(janelas):
+                sync_state.set(connection_id, "janelas", estado, {
+                    "proxima": janelas[idx][0],
+                    "data_fim": data_fim
+                })
+
+        sync_state.delete(connection_id, "janelas", estado)
+        return True
+
+    def _estimate_rows_per_unit(self, nome_query, db=None):
+        """
+        Linhas estimadas da tabela fato da coleção por unidade de saúde ({co_seq_dim_unidade_saude:
+        linhas}), só pelo catálogo: valores mais comuns do pg_stats e o restante dividido igualmente
+        entre as demais unidades. Sem estatística, todas as unidades pesam o mesmo.
+        """
+        _, coluna = PARTICAO_UNIDADE[nome_query]
+        db = db or self.db
+        df = db.execute_query_df(SQL_UNIDADES, params={"tabela": TABELAS_FATO[nome_query], "coluna": coluna})
+        if df is None or df.empty or not df["unidades"].iloc[0]:
+            return {}
+        unidades = [int(u) for u in df["unidades"].iloc[0].strip("{}").split(",")]
+        linhas = df["reltuples"].iloc[0]
+        valores, frequencias = df["valores"].iloc[0], df["frequencias"].iloc[0]
+        if linhas is None or linhas < 0 or df["n_distinct"].iloc[0] is None or df["n_distinct"].iloc[0] != df["n_distinct"].iloc[0]:
+            return {u: 1.0 for u in unidades}
+
+        comuns = {}
+        if valores:
+            comuns = dict(zip((int(v) for v in valores.strip("{}").split(",")), (float(f) for f in frequencias.strip("{}").split(","))))
+        distintos = df["n_distinct"].iloc[0]
+        distintos = distintos if distintos >= 0 else -distintos * linhas
+        restante = max(1.0 - float(df["null_frac"].iloc[0] or 0) - sum(comuns.values()), 0.0) / max(distintos - len(comuns), 1)
+        return {u: linhas * comuns.get(u, restante) for u in unidades}
+
+    def _plan_unit_partitions(self, nome_query, sql, db=None):
+        """
+        Grupos de unidades de saúde (listas de co_seq_dim_unidade_saude) em que a coleção é lida,
+        ou None para ler sem partição. Enquanto uma carga particionada não termina, os grupos
+        gravados no sync_state são reaproveitados para as posições salvas continuarem valendo.
+        """
+        if self.particoes_unidade <= 1 or nome_query not in PARTICAO_UNIDADE:
+            return None
+        alias, _ = PARTICAO_UNIDADE[nome_query]
+        if f"WHERE {alias}.co_dim_tempo >= %(data_inicio)s" not in sql:
+            return None
+        connection_id = self.config.get('id')
+        plano = sync_state.get(connection_id, "particoes", nome_query)
+        if plano:
+            self.periodos[nome_query] = tuple(plano["periodo"])
+            return plano["grupos"]
+
+        por_dia = self._estimate_rows_per_day(nome_query, db=db)
+        if por_dia is not None and por_dia * 31 <= self.janela_alvo_linhas:
+            # Um mês inteiro cabe numa consulta: as janelas bastam
+            return None
+        try:
+            pesos = self._estimate_rows_per_unit(nome_query, db=db)
+        except Exception as e:
+            print(f"[EXTRACTOR] -> {nome_query}: sem estimativa por unidade de saúde ({e}); sem partições.")
+            return None
+        if len(pesos) < 2:
+            return None
+
+        # Mais pesadas primeiro, cada uma no grupo mais leve até então
+        grupos = [[] for _ in range(min(self.particoes_unidade, len(pesos)))]
+        totais = [0.0] * len(grupos)
+        for unidade in sorted(pesos, key=lambda u: -pesos[u]):
+            i = totais.index(min(totais))
+            grupos[i].append(unidade)
+            totais[i] += pesos[unidade]
+        grupos = [sorted(g) for g in grupos]
+
+        periodo = self.periodos.get(nome_query) or self._get_date_range(nome_query)
+        self.periodos[nome_query] = periodo
+        sync_state.set(connection_id, "particoes", nome_query, {"grupos": grupos, "periodo": list(periodo)})
+        print(f"[EXTRACTOR] -> {nome_query}: {len(grupos)} partições por unidade de saúde, "
+              f"~{', '.join(f'{t:.0f}' for t in totais)} linhas estimadas.")
+        return grupos
+
+    def _extract_collection_partitions(self, nome_query, sql, headers, grupos, db=None):
+        """
+        Lê a coleção por grupo de unidades de saúde, cada grupo com as suas janelas e posições
+        salvas ("coleção@n"). Fora do modo paralelo, os grupos rodam ao mesmo tempo em conexões
+        do pool; dentro dele, um depois do outro na conexão do worker. O último grupo também leva
+        as linhas sem unidade ou com unidade fora da dimensão.
+        """
+        connection_id = self.config.get('id')
+        alias, coluna = PARTICAO_UNIDADE[nome_query]
+        condicao = f"WHERE {alias}.co_dim_tempo >= %(data_inicio)s"
+
+        def _particao(idx, db_particao):
+            if idx < len(grupos) - 1:
+                filtro = f"{alias}.{coluna} = ANY(%(particao_unidades)s)"
+                unidades = grupos[idx]
+            else:
+                filtro = f"({alias}.{coluna} IS NULL OR {alias}.{coluna} <> ALL(%(particao_unidades)s))"
+                unidades = [u for g in grupos[:-1] for u in g]
+            estado = f"{nome_query}@{idx + 1}"
+            print(f"[EXTRACTOR] -> {nome_query}: partição {idx + 1}/{len(grupos)} ({len(grupos[idx])} unidades)")
+            sucesso = self._extract_collection_windows(
+                nome_query, sql.replace(condicao, f"WHERE {filtro} AND {alias}.co_dim_tempo >= %(data_inicio)s", 1),
+                headers, db=db_particao, estado=estado, extras={"particao_unidades": unidades}
+            )
+            if sucesso and not self._is_cancelled():
+                sync_state.set(connection_id, "particoes", estado, True)
+            return sucesso
+
+        def _worker(idx):
+            if self._is_cancelled():
+                return False
+            db_particao = DatabaseConnection(self.config)
+            with self._bancos_lock:
+                self._bancos_ativos.add(db_particao)
+            try:
+                return _particao(idx, db_particao)
+            except Exception as e:
+                if not self._is_cancelled():
+                    print(f"[EXTRACTOR] -> {nome_query}: partição {idx + 1} falhou ({e}).")
+                return False
+            finally:
+                with self._bancos_lock:
+                    self._bancos_ativos.discard(db_particao)
+                db_particao.close()
+
+        pendentes = [i for i in range(len(grupos)) if not sync_state.get(connection_id, "particoes", f"{nome_query}@{i + 1}")]
+        if len(pendentes) < len(grupos):
+            print(f"[EXTRACTOR] -> {nome_query}: {len(grupos) - len(pendentes)} partição(ões) já concluída(s) anteriormente.")
+
+        if db is not None and db is not self.db:
+            # Worker do modo paralelo: as demais conexões do host já estão com as outras coleções
+            sucesso = all([_particao(idx, db) for idx in pendentes])
+        else:
+            workers = max(1, min(len(pendentes), connection_pool.max_por_host - 1))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                sucesso = all(list(executor.map(_worker, pendentes)))
+
+        if sucesso and not self._is_cancelled():
+            for idx in range(len(grupos)):
+                sync_state.delete(connection_id, "particoes", f"{nome_query}@{idx + 1}")
+            sync_state.delete(connection_id, "particoes", nome_query)
+        return sucesso
+
+    def _extract_collection_full(self, nome_query, sql, query_params, headers, db=None):
+        sucesso, total_registros, lotes, _, _ = self._stream_and_send(nome_query, sql, query_params, headers, db=db)
+        if total_registros == 0:
+            print(f"[EXTRACTOR] -> {nome_query}: 0 registros encontrados.")
+        else:
+            print(f"[EXTRACTOR] -> {nome_query}: {total_registros} registros extraídos e enviados em {lotes} lote(s).")
+        return sucesso
+
+    def _extract_collection_keyset(self, nome_query, sql, params, headers, chave, db=None, desde=None, estado=None):
+        """
+        Lê a coleção em páginas ordenadas pela chave co_seq_* da tabela fato (keyset pagination).
+        Depois que todos os lotes de uma página são aceitos, a última chave é gravada em disco;
+        se a extração cair no meio, a próxima execução continua da página seguinte.
+        `desde`, se informado, faz a leitura começar depois dessa chave.
+        """
+        connection_id = self.config.get('id')
+        estado = estado or nome_query
+        params = dict(params)
+        ultima_chave = desde
+
+        cursor = sync_state.get(connection_id, "cursores", estado)
+        if cursor:
+            # Mantém o início do período interrompido para não perder o que ainda não foi lido dele
+            params["data_inicio"] = min(params["data_inicio"], cursor["data_inicio"])
+            ultima_chave = cursor["ultima_chave"]
+            print(f"[EXTRACTOR] -> {nome_query}: retomando a partir da chave {ultima_chave} (período desde {params['data_inicio']})")
+
+        total_registros = 0
+        total_lotes = 0
+        while True:
+            if self._is_cancelled():
+                return False
+
+            filtro = f"WHERE pagina.{chave} > %(keyset_ultima_chave)s" if ultima_chave is not None else ""
+            sql_pagina = SQL_KEYSET.format(sql=sql, chave=chave, filtro=filtro, limite=self.tamanho_pagina)
+            page_params = dict(params, keyset_ultima_chave=ultima_chave)
+
+            sucesso, registros, lotes, chave_pagina, lidos = self._stream_and_send(nome_query, sql_pagina, page_params, headers, db=db, chave=chave)
+            total_registros += registros
+            total_lotes += lotes
+            if not sucesso:
+                print(f"[EXTRACTOR] -> {nome_query}: página com falha; progresso mantido na chave {ultima_chave}.")
+                return False
+            if lidos == 0:
+                break
+
+            ultima_chave = int(chave_pagina)
+            if lidos < self.tamanho_pagina:
+                break
+            sync_state.set(connection_id, "cursores", estado, {
+                "data_inicio": params["data_inicio"],
+                "data_fim": params["data_fim"],
+                "ultima_chave": ultima_chave
+            })
+
+        sync_state.delete(connection_id, "cursores", estado)
+        if total_registros == 0:
+            print(f"[EXTRACTOR] -> {nome_query}: 0 registros encontrados.")
+        else:
+            print(f"[EXTRACTOR] -> {nome_query}: {total_registros} registros extraídos e enviados em {total_lotes} lote(s).")
+        return True
+
+    def _run_sequential(self, headers):
+        sucesso_total = True
+
+        for nome_query, sql in self.queries_map.items():
+            print(f"[EXTRACTOR] Executando extração: {nome_query}...")
+            
+            try:
+                if self._is_cancelled():
+                    print("[EXTRACTOR] Execução interrompida, pulando restante...")
+                    sucesso_total = False
+                    break
+
+                if not self._extract_collection(nome_query, sql, headers):
+                    sucesso_total = False
+
+            except Exception as q_err:
+                if self._is_cancelled():
+                    print(f"[EXTRACTOR] Query {nome_query} cancelada no servidor.")
+                else:
+                    print(f"[EXTRACTOR] Erro ao executar query {nome_query}: {q_err}")
+                sucesso_total = False
+
+        return sucesso_total
+
+    def _run_parallel(self, headers, paralelismo):
+        """
+        Extrai as coleções em paralelo, cada uma em sua conexão do pool.
+        Todas importam o mesmo snapshot (pg_export_snapshot) em REPEATABLE READ, então enxergam
+        o banco no mesmo instante, como se fosse uma única transação.
+        """
+        # Uma conexão fica presa segurando o snapshot; as demais do limite do host vão para os workers
+        workers = max(1, min(paralelismo, connection_pool.max_por_host - 1, len(self.queries_map)))
+
+        conn = self.db.get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+                cur.execute("SELECT pg_export_snapshot()")
+                snapshot_id = cur.fetchone()[0]
+        except Exception as e:
+            print(f"[EXTRACTOR] Não foi possível exportar snapshot ({e}). Seguindo em modo sequencial.")
+            conn.rollback()
+            return self._run_sequential(headers)
+
+        print(f"[EXTRACTOR] Modo paralelo: {workers} conexões sobre o snapshot {snapshot_id}")
+
+        def _worker(nome_query, sql):
+            if self._is_cancelled():
+                return False
+            print(f"[EXTRACTOR] Executando extração: {nome_query}...")
+            db = DatabaseConnection(self.config, snapshot_id=snapshot_id)
+            with self._bancos_lock:
+                self._bancos_ativos.add(db)
+            try:
+                return self._extract_collection(nome_query, sql, headers, db=db)
+            except Exception as q_err:
+                if self._is_cancelled():
+                    print(f"[EXTRACTOR] Query {nome_query} cancelada no servidor.")
+                else:
+                    print(f"[EXTRACTOR] Erro ao executar query {nome_query}: {q_err}")
+                return False
+            finally:
+                with self._bancos_lock:
+                    self._bancos_ativos.discard(db)
+                db.close()
+
+        sucesso_total = True
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                # Mais pesadas primeiro (custo do preflight): a última a terminar não começa por último
+                ordem = sorted(self.queries_map.items(), key=lambda item: -self.estimativas.get(item[0], {}).get("custo", 0))
+                futuros = [executor.submit(_worker, nome, sql) for nome, sql in ordem]
+                for futuro in as_completed(futuros):
+                    if not futuro.result():
+                        sucesso_total = False
+        finally:
+            # Encerra a transação exportadora: o snapshot deixa de existir no servidor
+            conn.rollback()
+
+        return sucesso_total
+
     def run_extraction(self):
         """
         Executa o fluxo de extração principal para este município.
@@ -89,83 +1400,35 @@ class MunicipalityExtractor:
         print(f"\\n[EXTRACTOR] >>> Iniciando sincronização do banco: {self.config.get('db_name')} ({self.config.get('db_host')})")
         
         try:
-            data_inicio, data_fim = self._get_date_range()
-            params = {
-                "data_inicio": data_inicio,
-                "data_fim": data_fim
-            }
-            
             headers = {
                 "X-Api-Key": self.api_token,
                 "X-Municipality-Id": self.municipality_id,
                 "Content-Type": "application/json"
             }
-            
-            sucesso_total = True
 
-            for nome_query, sql in self.queries_map.items():
-                print(f"[EXTRACTOR] Executando extração: {nome_query}...")
-                
-                try:
-                    if hasattr(self, 'cancel_event') and self.cancel_event and self.cancel_event.is_set():
-                        print("[EXTRACTOR] Execução interrompida, pulando restante...")
-                        sucesso_total = False
-                        break
-                        
-                    # Somente passa os parâmetros se a query os contiver
-                    query_params = params if "%(data_inicio)s" in sql else None
-                    df = self.db.execute_query_df(sql, params=query_params)
-                    
-                    if df is None or df.empty:
-                        print(f"[EXTRACTOR] -> {nome_query}: 0 registros encontrados.")
-                        continue
-                        
-                    # Converter tudo que é data/datetime/timestamp para string (ISO)
-                    for col in df.select_dtypes(include=['datetime64', 'datetimetz']).columns:
-                        df[col] = df[col].astype(str)
-                        
-                    # Opecional: lidar com NaN, NaT, None substituindo por string vazia ou None pythonic
-                    # Mas o Pandas fillna com string vazia resolve a maior parte para JSON
-                    df = df.fillna(value="")
-                    
-                    # Garantir que NaN floats que não foram pegos pelo fillna não quebrem o JSON
-                    df = df.replace({math.nan: None})
-
-                    payload_data = df.to_dict(orient='records')
-                    print(f"[EXTRACTOR] -> {nome_query}: {len(payload_data)} registros extraídos. Enviando para a nuvem...")
-                    
-                    # Envio em lotes (batch) para não estourar payload da API
-                    BATCH_SIZE = 500
-                    total_batches = math.ceil(len(payload_data) / BATCH_SIZE)
-                    for idx, chunk in enumerate(self._chunk_list(payload_data, BATCH_SIZE), 1):
-                        if hasattr(self, 'cancel_event') and self.cancel_event and self.cancel_event.is_set():
-                            print("[EXTRACTOR] Extração interrompida pelo usuário.")
-                            sucesso_total = False
-                            break
-                            
-                        print(f"[EXTRACTOR]    -> Enviando lote {idx}/{total_batches} ({len(chunk)} registros)...", flush=True)
-                        payload = {
-                            "collection": nome_query,
-                            "data": chunk,
-                            "municipio_id": self.municipality_id
-                        }
-                        
-                        try:
-                            payload_str = json.dumps(payload, default=str)
-                            response = requests.post(self.api_url, data=payload_str, headers=headers, timeout=60)
-                            if response.status_code not in [200, 201]:
-                                print(f"[EXTRACTOR] -> Erro na API ({response.status_code}): {response.text}")
-                                sucesso_total = False
-                        except Exception as req_e:
-                            print(f"[EXTRACTOR] -> Falha na requisição web: {req_e}")
-                            sucesso_total = False
-
-                except Exception as q_err:
-                    print(f"[EXTRACTOR] Erro ao executar query {nome_query}: {q_err}")
-                    sucesso_total = False
+            sucesso_total = None
+            if self.cdc:
+                # O ciclo CDC prepara as dimensões só quando há alterações a enviar
+                sucesso_total = self._run_cdc(headers)
+            else:
+                self._drop_cdc_slot()
+
+            if sucesso_total is None:
+                self._preparar_dimensoes(headers)
+                if self.preflight:
+                    try:
+                        self._run_preflight()
+                    except Exception as e:
+                        print(f"[PREFLIGHT] Indisponível ({e}). Seguindo com os parâmetros configurados.")
+                paralelismo = self._choose_concurrency()
+
+                if paralelismo > 1:
+                    sucesso_total = self._run_parallel(headers, paralelismo)
+                else:
+                    sucesso_total = self._run_sequential(headers)
             
             if sucesso_total:
-                # Atualiza a data da última execução com sucesso
+                # Atualiza a data da última execução com sucesso (exibição; o incremental usa as marcas por coleção)
                 agora = datetime.datetime.now().isoformat()
                 config_manager.set_municipality_last_run(self.config.get('id'), agora)
                 print(f"[EXTRACTOR] <<< Sincronização concluída com sucesso para {self.municipality_id}!")
@@ -179,3 +1442,5 @@ class MunicipalityExtractor:
             return False
         finally:
             self.db.close()
+            if self.carga:
+                self.carga.close()
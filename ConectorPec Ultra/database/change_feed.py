@@ -0,0 +1,228 @@
+import re
+import struct
+
+# Plugins de decodificação aceitos: test_decoding (contrib, saída em texto) e pgoutput (nativo
+# desde o PostgreSQL 10, binário; só publica as tabelas da publicação)
+PLUGINS = ("test_decoding", "pgoutput")
+
+# Linha do test_decoding: "table public.tb_x: INSERT: col[tipo]:valor col2[tipo]:'texto' col3[tipo[]]:'{a,b}'"
+_LINHA_TEST_DECODING = re.compile(r"^table ([^.]+)\.(\S+): (INSERT|UPDATE|DELETE): (.*)$", re.DOTALL)
+_COLUNA_TEST_DECODING = re.compile(r"(\w+)\[(?:[^\[\]]|\[\])+\]:('(?:[^']|'')*'|\S+)")
+
+_OPERACOES_PGOUTPUT = {b"I": "INSERT", b"U": "UPDATE", b"D": "DELETE"}
+
+
+def _colunas_test_decoding(texto):
+    # UPDATE com chave alterada traz "old-key: ... new-tuple: ..."; vale a tupla nova
+    if "new-tuple:" in texto:
+        texto = texto.split("new-tuple:", 1)[1]
+    colunas = {}
+    for nome, valor in _COLUNA_TEST_DECODING.findall(texto):
+        if valor == "null":
+            colunas[nome] = None
+        elif valor.startswith("'"):
+            colunas[nome] = valor[1:-1].replace("''", "'")
+        else:
+            colunas[nome] = valor
+    return colunas
+
+
+def decode_test_decoding(linha):
+    """(schema, tabela, operação, {coluna: texto}) de uma linha do test_decoding, ou None (BEGIN/COMMIT)."""
+    m = _LINHA_TEST_DECODING.match(linha)
+    if not m:
+        return None
+    schema, tabela, operacao, resto = m.groups()
+    return schema, tabela, operacao, _colunas_test_decoding(resto)
+
+
+class _Leitor:
+    def __init__(self, dados):
+        self.dados = dados
+        self.pos = 0
+
+    def ler(self, formato):
+        valores = struct.unpack_from(formato, self.dados, self.pos)
+        self.pos += struct.calcsize(formato)
+        return valores[0] if len(valores) == 1 else valores
+
+    def texto(self):
+        fim = self.dados.index(b"\x00", self.pos)
+        valor = self.dados[self.pos:fim].decode("utf-8")
+        self.pos = fim + 1
+        return valor
+
+    def tupla(self, nomes):
+        colunas = {}
+        for i in range(self.ler("!h")):
+            tipo = self.dados[self.pos:self.pos + 1]
+            self.pos += 1
+            if tipo == b"t":
+                tamanho = self.ler("!i")
+                colunas[nomes[i]] = self.dados[self.pos:self.pos + tamanho].decode("utf-8")
+                self.pos += tamanho
+            elif tipo == b"n":
+                colunas[nomes[i]] = None
+            # "u": valor TOAST inalterado, não vem na mensagem
+        return colunas
+
+
+def decode_pgoutput(dados, relacoes):
+    """
+    (schema, tabela, operação, {coluna: texto}) de uma mensagem do pgoutput (protocolo 1), ou None.
+    `relacoes` guarda as mensagens Relation já vistas (oid -> (schema, tabela, colunas)): o
+    pgoutput só descreve cada tabela uma vez por sessão de decodificação.
+    """
+    dados = bytes(dados)
+    leitor = _Leitor(dados)
+    tipo = dados[:1]
+    leitor.pos = 1
+    if tipo == b"R":
+        oid = leitor.ler("!I")
+        schema, tabela = leitor.texto(), leitor.texto()
+        leitor.ler("!b")  # replica identity
+        nomes = []
+        for _ in range(leitor.ler("!h")):
+            leitor.ler("!b")
+            nomes.append(leitor.texto())
+            leitor.ler("!Ii")
+        relacoes[oid] = (schema, tabela, nomes)
+        return None
+    if tipo not in _OPERACOES_PGOUTPUT:
+        return None
+
+    oid = leitor.ler("!I")
+    schema, tabela, nomes = relacoes[oid]
+    marcador = leitor.dados[leitor.pos:leitor.pos + 1]
+    leitor.pos += 1
+    colunas = leitor.tupla(nomes)
+    if tipo == b"U" and marcador in (b"K", b"O"):
+        # Tupla antiga (chave alterada / REPLICA IDENTITY FULL); em seguida vem a nova ("N")
+        leitor.pos += 1
+        colunas = leitor.tupla(nomes)
+    return schema, tabela, _OPERACOES_PGOUTPUT[tipo], colunas
+
+
+class LogicalChangeFeed:
+    """
+    Fila de alterações de um banco PEC via slot de replicação lógica, lida pela interface SQL
+    (pg_logical_slot_peek_*_changes): exige wal_level = logical e um usuário com REPLICATION.
+    As alterações só saem do slot em `advance`, chamado depois que tudo foi aceito pela API;
+    se a execução cair antes, a próxima lê o mesmo trecho de novo.
+
+    Enquanto o slot existir, o servidor guarda o WAL que ainda não foi consumido: um conector
+    parado por muito tempo faz o pg_wal crescer. `drop` remove o slot (e a publicação).
+    """
+    def __init__(self, db, slot, plugin="test_decoding", tabelas=()):
+        if plugin not in PLUGINS:
+            raise ValueError(f"Plugin de decodificação não suportado: {plugin}")
+        self.db = db
+        self.slot = slot
+        self.plugin = plugin
+        self.publicacao = slot
+        self.tabelas = set(tabelas)
+
+    def _executar(self, sql, params=None, buscar=True):
+        conn = self.db.get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql, params)
+                resultado = cur.fetchall() if buscar and cur.description else None
+            conn.commit()
+            return resultado
+        except Exception:
+            conn.rollback()
+            raise
+
+    def exists(self):
+        return bool(self._executar("SELECT 1 FROM pg_replication_slots WHERE slot_name = %s", (self.slot,)))
+
+    def ensure(self):
+        """
+        Cria o slot (e, no pgoutput, a publicação das tabelas) se ainda não existir. True se criou agora.
+        Com o slot já criado, tabelas acompanhadas que faltarem na publicação são incluídas nela.
+        """
+        existe = self.exists()
+        if not existe:
+            nivel = self._executar("SELECT current_setting('wal_level')")[0][0]
+            if nivel != "logical":
+                raise Exception(f"wal_level = {nivel} no servidor (é preciso 'logical' e reiniciar o PostgreSQL)")
+        if self.plugin == "pgoutput":
+            self._publicar()
+        if existe:
+            return False
+        self._executar("SELECT pg_create_logical_replication_slot(%s, %s)", (self.slot, self.plugin))
+        return True
+
+    def _publicar(self):
+        existentes = sorted(nome for (nome,) in self._executar(
+            "SELECT c.relname FROM pg_class c WHERE c.relname = ANY(%s) AND c.relkind = 'r' AND pg_table_is_visible(c.oid)",
+            (sorted(self.tabelas),)
+        ))
+        if not self._executar("SELECT 1 FROM pg_publication WHERE pubname = %s", (self.publicacao,)):
+            self._executar(f"CREATE PUBLICATION {self.publicacao} FOR TABLE {', '.join(existentes)}", buscar=False)
+            return
+        publicadas = {nome for (nome,) in self._executar(
+            "SELECT tablename FROM pg_publication_tables WHERE pubname = %s", (self.publicacao,)
+        )}
+        faltando = [nome for nome in existentes if nome not in publicadas]
+        if faltando:
+            self._executar(f"ALTER PUBLICATION {self.publicacao} ADD TABLE {', '.join(faltando)}", buscar=False)
+
+    def peek(self, limite):
+        """
+        Lê sem consumir até `limite` alterações (fecha sempre numa transação inteira).
+        Retorna (lsn para o advance ou None, [(tabela, operação, {coluna: texto})]) só com as
+        tabelas acompanhadas.
+        """
+        if self.plugin == "pgoutput":
+            linhas = self._executar(
+                "SELECT lsn::text, data FROM pg_logical_slot_peek_binary_changes(%s, NULL, %s, "
+                "'proto_version', '1', 'publication_names', %s)",
+                (self.slot, limite, self.publicacao)
+            )
+            relacoes = {}
+            decodificar = lambda dados: decode_pgoutput(dados, relacoes)
+        else:
+            linhas = self._executar(
+                "SELECT lsn::text, data FROM pg_logical_slot_peek_changes(%s, NULL, %s, "
+                "'include-xids', '0', 'skip-empty-xacts', '1')",
+                (self.slot, limite)
+            )
+            decodificar = decode_test_decoding
+
+        eventos = []
+        for _, dados in linhas:
+            evento = decodificar(dados)
+            if evento and evento[1] in self.tabelas:
+                eventos.append(evento[1:])
+        # A última linha é sempre um COMMIT; o lsn dele fecha o trecho lido
+        return (linhas[-1][0] if linhas else None), eventos
+
+    def advance(self, lsn):
+        """Descarta do slot tudo até `lsn` (inclusive)."""
+        versao = int(self._executar("SHOW server_version_num")[0][0])
+        if versao >= 110000:
+            self._executar("SELECT pg_replication_slot_advance(%s, %s)", (self.slot, lsn))
+        elif self.plugin == "pgoutput":
+            self._executar(
+                "SELECT count(*) FROM pg_logical_slot_get_binary_changes(%s, %s, NULL, "
+                "'proto_version', '1', 'publication_names', %s)",
+                (self.slot, lsn, self.publicacao)
+            )
+        else:
+            self._executar("SELECT count(*) FROM pg_logical_slot_get_changes(%s, %s, NULL)", (self.slot, lsn))
+
+    def lag_bytes(self):
+        """WAL retido pelo slot no servidor (bytes), ou None se o slot não existir."""
+        linhas = self._executar(
+            "SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), confirmed_flush_lsn) FROM pg_replication_slots WHERE slot_name = %s",
+            (self.slot,)
+        )
+        return int(linhas[0][0]) if linhas and linhas[0][0] is not None else None
+
+    def drop(self):
+        if self.exists():
+            self._executar("SELECT pg_drop_replication_slot(%s)", (self.slot,))
+        if self.plugin == "pgoutput":
+            self._executar(f"DROP PUBLICATION IF EXISTS {self.publicacao}", buscar=False)
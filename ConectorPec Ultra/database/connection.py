@@ -1,29 +1,110 @@
 import psycopg2
 import pandas as pd
+import io
+import queue
+import threading
 import time
+import uuid
+from database.pool import connection_pool
+
+# OIDs de tipos numéricos do PostgreSQL: no caminho COPY o pandas infere int/float para estas
+# colunas; todas as demais (textos, códigos com zeros à esquerda, datas) são lidas como string.
+_COPY_NUMERIC_OIDS = {20, 21, 23, 26, 700, 701, 1700}
+# Marcador de NULL no CSV do COPY. O NULL padrão do CSV (campo vazio sem aspas) não se distingue
+# de '' depois do parse; um caractere de controle (US, 0x1F) não aparece como valor inteiro de texto.
+_COPY_NULL = "\x1f"
+_COPY_END = object()
+
+
+class _CopyQueueWriter:
+    """
+    Arquivo falso entregue ao copy_expert: acumula os bytes recebidos e repassa blocos
+    para a fila consumida pela thread principal. A fila limitada aplica backpressure ao servidor.
+    """
+    def __init__(self, fila, stop_event, block_size=64 * 1024):
+        self.fila = fila
+        self.stop_event = stop_event
+        self.block_size = block_size
+        self._parts = []
+        self._size = 0
+
+    def write(self, data):
+        self._parts.append(data if isinstance(data, bytes) else data.encode())
+        self._size += len(data)
+        if self._size >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if not self._parts:
+            return
+        bloco = b"".join(self._parts)
+        self._parts = []
+        self._size = 0
+        while True:
+            if self.stop_event.is_set():
+                raise RuntimeError("COPY interrompido pelo consumidor")
+            try:
+                self.fila.put(bloco, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+
+class _CopyQueueReader(io.RawIOBase):
+    """
+    Lado consumidor da fila: expõe os blocos do COPY como um arquivo binário para o parser C do pandas.
+    """
+    def __init__(self, fila):
+        self.fila = fila
+        self._atual = b""
+        self._fim = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, destino):
+        while not self._atual and not self._fim:
+            bloco = self.fila.get()
+            if bloco is _COPY_END:
+                self._fim = True
+            else:
+                self._atual = bloco
+        if not self._atual:
+            return 0
+        n = min(len(destino), len(self._atual))
+        destino[:n] = self._atual[:n]
+        self._atual = self._atual[n:]
+        return n
+
 
 class DatabaseConnection:
-    def __init__(self, db_config):
+    def __init__(self, db_config, snapshot_id=None):
         """
         Recebe um dicionário com a configuração do banco de dados de um município.
         Ex: {'db_host': '...', 'db_port': '5432', 'db_name': 'esus', 'db_user': '...', 'db_password': '...'}
+        Se `snapshot_id` for informado (vindo de pg_export_snapshot), toda transação desta conexão
+        enxerga exatamente o mesmo ponto no tempo que a transação exportadora.
         """
         self.config = db_config
+        self.snapshot_id = snapshot_id
         self.connection = None
+        # Limites por query (segundos; 0 desliga): query descontrolada ou presa em lock é abortada no servidor
+        self.statement_timeout = int(db_config.get("extracao_statement_timeout", 1800))
+        self.lock_timeout = int(db_config.get("extracao_lock_timeout", 30))
 
     def get_connection(self, retries=3, delay=2):
         for attempt in range(retries):
             try:
                 if self.connection and not self.connection.closed:
                     return self.connection
-                    
-                self.connection = psycopg2.connect(
-                    host=self.config.get("db_host", "localhost"),
-                    port=self.config.get("db_port", "5432"),
-                    dbname=self.config.get("db_name", "esus"),
-                    user=self.config.get("db_user", "postgres"),
-                    password=self.config.get("db_password", "")
-                )
+
+                if self.connection is not None:
+                    # Conexão caiu no meio do uso: devolve ao pool para ser descartada
+                    connection_pool.release(self.config, self.connection, discard=True)
+                    self.connection = None
+
+                # Reaproveita conexões já autenticadas com o mesmo servidor PEC (handshake via VPN é caro)
+                self.connection = connection_pool.acquire(self.config)
                 return self.connection
             except Exception as e:
                 print(f"Erro ao conectar ao PostgreSQL {self.config.get('db_host')} (Tentativa {attempt+1}/{retries}): {e}")
@@ -32,21 +113,190 @@ class DatabaseConnection:
                 else:
                     raise Exception(f"Falha na conexão com o banco local do e-SUS PEC ({self.config.get('db_host')}) após várias tentativas.")
 
+    def _begin_transaction(self, conn):
+        """
+        Abre a transação da próxima query. Com snapshot compartilhado, ela precisa começar
+        em REPEATABLE READ e importar o snapshot antes de qualquer outro comando.
+        Os timeouts valem só para a transação (set_config local), então a conexão volta limpa ao pool.
+        """
+        with conn.cursor() as cur:
+            if self.snapshot_id:
+                cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+                cur.execute("SET TRANSACTION SNAPSHOT %s", (self.snapshot_id,))
+            cur.execute(
+                "SELECT set_config('statement_timeout', %s, true), set_config('lock_timeout', %s, true)",
+                (f"{self.statement_timeout}s", f"{self.lock_timeout}s")
+            )
+
+    def cancel(self):
+        """
+        Interrompe no servidor a query em andamento nesta conexão. Pode ser chamado de outra
+        thread: a query em execução falha com QueryCanceled em vez de rodar até o fim.
+        """
+        conn = self.connection
+        if conn is not None and not conn.closed:
+            try:
+                conn.cancel()
+            except Exception as e:
+                print(f"Erro ao cancelar query no host {self.config.get('db_host')}: {e}")
+
     def execute_query_df(self, query, params=None):
         """
         Executa uma query no banco de dados local e retorna um Pandas DataFrame.
         """
         conn = self.get_connection()
         try:
+            return self._read_sql(conn, query, params)
+        except Exception as e:
+            print(f"Erro ao executar query no host {self.config.get('db_host')}: {e}")
+            if not conn.closed:
+                raise
+            return self._read_sql(self.get_connection(), query, params)
+
+    def _read_sql(self, conn, query, params):
+        """
+        Roda a query numa transação própria e sempre a encerra: com sucesso faz commit (a conexão
+        não fica "idle in transaction" no pool, segurando o snapshot), com erro faz rollback, porque
+        quem trata o erro (sondas de estatística/sequência) segue usando a conexão.
+        """
+        try:
+            self._begin_transaction(conn)
             df = pd.read_sql_query(query, conn, params=params)
+            conn.commit()
             return df
+        finally:
+            if not conn.closed and conn.status != psycopg2.extensions.STATUS_READY:
+                conn.rollback()
+
+    def iter_query_df(self, query, params=None, chunk_size=500, itersize=2000):
+        """
+        Executa uma query com cursor nomeado (server-side) e devolve DataFrames de até `chunk_size` linhas.
+        O psycopg2 busca `itersize` linhas por ida ao servidor, então o pico de memória fica
+        limitado ao tamanho do lote, independente do tamanho total do resultado.
+        """
+        conn = self.get_connection()
+        cursor_name = f"probpa_stream_{uuid.uuid4().hex[:12]}"
+        try:
+            self._begin_transaction(conn)
+            with conn.cursor(name=cursor_name) as cur:
+                cur.itersize = itersize
+                cur.execute(query, params)
+
+                columns = None
+                buffer = []
+                for row in cur:
+                    buffer.append(row)
+                    if len(buffer) >= chunk_size:
+                        if columns is None:
+                            columns = [desc[0] for desc in cur.description]
+                        yield pd.DataFrame.from_records(buffer, columns=columns, coerce_float=True)
+                        buffer = []
+
+                if buffer:
+                    if columns is None:
+                        columns = [desc[0] for desc in cur.description]
+                    yield pd.DataFrame.from_records(buffer, columns=columns, coerce_float=True)
+
+            # Cursores nomeados vivem dentro de uma transação: encerra para liberar o snapshot no servidor
+            conn.commit()
         except Exception as e:
-            print(f"Erro ao executar query no host {self.config.get('db_host')}: {e}")
-            if conn.closed:
-                conn = self.get_connection()
-                return pd.read_sql_query(query, conn, params=params)
+            print(f"Erro ao executar query (streaming) no host {self.config.get('db_host')}: {e}")
+            if not conn.closed:
+                conn.rollback()
             raise
+        finally:
+            # Se o consumidor abandonar o gerador no meio (ex: cancelamento), não deixa a transação aberta
+            if not conn.closed and conn.status != psycopg2.extensions.STATUS_READY:
+                conn.rollback()
+
+    def iter_query_copy_df(self, query, params=None, chunk_size=500):
+        """
+        Executa a query via `COPY (...) TO STDOUT WITH CSV` e devolve DataFrames de até `chunk_size`
+        linhas. O fluxo é interpretado de forma incremental pelo parser C do pandas, sem passar
+        pelo protocolo de cursor nem pela conversão de tipos linha a linha do psycopg2.
+        """
+        conn = self.get_connection()
+        encoding = psycopg2.extensions.encodings.get(conn.encoding, "utf-8")
+        try:
+            self._begin_transaction(conn)
+            with conn.cursor() as cur:
+                sql = cur.mogrify(query, params).decode(encoding)
+                # LIMIT 0 só para descobrir nomes e tipos das colunas sem trafegar dados
+                cur.execute(f"SELECT * FROM (\n{sql}\n) AS q LIMIT 0")
+                columns = [desc[0] for desc in cur.description]
+                dtypes = {desc[0]: str for desc in cur.description if desc[1] not in _COPY_NUMERIC_OIDS}
+            conn.commit()
+        except Exception as e:
+            print(f"Erro ao preparar COPY no host {self.config.get('db_host')}: {e}")
+            if not conn.closed:
+                conn.rollback()
+            raise
+
+        fila = queue.Queue(maxsize=32)
+        stop_event = threading.Event()
+        erros = []
+
+        def _produtor():
+            writer = _CopyQueueWriter(fila, stop_event)
+            try:
+                self._begin_transaction(conn)
+                with conn.cursor() as cur:
+                    cur.copy_expert(f"COPY (\n{sql}\n) TO STDOUT WITH (FORMAT csv, NULL E'\\x1f')", writer)
+                writer.flush()
+                conn.commit()
+            except Exception as e:
+                erros.append(e)
+                if not conn.closed:
+                    conn.rollback()
+            finally:
+                while not stop_event.is_set():
+                    try:
+                        fila.put(_COPY_END, timeout=0.5)
+                        break
+                    except queue.Full:
+                        continue
+
+        thread = threading.Thread(target=_produtor, daemon=True)
+        thread.start()
+
+        try:
+            leitor = io.BufferedReader(_CopyQueueReader(fila), buffer_size=256 * 1024)
+            # Como no cursor: só NULL vira NaN ('' continua texto vazio; "NA", "null" etc. ficam como
+            # texto) e numeric/float chegam como o float mais próximo do valor (o parser rápido do
+            # pandas arredonda diferente do float(Decimal) que o cursor faz com coerce_float)
+            partes = pd.read_csv(
+                leitor, header=None, names=columns, dtype=dtypes, encoding=encoding,
+                keep_default_na=False, na_values=[_COPY_NULL], float_precision="round_trip",
+                chunksize=chunk_size,
+            )
+            try:
+                for df in partes:
+                    yield df
+            except Exception:
+                # Erro de parse causado por COPY interrompido: reporta o erro original do servidor
+                thread.join()
+                if erros:
+                    raise erros[0]
+                raise
+
+            thread.join()
+            if erros:
+                print(f"Erro ao executar COPY no host {self.config.get('db_host')}: {erros[0]}")
+                raise erros[0]
+        finally:
+            # Consumidor abandonou o gerador: interrompe o COPY no servidor e espera a thread sair
+            if thread.is_alive():
+                stop_event.set()
+                try:
+                    conn.cancel()
+                except Exception:
+                    pass
+                thread.join(timeout=5)
 
     def close(self):
-        if self.connection and not self.connection.closed:
-            self.connection.close()
+        """
+        Devolve a conexão ao pool compartilhado (ela permanece aberta para a próxima execução).
+        """
+        if self.connection is not None:
+            connection_pool.release(self.config, self.connection)
+            self.connection = None
@@ -0,0 +1,292 @@
+import re
+import threading
+import pandas as pd
+from database.pool import connection_pool
+
+# Dimensões pequenas repetidas em quase toda query de fato. Em vez de juntá-las no servidor
+# (e trafegar o mesmo nome de profissional/unidade a cada linha), a query passa a trazer só a
+# chave inteira e a junção é feita aqui, em cima de uma cópia local da dimensão.
+DIMENSOES_CACHE = (
+    "tb_dim_profissional",
+    "tb_dim_cbo",
+    "tb_dim_unidade_saude",
+    "tb_dim_equipe",
+    "tb_dim_procedimento",
+    "tb_dim_sexo",
+    "tb_dim_tempo",
+)
+
+# Dimensões enviadas à API como documentos de referência versionados no modo de sincronização
+# de dimensões (os registros de fato levam só a chave): tabela -> (documento, coluna da chave)
+DIMENSOES_SINCRONIZADAS = {
+    "tb_dim_profissional": ("profissionais", "ref_profissional"),
+    "tb_dim_unidade_saude": ("unidades", "ref_unidade"),
+    "tb_dim_cbo": ("cbos", "ref_cbo"),
+    "tb_dim_procedimento": ("procedimentos", "ref_procedimento"),
+    "tb_dim_equipe": ("equipes", "ref_equipe"),
+}
+
+# Linha de junção no formato usado pelas queries: [LEFT] JOIN tb_dim_x alias ON fato.co_dim_x = alias.co_seq_dim_x
+_JOIN_RE = re.compile(
+    r"^[ \t]*(LEFT[ \t]+)?JOIN[ \t]+(tb_dim_\w+)[ \t]+(\w+)[ \t]+ON[ \t]+(\w+\.\w+)[ \t]*=[ \t]*(\w+)\.(\w+)[ \t]*$",
+    re.IGNORECASE | re.MULTILINE
+)
+_ITEM_RE = r"^\s*{alias}\.(\w+)(?:\s+AS\s+(\w+))?\s*$"
+
+
+def _fim_da_lista_select(sql, inicio):
+    """Posição do FROM que encerra a lista do SELECT principal (ignora subqueries e strings)."""
+    nivel = 0
+    em_string = False
+    for i in range(inicio, len(sql)):
+        c = sql[i]
+        if c == "'":
+            em_string = not em_string
+        elif em_string:
+            continue
+        elif c == "(":
+            nivel += 1
+        elif c == ")":
+            nivel -= 1
+        elif nivel == 0 and re.match(r"FROM\b", sql[i:i + 5], re.IGNORECASE) and not re.match(r"\w", sql[i - 1]):
+            return i
+    return -1
+
+
+def _dividir_itens(lista):
+    """Divide a lista do SELECT nas vírgulas de nível zero."""
+    itens = []
+    nivel = 0
+    em_string = False
+    atual = []
+    for c in lista:
+        if c == "'":
+            em_string = not em_string
+        elif not em_string:
+            if c == "(":
+                nivel += 1
+            elif c == ")":
+                nivel -= 1
+            elif c == "," and nivel == 0:
+                itens.append("".join(atual))
+                atual = []
+                continue
+        atual.append(c)
+    itens.append("".join(atual))
+    return itens
+
+
+class DimensionCache:
+    """
+    Cópia local das dimensões pequenas do PEC, por banco de município (host/porta/banco/usuário).
+    Cada tabela só é relida quando a contagem de linhas ou a maior chave mudam no servidor.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bancos = {}  # chave do banco -> {tabela: {"assinatura", "chave", "colunas", "dados"}}
+
+    def compile_query(self, sql):
+        """
+        Reescreve a query para trazer só a chave das dimensões em DIMENSOES_CACHE.
+        Uma junção só sai do SQL se o alias da dimensão aparecer apenas como item simples do
+        SELECT principal (alias.coluna [AS nome]); qualquer outro uso (WHERE, COALESCE, outra
+        junção) mantém a junção no servidor. Cada item reescrito continua na mesma posição,
+        agora com a chave estrangeira. Retorna {"sql", "juncoes"}; sem junções elegíveis,
+        devolve o SQL original.
+        """
+        texto = re.sub(r"--[^\n]*", "", sql)
+        inicio = re.search(r"\bSELECT\b", texto, re.IGNORECASE)
+        fim = _fim_da_lista_select(texto, inicio.end()) if inicio else -1
+        if fim < 0:
+            return {"sql": sql, "juncoes": []}
+
+        itens = _dividir_itens(texto[inicio.end():fim])
+        resto = texto[fim:]
+        juncoes = []
+
+        for m in _JOIN_RE.finditer(resto):
+            esquerda, tabela, alias, chave_fato, alias_on, chave_dim = m.groups()
+            if tabela.lower() not in DIMENSOES_CACHE or alias_on != alias:
+                continue
+
+            linha = m.group(0)
+            fora_da_juncao = texto.replace(linha, "", 1)
+            referencias = len(re.findall(rf"\b{alias}\.\w+", fora_da_juncao))
+            colunas = []
+            for indice, item in enumerate(itens):
+                simples = re.match(_ITEM_RE.format(alias=alias), item, re.IGNORECASE)
+                if simples:
+                    colunas.append((indice, simples.group(1), simples.group(2) or simples.group(1)))
+            if not colunas or len(colunas) != referencias:
+                continue
+
+            for indice, _, nome in colunas:
+                itens[indice] = f"\n    {chave_fato} AS {nome}"
+            resto = re.sub(re.escape(linha) + r"\n?", "", resto, count=1)
+            juncoes.append({
+                "tabela": tabela.lower(),
+                "chave": chave_dim,
+                "interna": not esquerda,
+                "colunas": colunas,
+            })
+
+        if not juncoes:
+            return {"sql": sql, "juncoes": []}
+        sql_reduzido = texto[:inicio.end()] + ",".join(itens).rstrip() + "\n" + resto
+        return {"sql": sql_reduzido, "juncoes": juncoes}
+
+    @staticmethod
+    def _necessarias(planos):
+        """{tabela: {"chave", "colunas"}} das dimensões que os planos juntam no cliente."""
+        necessarias = {}
+        for plano in planos:
+            for juncao in plano["juncoes"]:
+                tabela = necessarias.setdefault(juncao["tabela"], {"chave": juncao["chave"], "colunas": set()})
+                tabela["colunas"].update(coluna for _, coluna, _ in juncao["colunas"])
+        return necessarias
+
+    def refresh(self, db, planos):
+        """
+        Garante em memória as dimensões usadas pelos planos. Uma única query traz contagem e
+        maior chave de todas; só as tabelas com assinatura diferente (ou com colunas novas
+        pedidas) são relidas.
+        """
+        necessarias = self._necessarias(planos)
+        if not necessarias:
+            return
+
+        banco = connection_pool.make_key(db.config)
+        conn = db.get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(" UNION ALL ".join(
+                    f"SELECT '{tabela}', count(*), max({info['chave']})::bigint FROM {tabela}"
+                    for tabela, info in necessarias.items()
+                ))
+                assinaturas = {linha[0]: (linha[1], linha[2]) for linha in cur.fetchall()}
+
+                with self._lock:
+                    cache = self._bancos.setdefault(banco, {})
+                    for tabela, info in necessarias.items():
+                        atual = cache.get(tabela)
+                        colunas = sorted(info["colunas"] | set(atual["colunas"] if atual else ()))
+                        if atual and atual["assinatura"] == assinaturas[tabela] and set(info["colunas"]) <= set(atual["colunas"]):
+                            continue
+                        cur.execute(f"SELECT {info['chave']}, {', '.join(colunas)} FROM {tabela}")
+                        linhas = cur.fetchall()
+                        # dtype=object preserva os tipos do psycopg2, como chegariam pela junção no servidor
+                        dados = pd.DataFrame(linhas, columns=[info["chave"]] + colunas, dtype=object)
+                        dados.index = pd.Index([linha[0] for linha in linhas])
+                        cache[tabela] = {
+                            "assinatura": assinaturas[tabela],
+                            "chave": info["chave"],
+                            "colunas": colunas,
+                            "dados": dados,
+                        }
+                        print(f"[DIMENSOES] {tabela}: {len(linhas)} linhas carregadas.")
+        finally:
+            conn.rollback()
+
+    def carregadas(self, db_config, planos):
+        """True se o cache do banco já tem todas as dimensões (e colunas) que os planos juntam."""
+        necessarias = self._necessarias(planos)
+        with self._lock:
+            cache = self._bancos.get(connection_pool.make_key(db_config), {})
+            return all(
+                tabela in cache and info["colunas"] <= set(cache[tabela]["colunas"])
+                for tabela, info in necessarias.items()
+            )
+
+    def versoes(self, db, planos):
+        """
+        {tabela: {"chave", "colunas", "versao"}} das DIMENSOES_SINCRONIZADAS usadas pelos
+        planos. A versão é um md5 das colunas que os fatos usam da tabela, calculado no
+        servidor numa única query: qualquer edição (não só inserções) gera versão nova.
+        """
+        necessarias = {t: info for t, info in self._necessarias(planos).items() if t in DIMENSOES_SINCRONIZADAS}
+        if not necessarias:
+            return {}
+        for info in necessarias.values():
+            info["colunas"] = sorted(info["colunas"])
+        conn = db.get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(" UNION ALL ".join(
+                    f"SELECT '{tabela}', md5(string_agg(ROW({info['chave']}, {', '.join(info['colunas'])})::text, ',' ORDER BY {info['chave']})) FROM {tabela}"
+                    for tabela, info in necessarias.items()
+                ))
+                for tabela, versao in cur.fetchall():
+                    necessarias[tabela]["versao"] = versao or ""
+        finally:
+            conn.rollback()
+        return necessarias
+
+    def documento(self, db, tabela, info):
+        """Documento de referência de uma dimensão sincronizada: linhas (chave primeiro) e versão."""
+        conn = db.get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"SELECT {info['chave']}, {', '.join(info['colunas'])} FROM {tabela} ORDER BY {info['chave']}")
+                linhas = [list(linha) for linha in cur.fetchall()]
+        finally:
+            conn.rollback()
+        return {
+            "dimensao": DIMENSOES_SINCRONIZADAS[tabela][0],
+            "tabela": tabela,
+            "versao": info["versao"],
+            "colunas": [info["chave"]] + info["colunas"],
+            "linhas": linhas,
+        }
+
+    @staticmethod
+    def referencias(plano, sincronizadas):
+        """
+        O que as chaves das junções com tabelas em `sincronizadas` representam, enviado junto
+        com os registros: {ref_*: {"tabela", "colunas": {coluna do registro: coluna da dimensão}}}.
+        A API procura a chave no documento de referência da tabela e devolve as colunas ao registro.
+        """
+        return {
+            DIMENSOES_SINCRONIZADAS[juncao["tabela"]][1]: {
+                "tabela": juncao["tabela"],
+                "colunas": {nome: coluna for _, coluna, nome in juncao["colunas"]},
+            }
+            for juncao in plano["juncoes"] if juncao["tabela"] in sincronizadas
+        }
+
+    def apply(self, db_config, df, plano, sincronizadas=()):
+        """
+        Troca as chaves estrangeiras do DataFrame pelos valores da dimensão, coluna a coluna.
+        Junções internas descartam as linhas sem correspondência, como o JOIN fazia no servidor.
+        As junções com tabelas em `sincronizadas` (modo de sincronização de dimensões) só
+        filtram: suas colunas viram uma só, com a chave (ref_profissional, ref_unidade...).
+        """
+        if df.empty or not plano["juncoes"]:
+            return df
+        with self._lock:
+            cache = self._bancos.get(connection_pool.make_key(db_config), {})
+
+        df = df.copy()
+        nomes = list(df.columns)
+        descartadas = set()
+        for juncao in plano["juncoes"]:
+            dados = cache[juncao["tabela"]]["dados"]
+            chaves = df.iloc[:, juncao["colunas"][0][0]]
+            if juncao["interna"]:
+                df = df[chaves.isin(dados.index)]
+                chaves = df.iloc[:, juncao["colunas"][0][0]]
+            if juncao["tabela"] in sincronizadas:
+                # Chave inteira (a coluna pode ter vindo como float por causa dos nulos)
+                df.isetitem(juncao["colunas"][0][0], chaves.map(lambda v: None if pd.isna(v) else int(v)).astype(object))
+                nomes[juncao["colunas"][0][0]] = DIMENSOES_SINCRONIZADAS[juncao["tabela"]][1]
+                descartadas.update(indice for indice, _, _ in juncao["colunas"][1:])
+                continue
+            for indice, coluna, _ in juncao["colunas"]:
+                df.isetitem(indice, chaves.map(dados[coluna]).astype(object))
+        if nomes != list(df.columns):
+            df.columns = nomes
+            df = df.iloc[:, [i for i in range(len(nomes)) if i not in descartadas]]
+        return df
+
+
+# Singleton instance
+dimension_cache = DimensionCache()
@@ -0,0 +1,114 @@
+import threading
+import time
+import psycopg2
+
+# Nome com que o conector se identifica no PEC (pg_stat_activity.application_name): as conexões
+# com este prefixo não contam como carga dos usuários
+APPLICATION_NAME = "ProBPA Ultra"
+
+LIVRE, OCUPADO, SATURADO = 0, 1, 2
+NOMES_NIVEIS = {LIVRE: "livre", OCUPADO: "ocupado", SATURADO: "saturado"}
+
+# Sessões dos usuários do PEC (as do próprio conector ficam de fora) que estão executando algo
+# agora e que estão paradas esperando um lock
+SQL_CARGA = """
+    SELECT
+        count(*) FILTER (WHERE state = 'active'),
+        count(*) FILTER (WHERE wait_event_type = 'Lock')
+    FROM pg_stat_activity
+    WHERE datname = current_database()
+      AND pid <> pg_backend_pid()
+      AND backend_type = 'client backend'
+      AND application_name NOT LIKE %s
+"""
+
+
+class SourceLoadMonitor:
+    """
+    Mede a carga do banco PEC do município pelo pg_stat_activity, numa conexão própria em
+    autocommit (fora do pool, para não ocupar a vaga de uma conexão de extração).
+
+    - OCUPADO: `ativas` sessões ativas ou alguma sessão esperando lock;
+    - SATURADO: o dobro de `ativas` ou `locks` sessões esperando lock.
+
+    As amostras valem `intervalo` segundos, então pode ser consultado a cada lote. Se o
+    pg_stat_activity não puder ser lido, o monitor se desliga e passa a responder LIVRE.
+    """
+    def __init__(self, db_config, ativas=6, locks=3, intervalo=5, pausa_max=600):
+        self.config = db_config
+        self.ativas = ativas
+        self.locks = locks
+        self.intervalo = intervalo
+        self.pausa_max = pausa_max
+        self.conn = None
+        self.desligado = False
+        self.ultimo = (LIVRE, 0, 0)
+        self._amostrado_em = None
+        self._lock = threading.Lock()
+
+    def _amostrar(self):
+        if self.conn is None or self.conn.closed:
+            self.conn = psycopg2.connect(
+                host=self.config.get("db_host", "localhost"),
+                port=str(self.config.get("db_port", "5432")),
+                dbname=self.config.get("db_name", "esus"),
+                user=self.config.get("db_user", "postgres"),
+                password=self.config.get("db_password", ""),
+                connect_timeout=10,
+                application_name=f"{APPLICATION_NAME} (carga)"
+            )
+            self.conn.autocommit = True
+        with self.conn.cursor() as cur:
+            cur.execute(SQL_CARGA, (APPLICATION_NAME + "%",))
+            ativas, em_lock = cur.fetchone()
+        if ativas >= 2 * self.ativas or em_lock >= self.locks:
+            nivel = SATURADO
+        elif ativas >= self.ativas or em_lock:
+            nivel = OCUPADO
+        else:
+            nivel = LIVRE
+        return nivel, ativas, em_lock
+
+    def nivel(self):
+        """Nível de carga atual (LIVRE, OCUPADO ou SATURADO), da última amostra válida."""
+        with self._lock:
+            if self.desligado:
+                return LIVRE
+            agora = time.monotonic()
+            if self._amostrado_em is not None and agora - self._amostrado_em < self.intervalo:
+                return self.ultimo[0]
+            try:
+                atual = self._amostrar()
+            except Exception as e:
+                print(f"[CARGA] Não foi possível ler o pg_stat_activity ({e}): extração sem controle de carga.")
+                self.desligado = True
+                self.close()
+                return LIVRE
+            self._amostrado_em = agora
+            anterior, self.ultimo = self.ultimo[0], atual
+        if atual[0] != anterior:
+            print(f"[CARGA] PEC {NOMES_NIVEIS[atual[0]]}: {atual[1]} sessões ativas, {atual[2]} esperando lock.")
+        return atual[0]
+
+    def aguardar(self, cancelado=lambda: False):
+        """
+        Pausa enquanto o PEC estiver SATURADO (até `pausa_max` segundos seguidos; depois
+        segue no ritmo de OCUPADO para a execução terminar). Devolve o nível com que seguir.
+        """
+        inicio = time.monotonic()
+        nivel = self.nivel()
+        while nivel == SATURADO and not cancelado():
+            if time.monotonic() - inicio >= self.pausa_max:
+                print(f"[CARGA] PEC saturado há {self.pausa_max}s: seguindo em ritmo reduzido.")
+                return OCUPADO
+            time.sleep(min(self.intervalo, 1))
+            nivel = self.nivel()
+        return nivel
+
+    def close(self):
+        if self.conn is not None and not self.conn.closed:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+        self.conn = None
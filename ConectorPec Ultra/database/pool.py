@@ -0,0 +1,185 @@
+import hashlib
+import threading
+import time
+import psycopg2
+from database.load_monitor import APPLICATION_NAME
+
+# Máximo de conexões simultâneas abertas contra um mesmo servidor PEC (host:porta)
+MAX_CONEXOES_POR_HOST = 4
+# Conexões ociosas por mais tempo que isso são fechadas na próxima passagem pelo pool
+MAX_OCIOSO_SEGUNDOS = 20 * 60
+
+
+class ConnectionPool:
+    """
+    Pool de conexões PostgreSQL compartilhado pelo processo inteiro.
+    As conexões ociosas são agrupadas por host/porta/banco/usuário/senha e o limite de conexões
+    é aplicado por host, já que vários municípios podem morar no mesmo servidor PEC.
+    """
+    def __init__(self, max_por_host=MAX_CONEXOES_POR_HOST, max_ocioso_segundos=MAX_OCIOSO_SEGUNDOS):
+        self.max_por_host = max_por_host
+        self.max_ocioso_segundos = max_ocioso_segundos
+        self._cond = threading.Condition()
+        self._ociosas = {}   # chave -> [(conexão, instante em que voltou ao pool)]
+        self._abertas = {}   # (host, porta) -> total de conexões abertas (em uso + ociosas)
+        self._em_uso = {}    # conexão -> geração do pool em que foi entregue
+        # close_all avança a geração: conexões entregues antes dele são fechadas quando voltam
+        self._geracao = 0
+
+    @staticmethod
+    def make_key(db_config):
+        # A senha entra como hash: trocada na configuração, a conexão ociosa aberta com a
+        # antiga não é reaproveitada (e o hash não expõe a senha em logs ou no cache)
+        senha = str(db_config.get("db_password", ""))
+        return (
+            str(db_config.get("db_host", "localhost")),
+            str(db_config.get("db_port", "5432")),
+            str(db_config.get("db_name", "esus")),
+            str(db_config.get("db_user", "postgres")),
+            hashlib.sha256(senha.encode("utf-8")).hexdigest(),
+        )
+
+    def acquire(self, db_config, timeout=120):
+        """
+        Devolve uma conexão validada para a configuração informada, reaproveitando uma ociosa
+        quando possível. Bloqueia (até `timeout`) se o host já estiver no limite de conexões.
+        """
+        chave = self.make_key(db_config)
+        host = chave[:2]
+        limite = time.monotonic() + timeout
+
+        while True:
+            conn = None
+            criar = False
+            with self._cond:
+                self._descartar_expiradas()
+                ociosas = self._ociosas.get(chave)
+                if ociosas:
+                    conn, _ = ociosas.pop()
+                elif self._abertas.get(host, 0) < self.max_por_host:
+                    self._abertas[host] = self._abertas.get(host, 0) + 1
+                    criar = True
+                elif self._liberar_ociosa_de_outro_banco(host):
+                    continue
+                else:
+                    restante = limite - time.monotonic()
+                    if restante <= 0:
+                        raise Exception(f"Tempo esgotado aguardando conexão livre para {host[0]}:{host[1]}")
+                    self._cond.wait(restante)
+                    continue
+
+            if criar:
+                try:
+                    conn = psycopg2.connect(
+                        host=chave[0],
+                        port=chave[1],
+                        dbname=chave[2],
+                        user=chave[3],
+                        password=db_config.get("db_password", ""),
+                        connect_timeout=10,
+                        application_name=APPLICATION_NAME
+                    )
+                except Exception:
+                    self._decrementar(host)
+                    raise
+                return self._entregar(conn)
+
+            if self._validar(conn):
+                return self._entregar(conn)
+            # Conexão morta (VPN caiu, servidor reiniciou): descarta e tenta de novo
+            self._fechar(conn)
+            self._decrementar(host)
+
+    def release(self, db_config, conn, discard=False):
+        """
+        Devolve a conexão ao pool. Transações abertas são desfeitas; conexões fechadas,
+        marcadas com `discard` ou entregues antes de um close_all são descartadas.
+        """
+        if conn is None:
+            return
+        chave = self.make_key(db_config)
+        with self._cond:
+            if self._em_uso.pop(conn, self._geracao) != self._geracao:
+                discard = True
+        if not discard and not conn.closed:
+            try:
+                if conn.status != psycopg2.extensions.STATUS_READY:
+                    conn.rollback()
+            except Exception:
+                discard = True
+        if discard or conn.closed:
+            self._fechar(conn)
+            self._decrementar(chave[:2])
+            return
+        with self._cond:
+            self._ociosas.setdefault(chave, []).append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def close_all(self):
+        """
+        Fecha as conexões ociosas. As que estão em uso são fechadas quando voltarem (release).
+        """
+        with self._cond:
+            self._geracao += 1
+            for chave, ociosas in self._ociosas.items():
+                for conn, _ in ociosas:
+                    self._fechar(conn)
+                    self._abertas[chave[:2]] = self._abertas.get(chave[:2], 1) - 1
+            self._ociosas.clear()
+            self._cond.notify_all()
+
+    def _entregar(self, conn):
+        with self._cond:
+            self._em_uso[conn] = self._geracao
+        return conn
+
+    def _validar(self, conn):
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _descartar_expiradas(self):
+        # Chamado com o lock adquirido
+        agora = time.monotonic()
+        for chave, ociosas in self._ociosas.items():
+            vivas = []
+            for conn, desde in ociosas:
+                if agora - desde > self.max_ocioso_segundos or conn.closed:
+                    self._fechar(conn)
+                    self._abertas[chave[:2]] = self._abertas.get(chave[:2], 1) - 1
+                else:
+                    vivas.append((conn, desde))
+            ociosas[:] = vivas
+
+    def _liberar_ociosa_de_outro_banco(self, host):
+        # Chamado com o lock adquirido: host no limite, mas com conexão ociosa de outro município
+        for chave, ociosas in self._ociosas.items():
+            if chave[:2] == host and ociosas:
+                conn, _ = ociosas.pop(0)
+                self._fechar(conn)
+                self._abertas[host] = self._abertas.get(host, 1) - 1
+                return True
+        return False
+
+    def _decrementar(self, host):
+        with self._cond:
+            self._abertas[host] = max(0, self._abertas.get(host, 1) - 1)
+            self._cond.notify()
+
+    @staticmethod
+    def _fechar(conn):
+        try:
+            if not conn.closed:
+                conn.close()
+        except Exception:
+            pass
+
+
+# Singleton instance
+connection_pool = ConnectionPool()
@@ -37,3 +37,49 @@ LEFT JOIN tb_dim_local_atendimento dim_local ON fat.co_dim_local_atendimento = d
 WHERE fat.co_dim_tempo >= %(data_inicio)s 
   AND fat.co_dim_tempo <= %(data_fim)s
 """
+
+# Mesma saída da QUERY_ATENDIMENTO_INDIVIDUAL, com as duas subqueries correlacionadas trocadas
+# por um único agregado LATERAL por atendimento: os problemas de cada linha são lidos uma vez, e
+# os nomes de CIAP/CID vêm pela chave (sem junção dentro do agregado, que por linha vira hash join
+# com leitura da dimensão inteira). O agregado depende só da linha, então uma página keyset
+# (ORDER BY chave LIMIT n) ou um filtro por chaves só agrega os atendimentos que devolve, em vez
+# de todos os do período. A ordem dos nomes dentro de cada string_agg não é garantida em nenhuma
+# das duas formas.
+# Equivalência e tempos: tools/equivalencia_atendimento_individual.py
+QUERY_ATENDIMENTO_INDIVIDUAL_AGREGADA = """
+SELECT 
+    fat.co_seq_fat_atd_ind AS id_atendimento,
+    fat.co_fat_cidadao_pec AS id_paciente,
+    fat.co_dim_tempo AS data_atendimento,
+    cbo.nu_cbo AS cbo,
+    prof.no_profissional AS nome_profissional,
+    eq.nu_ine AS ine,
+    us.nu_cnes AS cnes,
+    fat.st_conduta_consulta_agendada AS conduta_agendada,
+    dim_tipo_atd.ds_tipo_atendimento AS tipo_atendimento,
+    dim_local.ds_local_atendimento AS local_atendimento,
+    fat.nu_peso,
+    fat.nu_altura,
+    fat.nu_pressao_sistolica,
+    fat.nu_pressao_diastolica,
+    fat.ds_filtro_ciaps AS ciaps_avaliados_codigos,
+    prob.ciaps_avaliados,
+    fat.ds_filtro_cids AS cids_avaliados_codigos,
+    prob.cids_avaliados
+FROM tb_fat_atendimento_individual fat
+JOIN tb_dim_cbo cbo ON fat.co_dim_cbo_1 = cbo.co_seq_dim_cbo
+JOIN tb_dim_profissional prof ON fat.co_dim_profissional_1 = prof.co_seq_dim_profissional
+JOIN tb_dim_equipe eq ON fat.co_dim_equipe_1 = eq.co_seq_dim_equipe
+JOIN tb_dim_unidade_saude us ON fat.co_dim_unidade_saude_1 = us.co_seq_dim_unidade_saude
+LEFT JOIN tb_dim_tipo_atendimento dim_tipo_atd ON fat.co_dim_tipo_atendimento = dim_tipo_atd.co_seq_dim_tipo_atendimento
+LEFT JOIN tb_dim_local_atendimento dim_local ON fat.co_dim_local_atendimento = dim_local.co_seq_dim_local_atendimento
+LEFT JOIN LATERAL (
+    SELECT
+        string_agg((SELECT ciap.no_ciap FROM tb_dim_ciap ciap WHERE ciap.co_seq_dim_ciap = p.co_dim_ciap), ', ') AS ciaps_avaliados,
+        string_agg((SELECT cid.no_cid FROM tb_dim_cid cid WHERE cid.co_seq_dim_cid = p.co_dim_cid), ', ') AS cids_avaliados
+    FROM tb_fat_atd_ind_problemas p
+    WHERE p.co_fat_atd_ind = fat.co_seq_fat_atd_ind
+) prob ON TRUE
+WHERE fat.co_dim_tempo >= %(data_inicio)s 
+  AND fat.co_dim_tempo <= %(data_fim)s
+"""
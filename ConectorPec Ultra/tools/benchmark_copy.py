@@ -0,0 +1,84 @@
+"""
+Benchmark: caminho atual (execute_query_df / pandas) x COPY TO STDOUT (iter_query_copy_df).
+
+Uso (a partir da pasta "ConectorPec Ultra"):
+    python tools/benchmark_copy.py --host 10.0.0.5 --db esus --user postgres --password *** \
+        --inicio 20240101 --fim 20240430 [--repeticoes 3] [--queries atendimento_individual,vacinas_aplicadas]
+
+Mede tempo de parede, CPU do processo e linhas por query. Rode contra o banco real do município
+(via VPN) para ver o ganho de protocolo; contra localhost o ganho mostrado é só de CPU.
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database.connection import DatabaseConnection
+from core.extractor import MunicipalityExtractor, BATCH_SIZE
+
+
+def _medir(func):
+    inicio_parede = time.perf_counter()
+    inicio_cpu = time.process_time()
+    linhas = func()
+    return linhas, time.perf_counter() - inicio_parede, time.process_time() - inicio_cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compara execute_query_df com o backend COPY TO STDOUT.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", default="5432")
+    parser.add_argument("--db", default="esus")
+    parser.add_argument("--user", default="postgres")
+    parser.add_argument("--password", default="")
+    parser.add_argument("--inicio", type=int, required=True, help="data_inicio no formato AAAAMMDD")
+    parser.add_argument("--fim", type=int, required=True, help="data_fim no formato AAAAMMDD")
+    parser.add_argument("--repeticoes", type=int, default=3)
+    parser.add_argument("--queries", default="", help="lista separada por vírgula (padrão: todas)")
+    args = parser.parse_args()
+
+    db_config = {
+        "db_host": args.host, "db_port": args.port, "db_name": args.db,
+        "db_user": args.user, "db_password": args.password,
+    }
+    queries_map = MunicipalityExtractor(db_config).queries_map
+    if args.queries:
+        selecionadas = [q.strip() for q in args.queries.split(",")]
+        queries_map = {k: v for k, v in queries_map.items() if k in selecionadas}
+
+    params = {"data_inicio": args.inicio, "data_fim": args.fim}
+    db = DatabaseConnection(db_config)
+
+    print(f"{'query':<26} {'backend':<8} {'linhas':>9} {'parede(s)':>10} {'cpu(s)':>8}")
+    totais = {"pandas": [0.0, 0.0], "copy": [0.0, 0.0]}
+    try:
+        for nome, sql in queries_map.items():
+            query_params = params if "%(data_inicio)s" in sql else None
+            backends = {
+                "pandas": lambda: len(db.execute_query_df(sql, params=query_params)),
+                "copy": lambda: sum(len(df) for df in db.iter_query_copy_df(sql, params=query_params, chunk_size=BATCH_SIZE)),
+            }
+            for backend, func in backends.items():
+                melhores = None
+                for _ in range(args.repeticoes):
+                    resultado = _medir(func)
+                    if melhores is None or resultado[1] < melhores[1]:
+                        melhores = resultado
+                linhas, parede, cpu = melhores
+                totais[backend][0] += parede
+                totais[backend][1] += cpu
+                print(f"{nome:<26} {backend:<8} {linhas:>9} {parede:>10.3f} {cpu:>8.3f}")
+    finally:
+        db.close()
+
+    print("-" * 64)
+    for backend, (parede, cpu) in totais.items():
+        print(f"{'TOTAL':<26} {backend:<8} {'':>9} {parede:>10.3f} {cpu:>8.3f}")
+    if totais["copy"][1] > 0:
+        print(f"\nRedução de CPU no cliente: {totais['pandas'][1] / totais['copy'][1]:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Benchmark: bytes enviados e tempo de codificação dos lotes, formato de linhas
+({"collection", "data": [...], "municipio_id"}) x formato colunar (extracao_payload_colunar,
+core.columnar_payload). Os dois lados partem do DataFrame do lote (core.batch_encoder) até o
+corpo do POST; a coluna gzip mostra quanto os corpos teriam se o transporte os comprimisse
+(só como referência, o extrator não comprime).
+
+Uso (a partir da pasta "ConectorPec Ultra"):
+    python tools/benchmark_payload_colunar.py [--linhas 200000]
+
+Usa os mesmos lotes de tools/benchmark_serializacao.py. Antes de medir, confere que o
+decode_payload devolve o corpo do formato de linhas, para o lote inteiro e para lotes com
+linhas tiradas do meio (filtro de inalteradas).
+"""
+import os
+import sys
+import gc
+import gzip
+import json
+import time
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark_serializacao import _lote, LOTES_DISTINTOS
+from core.batch_encoder import encode_records, batch_body, columnar_batch_body
+from core.columnar_payload import decode_payload
+from core.extractor import BATCH_SIZE
+
+COLECAO = "procedimentos_faturados"
+MUNICIPIO = "2400000"
+
+
+def _linhas(df):
+    return batch_body(COLECAO, encode_records(df), MUNICIPIO)
+
+
+def _colunar(df):
+    return columnar_batch_body(COLECAO, encode_records(df, colunar=True), MUNICIPIO)
+
+
+def _conferir(df):
+    if json.loads(_linhas(df)) != decode_payload(json.loads(_colunar(df))):
+        return False
+    # Lote com linhas descartadas no meio, como depois do filtro de inalteradas
+    linhas = encode_records(df)[::3]
+    colunar = encode_records(df, colunar=True)[::3]
+    return json.loads(batch_body(COLECAO, linhas, MUNICIPIO)) == decode_payload(json.loads(columnar_batch_body(COLECAO, colunar, MUNICIPIO)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compara o formato de linhas dos lotes com o formato colunar.")
+    parser.add_argument("--linhas", type=int, default=200000)
+    args = parser.parse_args()
+
+    lotes = [_lote(s) for s in range(LOTES_DISTINTOS)]
+    for df in lotes:
+        if not _conferir(df):
+            print("DIFERENTE: o corpo colunar decodificado não é igual ao formato de linhas.")
+            return 1
+
+    print(f"{args.linhas} linhas em lotes de {BATCH_SIZE}")
+    print(f"{'formato':<10} {'cpu(s)':>8} {'linhas/s':>10} {'bytes/linha':>12} {'corpo(MB)':>10} {'gzip(MB)':>9}")
+    gzip_por_lote = {}
+    resultados = {}
+    for nome, caminho in (("linhas", _linhas), ("colunar", _colunar)):
+        gzip_por_lote[nome] = sum(len(gzip.compress(caminho(df).encode())) for df in lotes) / len(lotes)
+        gc.collect()
+        linhas = tamanho = i = 0
+        inicio = time.process_time()
+        while linhas < args.linhas:
+            tamanho += len(caminho(lotes[i % len(lotes)]))
+            linhas += BATCH_SIZE
+            i += 1
+        cpu = time.process_time() - inicio
+        resultados[nome] = (cpu, tamanho)
+        print(f"{nome:<10} {cpu:>8.2f} {linhas / cpu:>10,.0f} {tamanho / linhas:>12.1f} "
+              f"{tamanho / 2**20:>10.1f} {gzip_por_lote[nome] * i / 2**20:>9.1f}")
+
+    (cpu_l, tam_l), (cpu_c, tam_c) = resultados["linhas"], resultados["colunar"]
+    print(f"\ncolunar: {100 * (1 - tam_c / tam_l):.0f}% menos bytes, CPU {100 * (cpu_c / cpu_l - 1):+.0f}%; "
+          f"corpos decodificados idênticos.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,133 @@
+"""
+Benchmark: serialização dos lotes enviados à API, caminho anterior (copy + astype(str) +
+fillna("") + replace + to_dict + json.dumps(default=str)) x core.batch_encoder.
+
+Uso (a partir da pasta "ConectorPec Ultra"):
+    python tools/benchmark_serializacao.py [--linhas 1000000] [--hash]
+
+Gera lotes de BATCH_SIZE linhas com os tipos que as queries do PEC trazem (inteiros, textos,
+datas do psycopg2, timestamps, Decimal, floats e NULL em quase todas as colunas) e mede, para
+a coleção inteira, o CPU do processo e o pico de memória alocada (tracemalloc, numa segunda
+passada, porque o rastreamento deixa tudo mais lento). Com --hash inclui o hash de cada linha
+usado para não reenviar as inalteradas. Antes de medir, confere que os dois caminhos geram o
+mesmo corpo e os mesmos hashes.
+"""
+import os
+import sys
+import gc
+import json
+import math
+import time
+import decimal
+import datetime
+import argparse
+import tracemalloc
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pandas as pd
+
+from core.batch_encoder import encode_records, batch_body
+from core.extractor import MunicipalityExtractor, BATCH_SIZE
+
+# Lotes diferentes gerados antes da medição e reaproveitados em ciclo até completar as linhas
+LOTES_DISTINTOS = 20
+
+
+def _lote(semente):
+    rng = np.random.default_rng(semente)
+    n = BATCH_SIZE
+    base = datetime.date(2024, 1, 1)
+    nulos = rng.random(n) < 0.1
+    registros = {
+        "id_procedimento": np.arange(semente * n, (semente + 1) * n),
+        "id_paciente": [None if x else f"{int(v):036d}" for x, v in zip(nulos, rng.integers(0, 10**9, n))],
+        "cns_profissional": [f"{int(v):015d}" for v in rng.integers(0, 10**15, n)],
+        "cbo": rng.choice(["225142", "223505", "322205", None], n).tolist(),
+        "cnes": [f"{int(v):07d}" for v in rng.integers(0, 10**7, n)],
+        "codigo_procedimento": rng.choice(["0301010064", "0214010015", "0101010010"], n).tolist(),
+        "nome_profissional": rng.choice(["Ana Conceição", "José D'Ávila", "Maria \"Mã\" Souza"], n).tolist(),
+        "data_atendimento": [base + datetime.timedelta(days=int(d)) for d in rng.integers(0, 365, n)],
+        "data_registro": pd.to_datetime("2024-01-01") + pd.to_timedelta(rng.integers(0, 365 * 86400, n), unit="s"),
+        "data_nascimento": [None if x else base - datetime.timedelta(days=int(d)) for x, d in zip(nulos, rng.integers(0, 30000, n))],
+        "peso": np.where(nulos, np.nan, rng.integers(30, 120, n) + 0.5),
+        "quantidade": np.where(rng.random(n) < 0.05, np.nan, rng.integers(1, 5, n)),
+        "valor": [decimal.Decimal(int(v)) / 100 for v in rng.integers(0, 100000, n)],
+        "sexo": rng.choice(["M", "F", None], n).tolist(),
+    }
+    return pd.DataFrame(registros)
+
+
+def _caminho_anterior(nome, df, municipio_id, com_hash):
+    df = df.copy()
+    for col in df.select_dtypes(include=["datetime64", "datetimetz"]).columns:
+        df[col] = df[col].astype(str)
+    df = df.fillna(value="")
+    df = df.replace({math.nan: None})
+    registros = df.to_dict(orient="records")
+    hashes = [MunicipalityExtractor._row_hash(r) for r in registros] if com_hash else None
+    return json.dumps({"collection": nome, "data": registros, "municipio_id": municipio_id}, default=str), hashes
+
+
+def _caminho_novo(nome, df, municipio_id, com_hash):
+    registros = encode_records(df, com_hash)
+    hashes = [r.hash() for r in registros] if com_hash else None
+    return batch_body(nome, registros, municipio_id), hashes
+
+
+def _rodar(caminho, lotes, total, com_hash):
+    linhas = 0
+    tamanho = 0
+    i = 0
+    while linhas < total:
+        corpo, _ = caminho("procedimentos_faturados", lotes[i % len(lotes)], "2400000", com_hash)
+        tamanho += len(corpo)
+        linhas += BATCH_SIZE
+        i += 1
+    return tamanho
+
+
+def _variacao(antes, depois):
+    """"12% menor" / "31% maior" de `depois` em relação a `antes`."""
+    mudanca = 100 * (depois / antes - 1)
+    return f"{abs(mudanca):.0f}% {'menor' if mudanca < 0 else 'maior'}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compara a serialização anterior dos lotes com o batch_encoder.")
+    parser.add_argument("--linhas", type=int, default=1000000)
+    parser.add_argument("--hash", action="store_true", help="inclui o hash de cada linha (supressão de inalteradas)")
+    args = parser.parse_args()
+
+    lotes = [_lote(s) for s in range(LOTES_DISTINTOS)]
+    for df in lotes:
+        if _caminho_anterior("c", df, "m", True) != _caminho_novo("c", df, "m", True):
+            print("DIFERENTE: os dois caminhos não geram o mesmo corpo/hash.")
+            return 1
+
+    caminhos = {"anterior": _caminho_anterior, "batch_encoder": _caminho_novo}
+    print(f"{args.linhas} linhas em lotes de {BATCH_SIZE}{' (com hash)' if args.hash else ''}")
+    print(f"{'caminho':<14} {'cpu(s)':>8} {'parede(s)':>10} {'pico(MB)':>9} {'corpo(MB)':>10}")
+    resultados = {}
+    for nome, caminho in caminhos.items():
+        gc.collect()
+        inicio_cpu, inicio_parede = time.process_time(), time.perf_counter()
+        tamanho = _rodar(caminho, lotes, args.linhas, args.hash)
+        cpu, parede = time.process_time() - inicio_cpu, time.perf_counter() - inicio_parede
+
+        gc.collect()
+        tracemalloc.start()
+        _rodar(caminho, lotes, args.linhas, args.hash)
+        _, pico = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        resultados[nome] = (cpu, pico)
+        print(f"{nome:<14} {cpu:>8.2f} {parede:>10.2f} {pico / 2**20:>9.1f} {tamanho / 2**20:>10.1f}")
+
+    (cpu_a, pico_a), (cpu_b, pico_b) = resultados["anterior"], resultados["batch_encoder"]
+    print(f"\nCPU {_variacao(cpu_a, cpu_b)}, pico de memória {_variacao(pico_a, pico_b)}; corpos e hashes idênticos.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,216 @@
+"""
+Equivalência e benchmark: QUERY_ATENDIMENTO_INDIVIDUAL (subqueries correlacionadas) x
+QUERY_ATENDIMENTO_INDIVIDUAL_AGREGADA (um agregado LATERAL dos problemas por atendimento).
+
+Uso (a partir da pasta "ConectorPec Ultra"):
+    python tools/equivalencia_atendimento_individual.py --host localhost --db postgres --user postgres \
+        [--atendimentos 200000] [--inicio 20240101 --fim 20240430] [--pagina 50000] [--repeticoes 3]
+    python tools/equivalencia_atendimento_individual.py --host 10.0.0.5 --db esus ... --real
+
+Sem --real, cria num schema próprio uma base sintética com as tabelas que as duas queries leem
+(atendimentos sem problema, problemas só com CIAP, só com CID, com chaves sem correspondência
+na dimensão, nomes nulos e atendimentos fora do período) e desfaz tudo no final (ROLLBACK).
+Com --real, compara as duas formas nas tabelas do próprio PEC, no período informado.
+
+As linhas são comparadas como multiconjunto; dentro de ciaps_avaliados/cids_avaliados os
+nomes são ordenados antes da comparação, porque string_agg sem ORDER BY não garante ordem
+em nenhuma das duas formas. O tempo mostrado é o Execution Time do EXPLAIN (ANALYZE, TIMING OFF) (servidor,
+sem transferência), o melhor de N repetições, da query inteira e de uma página keyset do meio do
+período (SQL_KEYSET do extrator, --pagina linhas), que é como a extração lê por padrão.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from collections import Counter
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database.connection import DatabaseConnection
+from queries.queries_atendimentos import QUERY_ATENDIMENTO_INDIVIDUAL, QUERY_ATENDIMENTO_INDIVIDUAL_AGREGADA
+from core.extractor import CHAVES_KEYSET, SQL_KEYSET
+
+SCHEMA_SINTETICO = "equivalencia_atd_ind"
+CHAVE = CHAVES_KEYSET["atendimento_individual"]
+COLUNAS_AGREGADAS = ("ciaps_avaliados", "cids_avaliados")
+
+SQL_BASE_SINTETICA = """
+CREATE SCHEMA {schema};
+SET LOCAL search_path = {schema};
+
+CREATE TABLE tb_dim_cbo AS
+    SELECT g AS co_seq_dim_cbo, lpad(g::text, 6, '2') AS nu_cbo FROM generate_series(1, 50) g;
+CREATE TABLE tb_dim_profissional AS
+    SELECT g AS co_seq_dim_profissional, 'Profissional ' || g AS no_profissional FROM generate_series(1, 500) g;
+CREATE TABLE tb_dim_equipe AS
+    SELECT g AS co_seq_dim_equipe, lpad(g::text, 10, '0') AS nu_ine FROM generate_series(1, 100) g;
+CREATE TABLE tb_dim_unidade_saude AS
+    SELECT g AS co_seq_dim_unidade_saude, lpad(g::text, 7, '9') AS nu_cnes FROM generate_series(1, 40) g;
+CREATE TABLE tb_dim_tipo_atendimento AS
+    SELECT g AS co_seq_dim_tipo_atendimento, 'Tipo ' || g AS ds_tipo_atendimento FROM generate_series(1, 8) g;
+CREATE TABLE tb_dim_local_atendimento AS
+    SELECT g AS co_seq_dim_local_atendimento, 'Local ' || g AS ds_local_atendimento FROM generate_series(1, 10) g;
+CREATE TABLE tb_dim_ciap AS
+    SELECT g AS co_seq_dim_ciap, CASE WHEN g % 97 = 0 THEN NULL ELSE 'CIAP ' || g END AS no_ciap
+    FROM generate_series(1, 700) g;
+CREATE TABLE tb_dim_cid AS
+    SELECT g AS co_seq_dim_cid, CASE WHEN g % 89 = 0 THEN NULL ELSE 'CID ' || g END AS no_cid
+    FROM generate_series(1, 2000) g;
+-- Chaves das dimensões como no PEC (as junções por linha usam o índice)
+ALTER TABLE tb_dim_cbo ADD PRIMARY KEY (co_seq_dim_cbo);
+ALTER TABLE tb_dim_profissional ADD PRIMARY KEY (co_seq_dim_profissional);
+ALTER TABLE tb_dim_equipe ADD PRIMARY KEY (co_seq_dim_equipe);
+ALTER TABLE tb_dim_unidade_saude ADD PRIMARY KEY (co_seq_dim_unidade_saude);
+ALTER TABLE tb_dim_tipo_atendimento ADD PRIMARY KEY (co_seq_dim_tipo_atendimento);
+ALTER TABLE tb_dim_local_atendimento ADD PRIMARY KEY (co_seq_dim_local_atendimento);
+ALTER TABLE tb_dim_ciap ADD PRIMARY KEY (co_seq_dim_ciap);
+ALTER TABLE tb_dim_cid ADD PRIMARY KEY (co_seq_dim_cid);
+
+CREATE TABLE tb_fat_atendimento_individual AS
+    SELECT
+        g::bigint AS co_seq_fat_atd_ind,
+        (g * 7 % 50000)::bigint AS co_fat_cidadao_pec,
+        to_char(date '2024-01-01' + (g % 366), 'YYYYMMDD')::int AS co_dim_tempo,
+        1 + g % 50 AS co_dim_cbo_1,
+        1 + g % 500 AS co_dim_profissional_1,
+        1 + g % 100 AS co_dim_equipe_1,
+        1 + g % 40 AS co_dim_unidade_saude_1,
+        CASE WHEN g % 13 = 0 THEN NULL WHEN g % 17 = 0 THEN 99 ELSE 1 + g % 8 END AS co_dim_tipo_atendimento,
+        CASE WHEN g % 11 = 0 THEN NULL ELSE 1 + g % 10 END AS co_dim_local_atendimento,
+        g % 2 AS st_conduta_consulta_agendada,
+        round((40 + g % 80)::numeric + 0.5, 1) AS nu_peso,
+        round((1.4 + (g % 60) / 100.0)::numeric, 2) AS nu_altura,
+        90 + g % 80 AS nu_pressao_sistolica,
+        60 + g % 40 AS nu_pressao_diastolica,
+        '|A' || (g % 99) || '|' AS ds_filtro_ciaps,
+        '|Z' || (g % 99) || '|' AS ds_filtro_cids
+    FROM generate_series(1, {atendimentos}) g;
+ALTER TABLE tb_fat_atendimento_individual ADD PRIMARY KEY (co_seq_fat_atd_ind);
+CREATE INDEX ON tb_fat_atendimento_individual (co_dim_tempo);
+
+-- 0 a 4 problemas por atendimento; k = 1 só CIAP, k = 2 só CID, chaves 9999 sem dimensão
+CREATE TABLE tb_fat_atd_ind_problemas AS
+    SELECT
+        row_number() OVER ()::bigint AS co_seq_fat_atend_ind_problemas,
+        a.g::bigint AS co_fat_atd_ind,
+        CASE WHEN k = 2 THEN NULL WHEN (a.g + k) % 23 = 0 THEN 9999 ELSE 1 + (a.g * k) % 700 END AS co_dim_ciap,
+        CASE WHEN k = 1 THEN NULL WHEN (a.g + k) % 29 = 0 THEN 9999 ELSE 1 + (a.g + k * 31) % 2000 END AS co_dim_cid
+    FROM generate_series(1, {atendimentos}) a(g)
+    CROSS JOIN LATERAL generate_series(1, a.g % 5) k;
+CREATE INDEX ON tb_fat_atd_ind_problemas (co_fat_atd_ind);
+
+ANALYZE tb_dim_cbo, tb_dim_profissional, tb_dim_equipe, tb_dim_unidade_saude, tb_dim_tipo_atendimento,
+    tb_dim_local_atendimento, tb_dim_ciap, tb_dim_cid, tb_fat_atendimento_individual, tb_fat_atd_ind_problemas;
+"""
+
+
+def _normalizar(linhas, colunas):
+    """Ordena os nomes dentro das colunas de string_agg e devolve o multiconjunto das linhas."""
+    indices = [i for i, nome in enumerate(colunas) if nome in COLUNAS_AGREGADAS]
+    resultado = Counter()
+    for linha in linhas:
+        linha = list(linha)
+        for i in indices:
+            if linha[i] is not None:
+                linha[i] = tuple(sorted(linha[i].split(", ")))
+        resultado[tuple(linha)] += 1
+    return resultado
+
+
+def _executar(cur, sql, params):
+    cur.execute(sql, params)
+    return [d[0] for d in cur.description], cur.fetchall()
+
+
+def _tempo_servidor(cur, sql, params, repeticoes):
+    melhor = None
+    for _ in range(repeticoes):
+        cur.execute("EXPLAIN (ANALYZE, TIMING OFF, FORMAT JSON) " + sql, params)
+        plano = cur.fetchone()[0]
+        if isinstance(plano, str):
+            plano = json.loads(plano)
+        tempo = plano[0]["Execution Time"] / 1000
+        melhor = tempo if melhor is None else min(melhor, tempo)
+    return melhor
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compara as duas formas da query de atendimento individual.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", default="5432")
+    parser.add_argument("--db", default="esus")
+    parser.add_argument("--user", default="postgres")
+    parser.add_argument("--password", default="")
+    parser.add_argument("--inicio", type=int, default=20240101, help="data_inicio no formato AAAAMMDD")
+    parser.add_argument("--fim", type=int, default=20240430, help="data_fim no formato AAAAMMDD")
+    parser.add_argument("--atendimentos", type=int, default=200000, help="tamanho da base sintética")
+    parser.add_argument("--pagina", type=int, default=50000, help="linhas da página keyset cronometrada")
+    parser.add_argument("--repeticoes", type=int, default=3)
+    parser.add_argument("--real", action="store_true", help="usa as tabelas do PEC em vez da base sintética")
+    args = parser.parse_args()
+
+    db_config = {
+        "db_host": args.host, "db_port": args.port, "db_name": args.db,
+        "db_user": args.user, "db_password": args.password,
+    }
+    params = {"data_inicio": args.inicio, "data_fim": args.fim}
+    db = DatabaseConnection(db_config)
+    conn = db.get_connection()
+    try:
+        with conn.cursor() as cur:
+            if not args.real:
+                inicio = time.perf_counter()
+                cur.execute(SQL_BASE_SINTETICA.format(schema=SCHEMA_SINTETICO, atendimentos=int(args.atendimentos)))
+                cur.execute("SELECT count(*) FROM tb_fat_atd_ind_problemas")
+                print(f"Base sintética: {args.atendimentos} atendimentos, {cur.fetchone()[0]} problemas "
+                      f"({time.perf_counter() - inicio:.1f}s)")
+
+            formas = {
+                "correlacionada": QUERY_ATENDIMENTO_INDIVIDUAL,
+                "agregada": QUERY_ATENDIMENTO_INDIVIDUAL_AGREGADA,
+            }
+            resultados = {}
+            pagina = None
+            print(f"\n{'forma':<16} {'linhas':>9} {'servidor(s)':>12} {'total(s)':>9} {'página(s)':>10}")
+            for nome, sql in formas.items():
+                servidor = _tempo_servidor(cur, sql, params, args.repeticoes)
+                inicio = time.perf_counter()
+                colunas, linhas = _executar(cur, sql, params)
+                total = time.perf_counter() - inicio
+                resultados[nome] = (colunas, linhas)
+                if pagina is None:
+                    # Página que começa no meio do período, igual para as duas formas
+                    chaves = sorted(linha[colunas.index(CHAVE)] for linha in linhas)
+                    pagina = chaves[len(chaves) // 2] if chaves else 0
+                sql_pagina = SQL_KEYSET.format(sql=sql, chave=CHAVE, filtro=f"WHERE pagina.{CHAVE} > %(keyset_ultima_chave)s", limite=int(args.pagina))
+                tempo_pagina = _tempo_servidor(cur, sql_pagina, dict(params, keyset_ultima_chave=pagina), args.repeticoes)
+                print(f"{nome:<16} {len(linhas):>9} {servidor:>12.3f} {total:>9.3f} {tempo_pagina:>10.3f}")
+
+            colunas_a, linhas_a = resultados["correlacionada"]
+            colunas_b, linhas_b = resultados["agregada"]
+            if colunas_a != colunas_b:
+                print(f"\nDIFERENTE: colunas {colunas_a} x {colunas_b}")
+                return 1
+            a = _normalizar(linhas_a, colunas_a)
+            b = _normalizar(linhas_b, colunas_b)
+            if a != b:
+                so_a = list((a - b).elements())
+                so_b = list((b - a).elements())
+                print(f"\nDIFERENTE: {len(so_a)} linha(s) só na correlacionada, {len(so_b)} só na agregada")
+                for linha in so_a[:5]:
+                    print("  correlacionada:", linha)
+                for linha in so_b[:5]:
+                    print("  agregada:      ", linha)
+                return 1
+            com_problemas = sum(1 for linha in linhas_a if linha[colunas_a.index("ciaps_avaliados")] or linha[colunas_a.index("cids_avaliados")])
+            print(f"\nEQUIVALENTES: {len(linhas_a)} linhas idênticas ({com_problemas} com CIAP/CID agregado).")
+            return 0
+    finally:
+        # Nada da base sintética fica no banco
+        conn.rollback()
+        db.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,84 @@
+"""
+Servidor local no lugar do ingestUltraData: recebe os POSTs do extrator, decodifica os lotes
+colunares com core.columnar_payload.decode_payload (o decodificador de referência) e conta
+registros e bytes por coleção. Com --saida, os registros decodificados vão para um arquivo
+JSON Lines ({"collection", ...colunas}).
+
+Uso (a partir da pasta "ConectorPec Ultra"):
+    python tools/servidor_local.py [--porta 8086] [--saida registros.jsonl]
+
+Para apontar o extrator para ele num teste, troque o self.api_url do MunicipalityExtractor
+(core/extractor.py) por http://127.0.0.1:<porta>/.
+"""
+import os
+import sys
+import json
+import argparse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.columnar_payload import decode_payload
+
+
+class Recebedor(BaseHTTPRequestHandler):
+    saida = None
+    totais = {}
+
+    def do_POST(self):
+        corpo = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            payload = json.loads(corpo)
+            colunar = "columnar" in payload
+            payload = decode_payload(payload)
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            self._responder(400, {"erro": f"corpo inválido: {e}"})
+            return
+        colecao = payload.get("collection") or ("dimensao" if "dimensao" in payload else "?")
+        registros = payload.get("data") or []
+        total = self.totais.setdefault(colecao, {"posts": 0, "registros": 0, "bytes": 0})
+        total["posts"] += 1
+        total["registros"] += len(registros)
+        total["bytes"] += len(corpo)
+        if self.saida is not None:
+            for registro in registros:
+                self.saida.write(json.dumps({"collection": colecao, **registro}, ensure_ascii=False) + "\n")
+            self.saida.flush()
+        print(f"[{payload.get('municipio_id')}] {colecao}: {len(registros)} registros "
+              f"({'colunar' if colunar else 'linhas'}, {len(corpo)} bytes) - total {total['registros']} registros, "
+              f"{total['bytes']} bytes em {total['posts']} POSTs", flush=True)
+        self._responder(200, {"recebidos": len(registros)})
+
+    def _responder(self, status, corpo):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(json.dumps(corpo).encode())
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor local no lugar do ingestUltraData.")
+    parser.add_argument("--porta", type=int, default=8086)
+    parser.add_argument("--saida", help="arquivo JSON Lines para os registros decodificados")
+    args = parser.parse_args()
+
+    if args.saida:
+        Recebedor.saida = open(args.saida, "a", encoding="utf-8")
+    servidor = HTTPServer(("127.0.0.1", args.porta), Recebedor)
+    print(f"Escutando em http://127.0.0.1:{args.porta}/ (Ctrl+C para parar)")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servidor.server_close()
+        if Recebedor.saida is not None:
+            Recebedor.saida.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,217 @@
+"""
+Verificação do modo CDC (extracao_cdc) contra um PostgreSQL de teste com wal_level = logical:
+para cada plugin (test_decoding e pgoutput) cria o slot com database.change_feed.LogicalChangeFeed,
+aplica INSERT/UPDATE/DELETE em tb_fat_atendimento_individual e tb_fat_atd_ind_problemas e confere
+
+- os eventos decodificados (tabela, operação e colunas, inclusive texto com aspas e NULL);
+- a tupla nova de UPDATE com old-key (chave alterada e REPLICA IDENTITY FULL);
+- o agrupamento do extrator (MunicipalityExtractor._agrupar_eventos_cdc): problema novo ou
+  alterado reenvia o atendimento a que pertence, DELETE na própria tabela vira remoção;
+- que o peek não consome nada e que o advance leva o confirmed_flush_lsn do slot até o lsn lido.
+
+Antes do servidor, confere a decodificação de linhas prontas do test_decoding (colunas de tipo
+array, tipo com espaços, texto com aspas, NULL e old-key), que não dependem do plugin instalado.
+
+Uso (a partir da pasta "ConectorPec Ultra"):
+    python tools/verificar_cdc.py --host localhost --db esus_teste --user postgres \
+        [--plugins test_decoding,pgoutput]
+
+Só para banco de teste: as linhas de teste são cópias de linhas existentes com chaves acima das
+atuais e são apagadas no final, junto com o slot e a publicação. Durante a verificação
+tb_fat_atd_ind_problemas fica com REPLICA IDENTITY FULL (volta para DEFAULT no final), e outras
+escritas nas duas tabelas ao mesmo tempo aparecem como eventos a mais.
+"""
+import os
+import sys
+import json
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database.connection import DatabaseConnection
+from database.change_feed import PLUGINS, LogicalChangeFeed, decode_test_decoding
+from core.extractor import CDC_CHAVES, MunicipalityExtractor
+
+SLOT = "probpa_verificacao_cdc"
+ATENDIMENTOS = ("tb_fat_atendimento_individual", "co_seq_fat_atd_ind")
+PROBLEMAS = ("tb_fat_atd_ind_problemas", "co_seq_fat_atend_ind_problemas")
+# Chaves de teste ficam acima da maior chave existente
+DESLOCAMENTO = 1_000_000_000
+
+# Cópia de uma linha existente da tabela com as colunas trocadas (valores em JSON)
+SQL_COPIAR_LINHA = """
+INSERT INTO {tabela}
+SELECT (jsonb_populate_record(NULL::{tabela}, to_jsonb(t) || %s::jsonb)).*
+FROM {tabela} t
+WHERE {chave} = (SELECT min({chave}) FROM {tabela})
+"""
+
+# Linhas do test_decoding e o que a decodificação deve devolver
+LINHAS_TEST_DECODING = [
+    ("coluna array", "table public.tb_x: INSERT: id[integer]:1 tags[character varying[]]:'{a,b}' n[text]:'x'",
+     ("public", "tb_x", "INSERT", {"id": "1", "tags": "{a,b}", "n": "x"})),
+    ("array NULL, tipo com espaços e aspas", "table public.tb_x: UPDATE: id[bigint]:2 notas[integer[]]:null dt[timestamp without time zone]:'2024-01-02 03:04:05' n[text]:'d''Ávila'",
+     ("public", "tb_x", "UPDATE", {"id": "2", "notas": None, "dt": "2024-01-02 03:04:05", "n": "d'Ávila"})),
+    ("old-key com array na tupla nova", "table public.tb_x: UPDATE: old-key: id[bigint]:3 new-tuple: id[bigint]:4 tags[text[]]:'{\"a b\",c}'",
+     ("public", "tb_x", "UPDATE", {"id": "4", "tags": '{"a b",c}'})),
+    ("BEGIN ignorado", "BEGIN 1234", None),
+]
+
+
+def _maior_chave(cur, tabela, chave):
+    cur.execute(f"SELECT COALESCE(max({chave}), 0) FROM {tabela}")
+    return int(cur.fetchone()[0])
+
+
+def _copiar(cur, tabela, chave, colunas):
+    cur.execute(SQL_COPIAR_LINHA.format(tabela=tabela, chave=chave), (json.dumps(colunas),))
+    if cur.rowcount != 1:
+        raise Exception(f"{tabela} está vazia: a verificação copia uma linha existente")
+
+
+def _conferir(nome, obtido, esperado, falhas):
+    if obtido == esperado:
+        print(f"  OK      {nome}")
+    else:
+        falhas.append(nome)
+        print(f"  FALHOU  {nome}\n          esperado: {esperado}\n          obtido:   {obtido}")
+
+
+def _limpar(conn, limites):
+    with conn.cursor() as cur:
+        for (tabela, chave), limite in zip((ATENDIMENTOS, PROBLEMAS), limites):
+            cur.execute(f"DELETE FROM {tabela} WHERE {chave} > %s", (limite,))
+    conn.commit()
+
+
+def verificar_decodificacao():
+    """Decodifica LINHAS_TEST_DECODING, sem servidor. Retorna a lista de verificações que falharam."""
+    falhas = []
+    for nome, linha, esperado in LINHAS_TEST_DECODING:
+        _conferir(nome, decode_test_decoding(linha), esperado, falhas)
+    return falhas
+
+
+def verificar(db, plugin):
+    """Roda o cenário com um plugin. Retorna a lista de verificações que falharam."""
+    conn = db.get_connection()
+    tabela_a, chave_a = ATENDIMENTOS
+    tabela_p, chave_p = PROBLEMAS
+    falhas = []
+
+    with conn.cursor() as cur:
+        base_a = _maior_chave(cur, tabela_a, chave_a) + DESLOCAMENTO
+        base_p = _maior_chave(cur, tabela_p, chave_p) + DESLOCAMENTO
+        cur.execute("SELECT relreplident FROM pg_class WHERE oid = %s::regclass", (tabela_p,))
+        identidade = cur.fetchone()[0]
+    conn.commit()
+    if identidade not in ("d", "f"):
+        raise Exception(f"{tabela_p} tem REPLICA IDENTITY '{identidade}': a verificação espera DEFAULT ou FULL")
+    a1, a2, a3, a4 = (base_a + i for i in range(1, 5))
+    p1, p2, p3 = (base_p + i for i in range(1, 4))
+
+    feed = LogicalChangeFeed(db, SLOT, plugin, set(CDC_CHAVES))
+    try:
+        # Estado inicial, gravado antes do slot (não aparece nas alterações)
+        with conn.cursor() as cur:
+            if identidade == "d":
+                # DELETE de um problema só traz a chave do atendimento com a tupla antiga inteira
+                cur.execute(f"ALTER TABLE {tabela_p} REPLICA IDENTITY FULL")
+            _copiar(cur, tabela_a, chave_a, {chave_a: a1})
+            _copiar(cur, tabela_a, chave_a, {chave_a: a2})
+            _copiar(cur, tabela_p, chave_p, {chave_p: p1, "co_fat_atd_ind": a1})
+            _copiar(cur, tabela_p, chave_p, {chave_p: p2, "co_fat_atd_ind": a2})
+        conn.commit()
+
+        if feed.exists():
+            feed.drop()
+        _conferir("slot criado", feed.ensure(), True, falhas)
+
+        with conn.cursor() as cur:
+            _copiar(cur, tabela_a, chave_a, {chave_a: a3, "nu_uuid_ficha": "ficha d'Ávila 3"})
+            _copiar(cur, tabela_p, chave_p, {chave_p: p3, "co_fat_atd_ind": a3})
+            # REPLICA IDENTITY FULL: old-key com a tupla antiga inteira, vale a nova
+            cur.execute(f"UPDATE {tabela_p} SET co_fat_atd_ind = %s WHERE {chave_p} = %s", (a2, p1))
+            # Chave primária alterada: old-key só com a chave antiga
+            cur.execute(f"UPDATE {tabela_a} SET {chave_a} = %s WHERE {chave_a} = %s", (a4, a1))
+            cur.execute(f"DELETE FROM {tabela_p} WHERE {chave_p} = %s", (p2,))
+            cur.execute(f"DELETE FROM {tabela_a} WHERE {chave_a} = %s", (a2,))
+        conn.commit()
+        with conn.cursor() as cur:
+            cur.execute(f"UPDATE {tabela_a} SET nu_uuid_ficha = NULL WHERE {chave_a} = %s", (a3,))
+        conn.commit()
+
+        esperados = [
+            (tabela_a, "INSERT", {chave_a: str(a3), "nu_uuid_ficha": "ficha d'Ávila 3"}),
+            (tabela_p, "INSERT", {chave_p: str(p3), "co_fat_atd_ind": str(a3)}),
+            (tabela_p, "UPDATE", {chave_p: str(p1), "co_fat_atd_ind": str(a2)}),
+            (tabela_a, "UPDATE", {chave_a: str(a4)}),
+            (tabela_p, "DELETE", {chave_p: str(p2), "co_fat_atd_ind": str(a2)}),
+            (tabela_a, "DELETE", {chave_a: str(a2)}),
+            (tabela_a, "UPDATE", {chave_a: str(a3), "nu_uuid_ficha": None}),
+        ]
+        lsn, eventos = feed.peek(1000)
+        obtidos = [(tabela, operacao, {coluna: colunas.get(coluna) for coluna in esperado})
+                   for (tabela, operacao, colunas), (_, _, esperado) in zip(eventos, esperados)]
+        _conferir("eventos decodificados", obtidos if len(eventos) == len(esperados) else eventos, esperados, falhas)
+
+        chaves, removidas, tocadas = MunicipalityExtractor._agrupar_eventos_cdc(eventos)
+        _conferir("chaves a reenviar", chaves, {"atendimento_individual": {a2, a3, a4}, "condicoes_clinicas": {p1, p3}}, falhas)
+        _conferir("chaves removidas", removidas, {"atendimento_individual": {a2}, "condicoes_clinicas": {p2}}, falhas)
+        _conferir("tabelas tocadas", tocadas, {tabela_a, tabela_p}, falhas)
+
+        _conferir("peek não consome", feed.peek(1000), (lsn, eventos), falhas)
+        feed.advance(lsn)
+        with conn.cursor() as cur:
+            cur.execute("SELECT confirmed_flush_lsn >= %s::pg_lsn FROM pg_replication_slots WHERE slot_name = %s", (lsn, SLOT))
+            avancou = cur.fetchone()[0]
+        conn.commit()
+        _conferir(f"slot avançado até {lsn}", avancou, True, falhas)
+        _conferir("nada pendente depois do advance", feed.peek(1000), (None, []), falhas)
+    finally:
+        conn.rollback()
+        feed.drop()
+        _limpar(conn, (base_a, base_p))
+        if identidade == "d":
+            with conn.cursor() as cur:
+                cur.execute(f"ALTER TABLE {tabela_p} REPLICA IDENTITY DEFAULT")
+            conn.commit()
+    return falhas
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verifica o modo CDC contra um PostgreSQL de teste (wal_level = logical).")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", default="5432")
+    parser.add_argument("--db", default="esus")
+    parser.add_argument("--user", default="postgres")
+    parser.add_argument("--password", default="")
+    parser.add_argument("--plugins", default=",".join(PLUGINS), help="plugins separados por vírgula")
+    args = parser.parse_args()
+
+    db = DatabaseConnection({
+        "db_host": args.host, "db_port": args.port, "db_name": args.db,
+        "db_user": args.user, "db_password": args.password,
+    })
+    print("\ndecodificação do test_decoding:")
+    falhas = [f"decodificação: {nome}" for nome in verificar_decodificacao()]
+    try:
+        for plugin in args.plugins.split(","):
+            print(f"\n{plugin}:")
+            try:
+                falhas += [f"{plugin}: {nome}" for nome in verificar(db, plugin)]
+            except Exception as e:
+                print(f"  FALHOU  {e}")
+                falhas.append(f"{plugin}: {e}")
+    finally:
+        db.close()
+
+    if falhas:
+        print(f"\n{len(falhas)} verificação(ões) falharam.")
+        return 1
+    print("\nTodas as verificações passaram.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,199 @@
+import re
+import struct
+
+# Supported decoding plugins: test_decoding (contrib, text output) and pgoutput (built in since
+# PostgreSQL 10, binary; only publishes the tables in the publication)
+PLUGINS = ("test_decoding", "pgoutput")
+
+# test_decoding line: "table public.tb_x: INSERT: col[type]:value col2[type]:'text' col3[type[]]:'{a,b}'"
+_TEST_DECODING_LINE = re.compile(r"^table ([^.]+)\.(\S+): (INSERT|UPDATE|DELETE): (.*)$", re.DOTALL)
+_TEST_DECODING_COLUMN = re.compile(r"(\w+)\[(?:[^\[\]]|\[\])+\]:('(?:[^']|'')*'|\S+)")
+
+_PGOUTPUT_OPERATIONS = {b"I": "INSERT", b"U": "UPDATE", b"D": "DELETE"}
+
+
+def decode_test_decoding(line):
+    """(schema, table, operation, {column: text}) from a test_decoding line, or None (BEGIN/COMMIT)."""
+    m = _TEST_DECODING_LINE.match(line)
+    if not m:
+        return None
+    schema, table, operation, rest = m.groups()
+    # An UPDATE that changed the key carries "old-key: ... new-tuple: ..."; the new tuple is what counts
+    if "new-tuple:" in rest:
+        rest = rest.split("new-tuple:", 1)[1]
+    columns = {}
+    for name, value in _TEST_DECODING_COLUMN.findall(rest):
+        if value == "null":
+            columns[name] = None
+        elif value.startswith("'"):
+            columns[name] = value[1:-1].replace("''", "'")
+        else:
+            columns[name] = value
+    return schema, table, operation, columns
+
+
+class _Reader:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read(self, fmt):
+        values = struct.unpack_from(fmt, self.data, self.pos)
+        self.pos += struct.calcsize(fmt)
+        return values[0] if len(values) == 1 else values
+
+    def string(self):
+        end = self.data.index(b"\x00", self.pos)
+        value = self.data[self.pos:end].decode("utf-8")
+        self.pos = end + 1
+        return value
+
+    def tuple(self, names):
+        columns = {}
+        for i in range(self.read("!h")):
+            kind = self.data[self.pos:self.pos + 1]
+            self.pos += 1
+            if kind == b"t":
+                size = self.read("!i")
+                columns[names[i]] = self.data[self.pos:self.pos + size].decode("utf-8")
+                self.pos += size
+            elif kind == b"n":
+                columns[names[i]] = None
+            # "u": unchanged TOAST value, not included in the message
+        return columns
+
+
+def decode_pgoutput(data, relations):
+    """
+    (schema, table, operation, {column: text}) from a pgoutput message (protocol 1), or None.
+    `relations` keeps the Relation messages seen so far (oid -> (schema, table, columns)):
+    pgoutput describes each table only once per decoding session.
+    """
+    data = bytes(data)
+    reader = _Reader(data)
+    kind = data[:1]
+    reader.pos = 1
+    if kind == b"R":
+        oid = reader.read("!I")
+        schema, table = reader.string(), reader.string()
+        reader.read("!b")  # replica identity
+        names = []
+        for _ in range(reader.read("!h")):
+            reader.read("!b")
+            names.append(reader.string())
+            reader.read("!Ii")
+        relations[oid] = (schema, table, names)
+        return None
+    if kind not in _PGOUTPUT_OPERATIONS:
+        return None
+
+    oid = reader.read("!I")
+    schema, table, names = relations[oid]
+    marker = data[reader.pos:reader.pos + 1]
+    reader.pos += 1
+    columns = reader.tuple(names)
+    if kind == b"U" and marker in (b"K", b"O"):
+        # Old tuple (key changed / REPLICA IDENTITY FULL); the new one ("N") follows
+        reader.pos += 1
+        columns = reader.tuple(names)
+    return schema, table, _PGOUTPUT_OPERATIONS[kind], columns
+
+
+class LogicalChangeFeed:
+    """
+    Change stream of a PEC database through a logical replication slot, read with the SQL
+    interface (pg_logical_slot_peek_*_changes): needs wal_level = logical and a user with
+    REPLICATION. Changes only leave the slot on `advance`, called once everything they touched
+    was acknowledged by the API; a run that fails before that reads the same changes again.
+
+    While the slot exists the server keeps the WAL it has not consumed, so a connector that
+    stays offline for long makes pg_wal grow. `drop` removes the slot (and the publication).
+    """
+    def __init__(self, conn, slot, plugin="test_decoding", tables=()):
+        if plugin not in PLUGINS:
+            raise ValueError(f"Unsupported decoding plugin: {plugin}")
+        self.conn = conn
+        self.slot = slot
+        self.plugin = plugin
+        self.publication = slot
+        self.tables = set(tables)
+
+    def _run(self, sql, params=None, fetch=True):
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute(sql, params)
+                result = cur.fetchall() if fetch and cur.description else None
+            self.conn.commit()
+            return result
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def exists(self):
+        return bool(self._run("SELECT 1 FROM pg_replication_slots WHERE slot_name = %s", (self.slot,)))
+
+    def ensure(self):
+        """Creates the slot (and, for pgoutput, the tables' publication) if missing. True if created now."""
+        if self.exists():
+            return False
+        level = self._run("SELECT current_setting('wal_level')")[0][0]
+        if level != "logical":
+            raise Exception(f"server has wal_level = {level} ('logical' and a PostgreSQL restart are required)")
+        if self.plugin == "pgoutput" and not self._run("SELECT 1 FROM pg_publication WHERE pubname = %s", (self.publication,)):
+            existing = self._run(
+                "SELECT c.relname FROM pg_class c WHERE c.relname = ANY(%s) AND c.relkind = 'r' AND pg_table_is_visible(c.oid)",
+                (sorted(self.tables),)
+            )
+            self._run(f"CREATE PUBLICATION {self.publication} FOR TABLE {', '.join(sorted(t for (t,) in existing))}", fetch=False)
+        self._run("SELECT pg_create_logical_replication_slot(%s, %s)", (self.slot, self.plugin))
+        return True
+
+    def peek(self, limit):
+        """
+        Reads up to `limit` changes without consuming them (always whole transactions).
+        Returns (lsn to advance to, or None; [(table, operation, {column: text})]) for the
+        tracked tables only.
+        """
+        if self.plugin == "pgoutput":
+            rows = self._run(
+                "SELECT lsn::text, data FROM pg_logical_slot_peek_binary_changes(%s, NULL, %s, "
+                "'proto_version', '1', 'publication_names', %s)",
+                (self.slot, limit, self.publication)
+            )
+            relations = {}
+            decode = lambda data: decode_pgoutput(data, relations)
+        else:
+            rows = self._run(
+                "SELECT lsn::text, data FROM pg_logical_slot_peek_changes(%s, NULL, %s, "
+                "'include-xids', '0', 'skip-empty-xacts', '1')",
+                (self.slot, limit)
+            )
+            decode = decode_test_decoding
+
+        events = []
+        for _, data in rows:
+            event = decode(data)
+            if event and event[1] in self.tables:
+                events.append(event[1:])
+        # The last row is always a COMMIT; its lsn closes the range that was read
+        return (rows[-1][0] if rows else None), events
+
+    def advance(self, lsn):
+        """Discards everything up to `lsn` (inclusive) from the slot."""
+        version = int(self._run("SHOW server_version_num")[0][0])
+        if version >= 110000:
+            self._run("SELECT pg_replication_slot_advance(%s, %s)", (self.slot, lsn))
+        elif self.plugin == "pgoutput":
+            self._run(
+                "SELECT count(*) FROM pg_logical_slot_get_binary_changes(%s, %s, NULL, "
+                "'proto_version', '1', 'publication_names', %s)",
+                (self.slot, lsn, self.publication)
+            )
+        else:
+            self._run("SELECT count(*) FROM pg_logical_slot_get_changes(%s, %s, NULL)", (self.slot, lsn))
+
+    def drop(self):
+        if self.exists():
+            self._run("SELECT pg_drop_replication_slot(%s)", (self.slot,))
+        if self.plugin == "pgoutput":
+            self._run(f"DROP PUBLICATION IF EXISTS {self.publication}", fetch=False)
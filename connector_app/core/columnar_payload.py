@@ -0,0 +1,95 @@
+"""
+Columnar upload body ('columnar_payload'): instead of {"records": [{...}, ...]}, which repeats
+every key on every record, the batch goes out as
+
+    {"columnar": {"count": 100,
+                  "columns": ["externalId", "professional.name", ...],
+                  "data": [[...], [...], ...],
+                  "dictionaries": {"professional.name": ["Ana", "José"], ...}}}
+
+with one array per column, in record order. A column listed in "dictionaries" holds indexes
+into its dictionary (null stays null): low-cardinality strings (names, CBOs, CNES, procedure
+types) are written once per batch. Nested objects are flattened into dotted column names.
+
+decode_payload is the reference decoder: it gives back the {"records": [...]} body the row
+format would have sent, and has no dependencies besides json, so a stand-in server can use it
+as is (see tools/local_ingest_server.py). ingestPecData decodes the same way
+(functions/src/utils/columnarPayload.ts); keep the two in step when the format changes.
+"""
+import json
+
+# A string column goes out as a dictionary when at most this fraction of its values is distinct
+DICTIONARY_MAX_RATIO = 0.5
+
+_string = json.encoder.encode_basestring_ascii
+
+
+def encode_columns(names, columns):
+    """
+    Columnar block (JSON text) of `columns`, lists of already encoded JSON values (same length,
+    one list per name in `names`).
+    """
+    count = len(columns[0]) if columns else 0
+    limit = count * DICTIONARY_MAX_RATIO
+    data = []
+    dictionaries = []
+    for name, values in zip(names, columns):
+        distinct = dict.fromkeys(values)
+        if count > 1 and len(distinct) <= limit and all(value[0] == '"' or value == "null" for value in distinct):
+            distinct.pop("null", None)
+            codes = {value: str(i) for i, value in enumerate(distinct)}
+            codes["null"] = "null"
+            data.append("[" + ", ".join(map(codes.__getitem__, values)) + "]")
+            dictionaries.append(f'{_string(name)}: [{", ".join(distinct)}]')
+        else:
+            data.append("[" + ", ".join(values) + "]")
+    return (
+        f'{{"count": {count}, "columns": [{", ".join(map(_string, names))}], '
+        f'"data": [{", ".join(data)}], "dictionaries": {{{", ".join(dictionaries)}}}}}'
+    )
+
+
+def columnar_body(names, columns, ref_fields=None):
+    """Upload body of a columnar batch (bytes, as records_body, with its "refs")."""
+    refs = f', "refs": {json.dumps(ref_fields)}' if ref_fields else ""
+    return ('{"columnar": ' + encode_columns(names, columns) + refs + "}").encode()
+
+
+def decode_columns(block):
+    """Rows of a columnar block as flat dicts ({column name: value}), in order."""
+    names = block["columns"]
+    dictionaries = block.get("dictionaries") or {}
+    columns = []
+    for name, values in zip(names, block["data"]):
+        dictionary = dictionaries.get(name)
+        if dictionary is not None:
+            values = [None if code is None else dictionary[code] for code in values]
+        columns.append(values)
+    if not columns:
+        return [{} for _ in range(block.get("count", 0))]
+    return [dict(zip(names, row)) for row in zip(*columns)]
+
+
+def _nest(row):
+    record = {}
+    for name, value in row.items():
+        parent, dot, key = name.partition(".")
+        if dot:
+            record.setdefault(parent, {})[key] = value
+        else:
+            record[name] = value
+    return record
+
+
+def decode_payload(payload):
+    """
+    Upload body (parsed JSON) in the row format: columnar bodies are decoded into
+    {"records": [...]}, any other body is returned unchanged.
+    """
+    block = payload.get("columnar")
+    if block is None:
+        return payload
+    decoded = {"records": [_nest(row) for row in decode_columns(block)]}
+    if payload.get("refs"):
+        decoded["refs"] = payload["refs"]
+    return decoded
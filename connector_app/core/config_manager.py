@@ -155,6 +155,62 @@ class ConfigManager:
         self.config_cache["municipalities"] = muns
         self._save_cache_to_disk()
 
+    def set_collection_watermark(self, municipality_id: str, collection: str, timestamp_iso: str, signature=None, sequence=None):
+        """
+        Incremental watermark for one collection, committed once its last batch is acknowledged.
+        `signature` is the change probe of its source tables taken before the extraction and
+        `sequence` the (fact table, max co_seq_*) read before it.
+        """
+        if self.config_cache is None:
+            self.config_cache = self._load_config_internal()
+        if not self.config_cache: return
+        
+        muns = self.config_cache.get("municipalities", [])
+        for m in muns:
+            if m.get("municipality_id") == municipality_id:
+                m.setdefault("collection_watermarks", {})[collection] = timestamp_iso
+                if signature is not None:
+                    m.setdefault("collection_signatures", {})[collection] = signature
+                if sequence is not None:
+                    m.setdefault("collection_sequences", {}).setdefault(collection, {})[sequence[0]] = sequence[1]
+                break
+                
+        self.config_cache["municipalities"] = muns
+        self._save_cache_to_disk()
+
+    def set_cdc_slot(self, municipality_id: str, slot):
+        """Replication slot created for the logical decoding mode ({'name', 'plugin'}), or None once dropped."""
+        if self.config_cache is None:
+            self.config_cache = self._load_config_internal()
+        if not self.config_cache: return
+
+        muns = self.config_cache.get("municipalities", [])
+        for m in muns:
+            if m.get("municipality_id") == municipality_id:
+                if slot is None:
+                    m.pop("cdc_slot", None)
+                else:
+                    m["cdc_slot"] = slot
+                break
+
+        self.config_cache["municipalities"] = muns
+        self._save_cache_to_disk()
+
+    def set_dimension_version(self, municipality_id: str, table: str, version: str):
+        """Version of a synced dimension the API acknowledged (dimension sync mode ledger)."""
+        if self.config_cache is None:
+            self.config_cache = self._load_config_internal()
+        if not self.config_cache: return
+
+        muns = self.config_cache.get("municipalities", [])
+        for m in muns:
+            if m.get("municipality_id") == municipality_id:
+                m.setdefault("dimension_versions", {})[table] = version
+                break
+
+        self.config_cache["municipalities"] = muns
+        self._save_cache_to_disk()
+
     def set_municipality_last_attempt(self, municipality_id: str, timestamp_iso: str):
         if self.config_cache is None:
             self.config_cache = self._load_config_internal()
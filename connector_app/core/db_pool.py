@@ -0,0 +1,186 @@
+import hashlib
+import threading
+import time
+import psycopg2
+from core.load_monitor import APPLICATION_NAME
+
+# Max simultaneous connections opened against the same PEC server (host:port)
+MAX_CONNECTIONS_PER_HOST = 4
+# Connections idle for longer than this are closed the next time the pool is touched
+MAX_IDLE_SECONDS = 20 * 60
+
+
+class ConnectionPool:
+    """
+    Process-wide PostgreSQL connection pool.
+    Idle connections are grouped by host/port/db/user/password and the connection cap is enforced
+    per host, since several municipalities may live on the same PEC server.
+    """
+    def __init__(self, max_per_host=MAX_CONNECTIONS_PER_HOST, max_idle_seconds=MAX_IDLE_SECONDS):
+        self.max_per_host = max_per_host
+        self.max_idle_seconds = max_idle_seconds
+        self._cond = threading.Condition()
+        self._idle = {}   # key -> [(connection, time it came back to the pool)]
+        self._open = {}   # (host, port) -> open connections (in use + idle)
+        self._in_use = {}  # connection -> pool generation it was handed out in
+        # close_all bumps the generation: connections handed out before it are closed when they come back
+        self._generation = 0
+
+    @staticmethod
+    def make_key(mun_config):
+        # The password goes in as a hash: once it changes in the settings, an idle connection
+        # opened with the old one is not reused (and the hash keeps it out of logs and caches)
+        password = str(mun_config.get('db_pass', 'postgres'))
+        return (
+            str(mun_config.get('db_host')),
+            str(mun_config.get('db_port', '5432')),
+            str(mun_config.get('db_name', 'esus')),
+            str(mun_config.get('db_user', 'postgres')),
+            hashlib.sha256(password.encode('utf-8')).hexdigest(),
+        )
+
+    def acquire(self, mun_config, timeout=120):
+        """
+        Returns a validated connection for the municipality, reusing an idle one when possible.
+        Blocks (up to `timeout`) while the host is at its connection cap.
+        """
+        key = self.make_key(mun_config)
+        host = key[:2]
+        deadline = time.monotonic() + timeout
+
+        while True:
+            conn = None
+            create = False
+            with self._cond:
+                self._drop_expired()
+                idle = self._idle.get(key)
+                if idle:
+                    conn, _ = idle.pop()
+                elif self._open.get(host, 0) < self.max_per_host:
+                    self._open[host] = self._open.get(host, 0) + 1
+                    create = True
+                elif self._evict_idle_from_other_db(host):
+                    continue
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise Exception(f"Timed out waiting for a free connection to {host[0]}:{host[1]}")
+                    self._cond.wait(remaining)
+                    continue
+
+            if create:
+                try:
+                    conn = psycopg2.connect(
+                        host=key[0],
+                        port=key[1],
+                        dbname=key[2],
+                        user=key[3],
+                        password=mun_config.get('db_pass', 'postgres'),
+                        connect_timeout=10,
+                        application_name=APPLICATION_NAME
+                    )
+                except Exception:
+                    self._decrement(host)
+                    raise
+                return self._hand_out(conn)
+
+            if self._validate(conn):
+                return self._hand_out(conn)
+            # Dead connection (VPN dropped, server restarted): discard and try again
+            self._close(conn)
+            self._decrement(host)
+
+    def release(self, mun_config, conn, discard=False):
+        """
+        Returns the connection to the pool. Open transactions are rolled back; closed
+        connections, those flagged with `discard` and those handed out before a close_all
+        are dropped.
+        """
+        if conn is None:
+            return
+        key = self.make_key(mun_config)
+        with self._cond:
+            if self._in_use.pop(conn, self._generation) != self._generation:
+                discard = True
+        if not discard and not conn.closed:
+            try:
+                if conn.status != psycopg2.extensions.STATUS_READY:
+                    conn.rollback()
+            except Exception:
+                discard = True
+        if discard or conn.closed:
+            self._close(conn)
+            self._decrement(key[:2])
+            return
+        with self._cond:
+            self._idle.setdefault(key, []).append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def close_all(self):
+        """
+        Closes the idle connections. Those in use are closed when they come back (release).
+        """
+        with self._cond:
+            self._generation += 1
+            for key, idle in self._idle.items():
+                for conn, _ in idle:
+                    self._close(conn)
+                    self._open[key[:2]] = self._open.get(key[:2], 1) - 1
+            self._idle.clear()
+            self._cond.notify_all()
+
+    def _hand_out(self, conn):
+        with self._cond:
+            self._in_use[conn] = self._generation
+        return conn
+
+    def _validate(self, conn):
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _drop_expired(self):
+        # Called with the lock held
+        now = time.monotonic()
+        for key, idle in self._idle.items():
+            alive = []
+            for conn, since in idle:
+                if now - since > self.max_idle_seconds or conn.closed:
+                    self._close(conn)
+                    self._open[key[:2]] = self._open.get(key[:2], 1) - 1
+                else:
+                    alive.append((conn, since))
+            idle[:] = alive
+
+    def _evict_idle_from_other_db(self, host):
+        # Called with the lock held: host is at the cap but has an idle connection to another municipality
+        for key, idle in self._idle.items():
+            if key[:2] == host and idle:
+                conn, _ = idle.pop(0)
+                self._close(conn)
+                self._open[host] = self._open.get(host, 1) - 1
+                return True
+        return False
+
+    def _decrement(self, host):
+        with self._cond:
+            self._open[host] = max(0, self._open.get(host, 1) - 1)
+            self._cond.notify()
+
+    @staticmethod
+    def _close(conn):
+        try:
+            if not conn.closed:
+                conn.close()
+        except Exception:
+            pass
+
+
+# Singleton instance
+connection_pool = ConnectionPool()
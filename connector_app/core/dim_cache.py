@@ -0,0 +1,243 @@
+import re
+import threading
+from core.db_pool import connection_pool
+
+# Small PEC dimensions re-joined by almost every fact query. Instead of joining them on the
+# server (and shipping the same professional/unit names on every row), the query fetches only
+# the integer key and the lookup happens here, against a local copy of the dimension.
+CACHED_DIMENSIONS = (
+    'tb_dim_profissional',
+    'tb_dim_cbo',
+    'tb_dim_unidade_saude',
+    'tb_dim_equipe',
+    'tb_dim_procedimento',
+    'tb_dim_sexo',
+    'tb_dim_tempo',
+)
+
+# Dimensions uploaded once per change as versioned reference documents in the dimension sync
+# mode (facts then carry their keys): table -> document name
+SYNCED_DIMENSIONS = {
+    'tb_dim_profissional': 'professionals',
+    'tb_dim_unidade_saude': 'units',
+    'tb_dim_cbo': 'cbos',
+    'tb_dim_procedimento': 'procedures',
+    'tb_dim_equipe': 'teams',
+}
+
+# Join line as written in the engine queries: [LEFT] JOIN tb_dim_x alias ON fact.co_dim_x = alias.co_seq_dim_x
+_JOIN_RE = re.compile(
+    r"^[ \t]*(LEFT[ \t]+)?JOIN[ \t]+(tb_dim_\w+)[ \t]+(\w+)[ \t]+ON[ \t]+(\w+\.\w+)[ \t]*=[ \t]*(\w+)\.(\w+)[ \t]*$",
+    re.IGNORECASE | re.MULTILINE
+)
+_ITEM_RE = r"^\s*{alias}\.(\w+)(?:\s+AS\s+(\w+))?\s*$"
+
+
+def _select_list_end(sql, start):
+    """Position of the FROM closing the outer SELECT list (skips subqueries and string literals)."""
+    depth = 0
+    in_string = False
+    for i in range(start, len(sql)):
+        c = sql[i]
+        if c == "'":
+            in_string = not in_string
+        elif in_string:
+            continue
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif depth == 0 and re.match(r"FROM\b", sql[i:i + 5], re.IGNORECASE) and not re.match(r"\w", sql[i - 1]):
+            return i
+    return -1
+
+
+def _split_items(select_list):
+    """Splits the SELECT list on top-level commas."""
+    items = []
+    depth = 0
+    in_string = False
+    current = []
+    for c in select_list:
+        if c == "'":
+            in_string = not in_string
+        elif not in_string:
+            if c == "(":
+                depth += 1
+            elif c == ")":
+                depth -= 1
+            elif c == "," and depth == 0:
+                items.append("".join(current))
+                current = []
+                continue
+        current.append(c)
+    items.append("".join(current))
+    return items
+
+
+class DimensionCache:
+    """
+    Local copy of the small PEC dimensions, per municipality database (host/port/db/user).
+    A table is only re-read when its row count or max key changes on the server.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._databases = {}  # db key -> {table: {'signature', 'key', 'columns', 'lookups'}}
+
+    def compile_query(self, sql):
+        """
+        Rewrites a query so it fetches only the key of the dimensions in CACHED_DIMENSIONS.
+        A join is only moved client-side when the dimension alias is used solely as plain items
+        of the outer SELECT (alias.column [AS name]); any other use (WHERE, COALESCE, another
+        join) keeps it on the server. Rewritten items keep their position and now carry the
+        foreign key. Returns {'sql', 'joins'}; with nothing to rewrite, the SQL is unchanged.
+        """
+        text = re.sub(r"--[^\n]*", "", sql)
+        start = re.search(r"\bSELECT\b", text, re.IGNORECASE)
+        end = _select_list_end(text, start.end()) if start else -1
+        if end < 0:
+            return {'sql': sql, 'joins': []}
+
+        items = _split_items(text[start.end():end])
+        rest = text[end:]
+        joins = []
+
+        for m in _JOIN_RE.finditer(rest):
+            left, table, alias, fact_key, on_alias, dim_key = m.groups()
+            if table.lower() not in CACHED_DIMENSIONS or on_alias != alias:
+                continue
+
+            line = m.group(0)
+            outside_join = text.replace(line, "", 1)
+            references = len(re.findall(rf"\b{alias}\.\w+", outside_join))
+            columns = []
+            for index, item in enumerate(items):
+                plain = re.match(_ITEM_RE.format(alias=alias), item, re.IGNORECASE)
+                if plain:
+                    columns.append((index, plain.group(1), plain.group(2) or plain.group(1)))
+            if not columns or len(columns) != references:
+                continue
+
+            for index, _, name in columns:
+                items[index] = f"\n                   {fact_key} AS {name}"
+            rest = re.sub(re.escape(line) + r"\n?", "", rest, count=1)
+            joins.append({
+                'table': table.lower(),
+                'key': dim_key,
+                'inner': not left,
+                'columns': columns,
+            })
+
+        if not joins:
+            return {'sql': sql, 'joins': []}
+        return {'sql': text[:start.end()] + ",".join(items).rstrip() + "\n            " + rest, 'joins': joins}
+
+    @staticmethod
+    def _needed(plans):
+        """{table: {'key', 'columns'}} of the dimensions the plans join client-side."""
+        needed = {}
+        for plan in plans:
+            for join in plan['joins']:
+                table = needed.setdefault(join['table'], {'key': join['key'], 'columns': set()})
+                table['columns'].update(column for _, column, _ in join['columns'])
+        return needed
+
+    def refresh(self, cur, mun_config, plans):
+        """
+        Makes sure the dimensions used by the plans are in memory. One query returns the row
+        count and max key of all of them; only tables whose signature changed (or that need
+        new columns) are re-read.
+        """
+        needed = self._needed(plans)
+        if not needed:
+            return []
+
+        cur.execute(" UNION ALL ".join(
+            f"SELECT '{table}', count(*), max({info['key']})::bigint FROM {table}"
+            for table, info in needed.items()
+        ))
+        signatures = {row[0]: (row[1], row[2]) for row in cur.fetchall()}
+
+        loaded = []
+        with self._lock:
+            cache = self._databases.setdefault(connection_pool.make_key(mun_config), {})
+            for table, info in needed.items():
+                current = cache.get(table)
+                if current and current['signature'] == signatures[table] and info['columns'] <= set(current['columns']):
+                    continue
+                columns = sorted(info['columns'] | set(current['columns'] if current else ()))
+                cur.execute(f"SELECT {info['key']}, {', '.join(columns)} FROM {table}")
+                rows = cur.fetchall()
+                cache[table] = {
+                    'signature': signatures[table],
+                    'key': info['key'],
+                    'columns': columns,
+                    'lookups': {column: {row[0]: row[i] for row in rows} for i, column in enumerate(columns, 1)},
+                }
+                loaded.append((table, len(rows)))
+        return loaded
+
+    def versions(self, cur, plans):
+        """
+        {table: {'key', 'columns', 'version'}} of the SYNCED_DIMENSIONS the plans use. The
+        version is an md5 of the columns the facts take from the table, computed on the server
+        in one query, so any edit (not only inserts) gives a new version.
+        """
+        needed = {table: info for table, info in self._needed(plans).items() if table in SYNCED_DIMENSIONS}
+        if not needed:
+            return {}
+        for info in needed.values():
+            info['columns'] = sorted(info['columns'])
+        cur.execute(" UNION ALL ".join(
+            f"SELECT '{table}', md5(string_agg(ROW({info['key']}, {', '.join(info['columns'])})::text, ',' ORDER BY {info['key']})) FROM {table}"
+            for table, info in needed.items()
+        ))
+        for table, version in cur.fetchall():
+            needed[table]['version'] = version or ''
+        return needed
+
+    def document(self, cur, table, info):
+        """Reference document of one synced dimension: its rows (key first) and version."""
+        cur.execute(f"SELECT {info['key']}, {', '.join(info['columns'])} FROM {table} ORDER BY {info['key']}")
+        return {
+            'dimension': SYNCED_DIMENSIONS[table],
+            'table': table,
+            'version': info['version'],
+            'columns': [info['key']] + info['columns'],
+            'rows': [list(row) for row in cur.fetchall()],
+        }
+
+    def lookup(self, mun_config, table, column):
+        """{key: value} of one cached dimension column."""
+        with self._lock:
+            return self._databases[connection_pool.make_key(mun_config)][table]['lookups'][column]
+
+    def apply(self, mun_config, rows, plan, synced=()):
+        """
+        Replaces the foreign keys in `rows` with the dimension values, one column at a time.
+        Inner joins drop rows without a match, as the JOIN did on the server. Joins on the
+        tables in `synced` (dimension sync mode) only filter: their columns keep the key.
+        """
+        if not rows or not plan['joins']:
+            return rows
+        with self._lock:
+            cache = self._databases.get(connection_pool.make_key(mun_config), {})
+
+        columns = [list(col) for col in zip(*rows)]
+        for join in plan['joins']:
+            lookups = cache[join['table']]['lookups']
+            keys = columns[join['columns'][0][0]]
+            if join['inner']:
+                known = lookups[join['columns'][0][1]]
+                keep = [key in known for key in keys]
+                columns = [[v for v, k in zip(col, keep) if k] for col in columns]
+                keys = columns[join['columns'][0][0]]
+            if join['table'] in synced:
+                continue
+            for index, column, _ in join['columns']:
+                columns[index] = list(map(lookups[column].get, keys))
+        return list(zip(*columns))
+
+
+# Singleton instance
+dimension_cache = DimensionCache()
@@ -1,21 +1,132 @@
 import os
+import re
+import json
 import sys
+import time
 import psycopg2
 import requests
+from core.db_pool import connection_pool
+from core.change_feed import LogicalChangeFeed
+from core.dim_cache import dimension_cache, SYNCED_DIMENSIONS
+from core.load_monitor import SourceLoadMonitor, BUSY, SATURATED, LEVEL_NAMES
+from core.record_builder import RecordBatch, PROC_CODE
+from core.row_store import row_store
+from core.schema_cache import schema_cache
+from version import __version__
 from datetime import datetime, timedelta
 from typing import List, Dict, Any, Callable, Optional, Generator
 
 DEFAULT_API_URL = 'https://southamerica-east1-probpa-025.cloudfunctions.net/ingestPecData'
 
+# Preflight (EXPLAIN): collections estimated above this many rows are read through a
+# server-side cursor, fetching roughly PREFLIGHT_FETCH_BYTES per round trip
+PREFLIGHT_STREAM_ROWS = 50000
+PREFLIGHT_FETCH_BYTES = 4 * 1024 * 1024
+
+# Per-query limits in seconds (0 disables), overridable per municipality with
+# 'statement_timeout' / 'lock_timeout': runaway or lock-blocked queries are aborted server-side
+DEFAULT_STATEMENT_TIMEOUT = 1800
+DEFAULT_LOCK_TIMEOUT = 30
+
+# Tables whose columns shape the vaccination, home visit and collective activity SQL.
+# Their fingerprint keys the compiled queries on disk; bump QUERY_CACHE_VERSION whenever
+# _build_queries changes, so cached SQL from the old code is not reused.
+PROBED_TABLES = [
+    'tb_fat_vacinacao_vacina',
+    'tb_fat_atendimento_domiciliar',
+    'tb_fat_atend_dom_prob_cond',
+    'tb_fat_atividade_coletiva',
+    'tb_fat_atvdd_coletiva_part',
+]
+QUERY_CACHE_VERSION = 1
+
+# Fact tables the queries only LEFT JOIN by primary key for descriptive columns: their changes
+# cannot add or remove records, so the change probe leaves them out of the signature. Any
+# citizen registration touches tb_fat_cidadao_pec; with it in the signature the probe would
+# almost never skip a collection. An edited citizen goes out with the next change to the facts.
+LOOKUP_FACT_TABLES = {'tb_fat_cidadao_pec'}
+
+# Incremental by insert sequence: once a collection has a full upload, each run reads the rows
+# whose fact table primary key (co_seq_*) is above the last one uploaded, whatever their
+# dt_registro, so late-arriving fichas are caught without re-reading old periods. The last
+# SEQUENCE_MARGIN ids are read again (transactions still open during the previous run may
+# commit lower ids later); the row store drops the ones already acknowledged.
+SEQUENCE_MARGIN = 1000
+DATE_FILTER = "tempo.dt_registro >= %s"
+
+# Load control ('load_control'): while the PEC is busy queries stream LOAD_BUSY_FETCH_ROWS per
+# fetch; while saturated the extraction pauses (at most 'load_pause_max' seconds in a row)
+LOAD_BUSY_FETCH_ROWS = 1000
+LOAD_PAUSE_MAX_SECONDS = 600
+
+# Logical decoding mode ('cdc'): each cycle reads the changes pending in a replication slot and
+# re-reads only the fact rows they touched, every CDC_INTERVAL_SECONDS (or 'cdc_interval').
+CDC_INTERVAL_SECONDS = 10
+CDC_CHANGES_PER_CYCLE = 20000
+# Child fact tables whose rows are part of a parent's records: a change in them re-reads the
+# parent row. (child column, parent table, parent column)
+CDC_PARENT_KEYS = {
+    'tb_fat_atd_ind_problemas': ('co_fat_atd_ind', 'tb_fat_atendimento_individual', 'co_seq_fat_atd_ind'),
+    'tb_fat_atend_odonto_proced': ('co_fat_atd_odnt', 'tb_fat_atendimento_odonto', 'co_seq_fat_atd_odnt'),
+    'tb_fat_vacinacao_vacina': ('co_fat_vacinacao', 'tb_fat_vacinacao', 'co_seq_fat_vacinacao'),
+}
+
+# Collections read from the same fact table with the same date filter. When all members are
+# due from the same start date, one query reads the table once and fan_out splits each fetched
+# chunk into the member collections (rows in the members' own column layout).
+SHARED_SCANS = [
+    {
+        'collections': ('odontology', 'odonto_procedures'),
+        'label': 'Odontology + Odonto Procedures (shared scan)',
+        'fan_out': '_fan_out_odonto',
+        # One row per (attendance, procedure); attendances without procedures come once with
+        # faop NULL. Columns 16-17: attendance key and whether the row carries a procedure.
+        'sql': """
+            SELECT fao.nu_uuid_ficha, prof.no_profissional, prof.nu_cns, cbo.nu_cbo,
+                   cid.no_cidadao, cid.nu_cns, sex.ds_sexo, cid.nu_cpf_cidadao, 
+                   fao.dt_nascimento, unid.nu_cnes, proc.co_proced, proc.ds_proced,
+                   tempo.dt_registro, 'ODONTO_PROCEDURE', NULL, NULL,
+                   fao.co_seq_fat_atd_odnt, faop.co_fat_atd_odnt IS NOT NULL
+            FROM tb_fat_atendimento_odonto fao
+            LEFT JOIN tb_fat_atend_odonto_proced faop ON faop.co_fat_atd_odnt = fao.co_seq_fat_atd_odnt
+            LEFT JOIN tb_dim_procedimento proc ON faop.co_dim_procedimento = proc.co_seq_dim_procedimento
+            LEFT JOIN tb_dim_profissional prof ON fao.co_dim_profissional_1 = prof.co_seq_dim_profissional
+            LEFT JOIN tb_dim_cbo cbo ON fao.co_dim_cbo_1 = cbo.co_seq_dim_cbo
+            LEFT JOIN tb_fat_cidadao_pec cid ON fao.co_fat_cidadao_pec = cid.co_seq_fat_cidadao_pec
+            LEFT JOIN tb_dim_unidade_saude unid ON fao.co_dim_unidade_saude_1 = unid.co_seq_dim_unidade_saude
+            LEFT JOIN tb_dim_tempo tempo ON fao.co_dim_tempo = tempo.co_seq_dim_tempo
+            LEFT JOIN tb_dim_sexo sex ON fao.co_dim_sexo = sex.co_seq_dim_sexo
+            WHERE tempo.dt_registro >= %s
+        """,
+    },
+]
+
+# Collections whose query LEFT JOINs the problem/condition table: one row per CID/CIAP of the
+# ficha. With the municipality's 'rollup_diagnoses' option, each ficha becomes one record
+# carrying its codes as arrays.
+ROLLUP_COLLECTIONS = ('consultations', 'home_visits')
+
 class PecConnectorEngine:
     def __init__(self, config_manager):
         self.config = config_manager
         self.aborted = False
+        self._active_conn = None
+        self._load_monitor = None
+        self._probed_columns = None
 
     def abort(self):
         self.aborted = True
+        # Interrupt the running query on the server instead of waiting for it to finish
+        conn = self._active_conn
+        if conn is not None and not conn.closed:
+            try:
+                conn.cancel()
+            except Exception:
+                pass
 
     def get_table_columns(self, cur, table_name):
+        if self._probed_columns is not None:
+            return set(self._probed_columns.get(table_name, ()))
         try:
             cur.execute("""
                 SELECT column_name 
@@ -62,314 +173,243 @@ class PecConnectorEngine:
                         try: minutes = int(interval_setting)
                         except: pass
                     
+                    if mun.get('cdc', False):
+                        minutes = mun.get('cdc_interval', CDC_INTERVAL_SECONDS) / 60
                     if (datetime.now() - last_attempt_dt).total_seconds() / 60 < minutes:
                         yield ('INFO', f"Aguardando próximo ciclo agendado...", mun_id)
                         continue
                 except:
                     pass
 
-            start_date = datetime.now() - timedelta(days=days_back)
-            is_incremental = False
+            default_start = datetime.now() - timedelta(days=days_back)
+            watermarks = mun.get("collection_watermarks") or {}
             
-            if last_run:
-                try:
-                    last_run_dt = datetime.fromisoformat(last_run)
-                    start_date = last_run_dt
-                    is_incremental = True
-                    yield ('INFO', f"Incremental Mode: Starting from last success ({start_date})", mun_id)
-                except:
-                    yield ('WARNING', "Failed to parse last run time. Defaulting to full days back.", mun_id)
+            if watermarks or last_run:
+                yield ('INFO', f"Incremental Mode: each collection starts from its own last acknowledged upload (last full success: {last_run or 'never'})", mun_id)
             else:
-                yield ('INFO', f"Full Load Mode: Starting from {days_back} days ago ({start_date.date()})", mun_id)
+                yield ('INFO', f"Full Load Mode: Starting from {days_back} days ago ({default_start.date()})", mun_id)
 
             conn = None
             try:
                 db_host = mun.get('db_host')
                 db_port = str(mun.get('db_port', '5432'))
-                db_name = mun.get('db_name', 'esus')
-                db_user = mun.get('db_user', 'postgres')
-                db_pass = mun.get('db_pass', 'postgres')
                 
                 yield ('INFO', f"Connecting to DB {db_host}:{db_port}...", mun_id)
-                conn = psycopg2.connect(
-                    host=db_host,
-                    port=db_port,
-                    dbname=db_name,
-                    user=db_user,
-                    password=db_pass,
-                    connect_timeout=10
-                )
+                # Warm connections are reused across municipalities on the same server and across cycles
+                conn = connection_pool.acquire(mun)
+                self._active_conn = conn
                 cur = conn.cursor()
+                if mun.get('load_control', True):
+                    # Samples the clinicians' sessions before each query and between fetches
+                    self._load_monitor = SourceLoadMonitor(mun, mun.get('load_active_sessions', 6), mun.get('load_lock_waits', 3))
                 
-                # --- EXTRACTION ---
-                all_rows = []
+                # --- EXTRACTION + SENDING (one collection at a time) ---
+                queries, from_cache = self._load_queries(cur)
+                if from_cache:
+                    yield ('INFO', "Schema unchanged since last run: reusing adapted queries.", mun_id)
+                # Current co_seq_* of each driving fact table, read before any extraction starts
+                sequences = {}
+                if mun.get('insert_sequences', True):
+                    try:
+                        sequences = self._current_sequences(cur, [q['sql'] for q in queries] + [s['sql'] for s in SHARED_SCANS])
+                    except Exception as e:
+                        conn.rollback()
+                        yield ('WARNING', f"Insert sequences unavailable, incremental runs by date: {e}", mun_id)
+                units = self._plan_shared_scans(queries, mun, default_start, sequences) if mun.get('shared_scans', True) else list(queries)
+                shared = [u for u in units if u.get('members')]
+                for unit in shared:
+                    yield ('INFO', f"Shared scan: {', '.join(unit['collections'])} read in a single query.", mun_id)
+                plans = {}
+                if mun.get('dimension_cache', True) or mun.get('dimension_sync', False):
+                    # Small dimensions are joined client-side from a per-database cache
+                    try:
+                        plans = {q['collection']: dimension_cache.compile_query(q['sql']) for q in queries + shared if q['sql']}
+                        for table, count in dimension_cache.refresh(cur, mun, plans.values()):
+                            yield ('INFO', f"   -> Dimension cache: loaded {count} rows from {table}.", mun_id)
+                    except Exception as e:
+                        conn.rollback()
+                        plans = {}
+                        yield ('WARNING', f"Dimension cache unavailable, joining on the server: {e}", mun_id)
+                # Dimension sync: dimensions go up as versioned documents and facts carry their keys
+                synced = set()
+                if mun.get('dimension_sync', False) and plans:
+                    for msg in self._sync_dimensions(cur, mun, mun_id, plans, synced): yield msg
+                # Change probe: insert/update/delete counters of each source fact table, one catalog query
+                signatures = {}
+                if mun.get('change_probe', True):
+                    try:
+                        signatures = self._table_signatures(cur, sorted({t for u in units if u['sql'] for t in self._probed_tables(u['sql'])}))
+                    except Exception as e:
+                        conn.rollback()
+                        yield ('WARNING', f"Change probe unavailable, extracting every collection: {e}", mun_id)
+                acknowledged = mun.get("collection_signatures") or {}
+                # Logical decoding: only the fact rows changed since the last acknowledged cycle are read
+                feed, cdc_lsn, cdc_changes = None, None, None
+                if mun.get('cdc', False):
+                    slot = mun.get('cdc_slot_name') or re.sub(r"\W", "_", f"probpa_{mun_id}").lower()[:63]
+                    tables = {t for sql in [q['sql'] for q in queries] + [s['sql'] for s in SHARED_SCANS] if sql for t in self._source_tables(sql)}
+                    feed = LogicalChangeFeed(conn, slot, mun.get('cdc_plugin', 'test_decoding'), tables)
+                    try:
+                        if feed.ensure():
+                            self.config.set_cdc_slot(mun_id, {'name': feed.slot, 'plugin': feed.plugin})
+                            yield ('INFO', f"Replication slot {feed.slot} ({feed.plugin}) created: this run reads by date, the next ones read its changes.", mun_id)
+                        else:
+                            cdc_lsn, events = feed.peek(mun.get('cdc_limit', CDC_CHANGES_PER_CYCLE))
+                            cdc_changes, deleted = self._cdc_changes(cur, events)
+                            yield ('INFO', f"Logical decoding: {len(events)} changes pending in {', '.join(sorted(cdc_changes)) or 'no tracked table'}.", mun_id)
+                            if deleted:
+                                yield ('WARNING', f"{deleted} deleted rows cannot be removed through the API and were ignored.", mun_id)
+                    except Exception as e:
+                        conn.rollback()
+                        feed, cdc_lsn, cdc_changes = None, None, None
+                        yield ('WARNING', f"Logical decoding unavailable, extracting by date: {e}", mun_id)
+                elif mun.get('cdc_slot'):
+                    # CDC turned off: drop the slot so the server stops retaining WAL for it
+                    slot = mun['cdc_slot']
+                    try:
+                        LogicalChangeFeed(conn, slot['name'], slot['plugin']).drop()
+                        self.config.set_cdc_slot(mun_id, None)
+                        yield ('INFO', f"Logical decoding off: replication slot {slot['name']} dropped.", mun_id)
+                    except Exception as e:
+                        conn.rollback()
+                        yield ('WARNING', f"Could not drop replication slot {slot['name']}: {e}", mun_id)
+                total_records = 0
                 
-                # QUERY 1: PROCEDIMENTOS REALIZADOS
-                if self.aborted: return
-                yield ('INFO', "[1/7] Querying Procedures...", mun_id)
-                sql_proc = """
-                    SELECT pap.nu_uuid_ficha as id, prof.no_profissional, prof.nu_cns, cbo.nu_cbo,
-                           cid.no_cidadao, cid.nu_cns, sex.ds_sexo, cid.nu_cpf_cidadao, 
-                           pap.dt_nascimento, unid.nu_cnes, proc.co_proced, proc.ds_proced,
-                           tempo.dt_registro, 'PROCEDURE' as type, NULL, NULL
-                    FROM tb_fat_proced_atend_proced pap
-                    LEFT JOIN tb_dim_profissional prof ON pap.co_dim_profissional = prof.co_seq_dim_profissional
-                    LEFT JOIN tb_dim_cbo cbo ON pap.co_dim_cbo = cbo.co_seq_dim_cbo
-                    LEFT JOIN tb_fat_cidadao_pec cid ON pap.co_fat_cidadao_pec = cid.co_seq_fat_cidadao_pec
-                    LEFT JOIN tb_dim_unidade_saude unid ON pap.co_dim_unidade_saude = unid.co_seq_dim_unidade_saude
-                    LEFT JOIN tb_dim_procedimento proc ON pap.co_dim_procedimento = proc.co_seq_dim_procedimento
-                    LEFT JOIN tb_dim_tempo tempo ON pap.co_dim_tempo = tempo.co_seq_dim_tempo
-                    LEFT JOIN tb_dim_sexo sex ON pap.co_dim_sexo = sex.co_seq_dim_sexo
-                    WHERE tempo.dt_registro >= %s
-                """
-                cur.execute(sql_proc, (start_date.date(),))
-                rows = cur.fetchall()
-                yield ('INFO', f"   -> Found {len(rows)} procedures.", mun_id)
-                all_rows.extend(rows)
-
-                # QUERY 2: CONSULTAS + DIAGNOSTICOS
-                if self.aborted: return
-                yield ('INFO', "[2/7] Querying Consultations...", mun_id)
-                sql_consult = """
-                    SELECT fai.nu_uuid_ficha, prof.no_profissional, prof.nu_cns, cbo.nu_cbo,
-                           cid.no_cidadao, cid.nu_cns, sex.ds_sexo, cid.nu_cpf_cidadao, 
-                           fai.dt_nascimento, unid.nu_cnes, 'CONSULTA', 'ATENDIMENTO INDIVIDUAL',
-                           tempo.dt_registro, 'CONSULTATION', dim_cid.nu_cid, dim_ciap.nu_ciap
-                    FROM tb_fat_atendimento_individual fai
-                    LEFT JOIN tb_dim_profissional prof ON fai.co_dim_profissional_1 = prof.co_seq_dim_profissional
-                    LEFT JOIN tb_dim_cbo cbo ON fai.co_dim_cbo_1 = cbo.co_seq_dim_cbo
-                    LEFT JOIN tb_fat_cidadao_pec cid ON fai.co_fat_cidadao_pec = cid.co_seq_fat_cidadao_pec
-                    LEFT JOIN tb_dim_unidade_saude unid ON fai.co_dim_unidade_saude_1 = unid.co_seq_dim_unidade_saude
-                    LEFT JOIN tb_dim_tempo tempo ON fai.co_dim_tempo = tempo.co_seq_dim_tempo
-                    LEFT JOIN tb_dim_sexo sex ON fai.co_dim_sexo = sex.co_seq_dim_sexo
-                    LEFT JOIN tb_fat_atd_ind_problemas prob ON fai.co_seq_fat_atd_ind = prob.co_fat_atd_ind
-                    LEFT JOIN tb_dim_cid dim_cid ON prob.co_dim_cid = dim_cid.co_seq_dim_cid
-                    LEFT JOIN tb_dim_ciap dim_ciap ON prob.co_dim_ciap = dim_ciap.co_seq_dim_ciap
-                    WHERE tempo.dt_registro >= %s
-                """
-                cur.execute(sql_consult, (start_date.date(),))
-                rows = cur.fetchall()
-                yield ('INFO', f"   -> Found {len(rows)} consultations.", mun_id)
-                all_rows.extend(rows)
-
-                # QUERY 3: ODONTOLOGIA
-                if self.aborted: return
-                yield ('INFO', "[3/7] Querying Odontology (Attendance)...", mun_id)
-                sql_odonto = """
-                    SELECT fao.nu_uuid_ficha, prof.no_profissional, prof.nu_cns, cbo.nu_cbo,
-                           cid.no_cidadao, cid.nu_cns, sex.ds_sexo, cid.nu_cpf_cidadao, 
-                           fao.dt_nascimento, unid.nu_cnes, 'ODONTO', 'ATENDIMENTO ODONTOLOGICO',
-                           tempo.dt_registro, 'ODONTOLOGY', NULL, NULL
-                    FROM tb_fat_atendimento_odonto fao
-                    LEFT JOIN tb_dim_profissional prof ON fao.co_dim_profissional_1 = prof.co_seq_dim_profissional
-                    LEFT JOIN tb_dim_cbo cbo ON fao.co_dim_cbo_1 = cbo.co_seq_dim_cbo
-                    LEFT JOIN tb_fat_cidadao_pec cid ON fao.co_fat_cidadao_pec = cid.co_seq_fat_cidadao_pec
-                    LEFT JOIN tb_dim_unidade_saude unid ON fao.co_dim_unidade_saude_1 = unid.co_seq_dim_unidade_saude
-                    LEFT JOIN tb_dim_tempo tempo ON fao.co_dim_tempo = tempo.co_seq_dim_tempo
-                    LEFT JOIN tb_dim_sexo sex ON fao.co_dim_sexo = sex.co_seq_dim_sexo
-                    WHERE tempo.dt_registro >= %s
-                """
-                cur.execute(sql_odonto, (start_date.date(),))
-                rows = cur.fetchall()
-                yield ('INFO', f"   -> Found {len(rows)} dental attendances.", mun_id)
-                all_rows.extend(rows)
-
-                # QUERY 4: VACINAÇÃO
-                if self.aborted: return
-                yield ('INFO', "[4/7] Querying Vaccination (Detailed)...", mun_id)
-                vac_cols = self.get_table_columns(cur, 'tb_fat_vacinacao_vacina')
-                via_join = ""
-                local_join = ""
-                details_concat = ""
-                has_via = False
-                if 'co_dim_via_adm_vacina' in vac_cols:
-                    via_join = "LEFT JOIN tb_dim_via_administracao via ON vac_item.co_dim_via_adm_vacina = via.co_seq_dim_via_administracao"
-                    has_via = True
-                elif 'co_dim_via_administracao' in vac_cols:
-                    via_join = "LEFT JOIN tb_dim_via_administracao via ON vac_item.co_dim_via_administracao = via.co_seq_dim_via_administracao"
-                    has_via = True
+                # A failed shared scan appends its members to `units`, so they still run on their own
+                for step, query in enumerate(units, 1):
+                    if self.aborted: return
+                    collection = query['collection']
+                    members = query.get('members') or [query]
+                    start_date = self._collection_start(mun, members[0]['collection'], default_start)
+                    yield ('INFO', f"[{step}/{len(units)}] Querying {query['label']}...", mun_id)
                     
-                has_local = False
-                if 'co_dim_local_apl_vacina' in vac_cols:
-                    local_join = "LEFT JOIN tb_dim_local_apl_vacina local ON vac_item.co_dim_local_apl_vacina = local.co_seq_dim_local_apl_vacina"
-                    has_local = True
-
-                if has_via and has_local:
-                    details_concat = ", ' (', COALESCE(via.no_via_administracao, '?'), ' / ', COALESCE(local.ds_local_apl_vacina, '?'), ')'"
-                elif has_via:
-                    details_concat = ", ' (', COALESCE(via.no_via_administracao, '?'), ')'"
-                elif has_local:
-                     details_concat = ", ' (', COALESCE(local.ds_local_apl_vacina, '?'), ')'"
-
-                sql_vac = f"""
-                    SELECT vac.nu_uuid_ficha, prof.no_profissional, prof.nu_cns, cbo.nu_cbo,
-                           cid.no_cidadao, cid.nu_cns, sex.ds_sexo, cid.nu_cpf_cidadao, 
-                           vac.dt_nascimento, unid.nu_cnes, 
-                           imuno.nu_identificador, 
-                           CONCAT(imuno.no_imunobiologico, ' - ', dose.no_dose_imunobiologico {details_concat}),
-                           tempo.dt_registro, 'VACCINATION', NULL, NULL
-                    FROM tb_fat_vacinacao vac
-                    LEFT JOIN tb_dim_profissional prof ON vac.co_dim_profissional = prof.co_seq_dim_profissional
-                    LEFT JOIN tb_dim_cbo cbo ON vac.co_dim_cbo = cbo.co_seq_dim_cbo
-                    LEFT JOIN tb_fat_cidadao_pec cid ON vac.co_fat_cidadao_pec = cid.co_seq_fat_cidadao_pec
-                    LEFT JOIN tb_dim_unidade_saude unid ON vac.co_dim_unidade_saude = unid.co_seq_dim_unidade_saude
-                    LEFT JOIN tb_dim_tempo tempo ON vac.co_dim_tempo = tempo.co_seq_dim_tempo
-                    LEFT JOIN tb_dim_sexo sex ON vac.co_dim_sexo = sex.co_seq_dim_sexo
-                    JOIN tb_fat_vacinacao_vacina vac_item ON vac.co_seq_fat_vacinacao = vac_item.co_fat_vacinacao
-                    LEFT JOIN tb_dim_imunobiologico imuno ON vac_item.co_dim_imunobiologico = imuno.co_seq_dim_imunobiologico
-                    LEFT JOIN tb_dim_dose_imunobiologico dose ON vac_item.co_dim_dose_imunobiologico = dose.co_seq_dim_dose_imunobiologico
-                    {via_join}
-                    {local_join}
-                    WHERE tempo.dt_registro >= %s
-                """
-                cur.execute(sql_vac, (start_date.date(),))
-                rows = cur.fetchall()
-                yield ('INFO', f"   -> Found {len(rows)} vaccinations.", mun_id)
-                all_rows.extend(rows)
-
-                # QUERY 5: ODONTO PROCEDURES
-                if self.aborted: return
-                yield ('INFO', "[5/7] Querying Odonto Procedures...", mun_id)
-                try:
-                    sql_odonto_proc = """
-                        SELECT fao.nu_uuid_ficha, prof.no_profissional, prof.nu_cns, cbo.nu_cbo,
-                               cid.no_cidadao, cid.nu_cns, sex.ds_sexo, cid.nu_cpf_cidadao, 
-                               fao.dt_nascimento, unid.nu_cnes, proc.co_proced, proc.ds_proced,
-                               tempo.dt_registro, 'ODONTO_PROCEDURE', NULL, NULL
-                        FROM tb_fat_atend_odonto_proced faop
-                        JOIN tb_fat_atendimento_odonto fao ON faop.co_fat_atd_odnt = fao.co_seq_fat_atd_odnt
-                        LEFT JOIN tb_dim_procedimento proc ON faop.co_dim_procedimento = proc.co_seq_dim_procedimento
-                        LEFT JOIN tb_dim_profissional prof ON fao.co_dim_profissional_1 = prof.co_seq_dim_profissional
-                        LEFT JOIN tb_dim_cbo cbo ON fao.co_dim_cbo_1 = cbo.co_seq_dim_cbo
-                        LEFT JOIN tb_fat_cidadao_pec cid ON fao.co_fat_cidadao_pec = cid.co_seq_fat_cidadao_pec
-                        LEFT JOIN tb_dim_unidade_saude unid ON fao.co_dim_unidade_saude_1 = unid.co_seq_dim_unidade_saude
-                        LEFT JOIN tb_dim_tempo tempo ON fao.co_dim_tempo = tempo.co_seq_dim_tempo
-                        LEFT JOIN tb_dim_sexo sex ON fao.co_dim_sexo = sex.co_seq_dim_sexo
-                        WHERE tempo.dt_registro >= %s
-                    """
-                    cur.execute(sql_odonto_proc, (start_date.date(),))
-                    rows = cur.fetchall()
-                    yield ('INFO', f"   -> Found {len(rows)} dental procedures.", mun_id)
-                    all_rows.extend(rows)
-                except Exception as e:
-                    conn.rollback()
-                    yield ('WARNING', f"Skipping Odonto Procedures (Error): {e}", mun_id)
-
-                # QUERY 6: ATENDIMENTO DOMICILIAR
-                if self.aborted: return
-                yield ('INFO', "[6/7] Querying Home Visits...", mun_id)
-                try:
-                    dom_cols = self.get_table_columns(cur, 'tb_fat_atendimento_domiciliar')
-                    dom_pk = next((c for c in dom_cols if c.startswith('co_seq_')), 'co_seq_fat_atendimento_domiciliar')
+                    if query.get('warning'):
+                        yield ('WARNING', query['warning'], mun_id)
+                    if query['sql'] is None:
+                        continue
+
+                    signature = {t: signatures[t] for t in self._probed_tables(query['sql']) if t in signatures} if signatures else None
+                    if signature and all(acknowledged.get(m['collection']) == signature for m in members):
+                        # Nothing inserted, updated or deleted in its tables since the last acknowledged upload
+                        yield ('INFO', f"   -> No changes in {', '.join(signature)} since last upload: skipped.", mun_id)
+                        skipped_at = datetime.now().isoformat()
+                        for member in members:
+                            self.config.set_collection_watermark(mun_id, member['collection'], skipped_at, signature)
+                        continue
+                    
+                    plan = plans.get(collection)
+                    sql = plan['sql'] if plan else query['sql']
+                    # A shared scan's fan_out rebuilds some positions per member (literals instead of a join)
+                    refs = {m['collection']: self._dimension_refs(mun, plan, plans.get(m['collection']) if query.get('members') else plan, synced)
+                            for m in members}
+                    params = (start_date.date(),)
+                    table, alias = self._driving_table(query['sql'])
+                    since = self._sequence_since(mun, members, table) if table in sequences else None
+                    if cdc_changes is not None and DATE_FILTER in sql:
+                        keys = cdc_changes.get(table)
+                        if not keys:
+                            yield ('INFO', f"   -> No changes in {table} since the last cycle.", mun_id)
+                            continue
+                        sql = sql.replace(DATE_FILTER, "(" + " OR ".join(f"{alias}.{column} = ANY(%s)" for column in keys) + ")", 1)
+                        params = tuple(sorted(values) for values in keys.values())
+                        yield ('INFO', f"   -> Re-reading {sum(len(v) for v in keys.values())} changed {table} rows.", mun_id)
+                    elif since is not None:
+                        key = sequences[table][0]
+                        sql = sql.replace(DATE_FILTER, f"{alias}.{key} > %s", 1)
+                        params = (max(since - mun.get('sequence_margin', SEQUENCE_MARGIN), 0),)
+                        yield ('INFO', f"   -> Rows inserted after {table}.{key} = {since} (any attendance date).", mun_id)
                     
-                    adpc_join = ""
-                    adpc_selects = "dim_cid.nu_cid, dim_ciap.nu_ciap"
-                    adpc_cols = self.get_table_columns(cur, 'tb_fat_atend_dom_prob_cond')
+                    for msg in self._throttle(mun, mun_id): yield msg
+                    if self.aborted: return
+                    estimate = self._explain(cur, sql, params) if mun.get('preflight', True) else None
+                    fetch_size = None
+                    estimated = ""
+                    if estimate:
+                        estimated = f" (estimated ~{estimate['rows']}, cost {estimate['cost']:.0f})"
+                        if estimate['rows'] > PREFLIGHT_STREAM_ROWS:
+                            fetch_size = self._fetch_size(estimate)
+                            yield ('INFO', f"   -> Large result{estimated}: streaming {fetch_size} rows per fetch.", mun_id)
+                    if self._load_monitor and self._load_monitor.last[0] >= BUSY:
+                        # Short fetches, with a load check between them
+                        fetch_size = min(fetch_size or LOAD_BUSY_FETCH_ROWS, LOAD_BUSY_FETCH_ROWS)
                     
-                    if adpc_cols:
-                        fk_candidates = ['co_fat_atendimento_domiciliar', 'co_fat_atd_dom', 'co_fat_atd_domiciliar']
-                        adpc_fk = next((c for c in fk_candidates if c in adpc_cols), None)
-                        
-                        if not adpc_fk:
-                             adpc_pk_guess = next((c for c in adpc_cols if c.startswith('co_seq_')), None)
-                             adpc_fk = next((c for c in adpc_cols if 'fat' in c and ('dom' in c or 'atd' in c) and c != adpc_pk_guess), None)
-
-                        if adpc_fk:
-                            adpc_join = f"""
-                                LEFT JOIN tb_fat_atend_dom_prob_cond adpc ON fad.{dom_pk} = adpc.{adpc_fk}
-                                LEFT JOIN tb_dim_cid dim_cid ON adpc.co_dim_cid = dim_cid.co_seq_dim_cid
-                                LEFT JOIN tb_dim_ciap dim_ciap ON adpc.co_dim_ciap = dim_ciap.co_seq_dim_ciap
-                            """
+                    collection_started = datetime.now()
+                    found = {m['collection']: 0 for m in members}
+                    sent_ok = {m['collection']: True for m in members}
+                    # Records identical to the last acknowledged version are not uploaded again
+                    probes = {m['collection']: row_store.load_probe(mun_id, m['collection']) if mun.get('skip_unchanged', True) else None
+                              for m in members}
+                    skipped = [0]
+                    fan_out_state = set()
+                    # Per rolled-up collection: codes already sent per ficha, and rows in / records out
+                    rollups = {m['collection']: {} for m in members
+                               if mun.get('rollup_diagnoses', False) and m['collection'] in ROLLUP_COLLECTIONS}
+                    rolled = {c: [0, 0] for c in rollups}
+                    try:
+                        self._set_query_limits(cur, mun)
+                        for rows in self._iter_rows(conn, cur, sql, params, fetch_size):
+                            if plan:
+                                rows = dimension_cache.apply(mun, rows, plan, synced)
+                            outputs = getattr(self, query['fan_out'])(rows, fan_out_state) if query.get('members') else {collection: rows}
+                            for member in members:
+                                member_rows = outputs[member['collection']]
+                                if member['collection'] in rollups:
+                                    rolled[member['collection']][0] += len(member_rows)
+                                    member_rows = self._roll_up_diagnoses(member_rows, rollups[member['collection']])
+                                    rolled[member['collection']][1] += len(member_rows)
+                                found[member['collection']] += len(member_rows)
+                                if fetch_size is None:
+                                    yield ('INFO', f"   -> Found {len(member_rows)} {member['noun']}{estimated}.", mun_id)
+                                for msg in self._send_batch(member_rows, mun, member['collection'], probes[member['collection']], skipped,
+                                                            rolled_up=member['collection'] in rollups, refs=refs[member['collection']]):
+                                    if msg[0] == 'ERROR': sent_ok[member['collection']] = False
+                                    yield msg
+                                if self.aborted: return
+                            for msg in self._throttle(mun, mun_id): yield msg
+                            if self.aborted: return
+                    except Exception as e:
+                        conn.rollback()
+                        if self.aborted: return
+                        if query.get('members'):
+                            yield ('WARNING', f"Shared scan failed ({e}): querying {', '.join(query['collections'])} separately.", mun_id)
+                            units.extend(query['members'])
+                        elif query['optional']:
+                            yield ('WARNING', f"Skipping {query['label']} (Error): {e}", mun_id)
                         else:
-                             yield ('WARNING', f"Skipping Home Visit Details: FK not found. Avail: {str(list(adpc_cols))}", mun_id)
-                             adpc_selects = "NULL as nu_cid, NULL as nu_ciap"
-                    else:
-                        adpc_selects = "NULL as nu_cid, NULL as nu_ciap"
-
-                    sql_domiciliar = f"""
-                        SELECT fad.nu_uuid_ficha, prof.no_profissional, prof.nu_cns, cbo.nu_cbo,
-                               cid.no_cidadao, cid.nu_cns, sex.ds_sexo, cid.nu_cpf_cidadao, 
-                               fad.dt_nascimento, unid.nu_cnes, 'DOMICILIAR', 'VISITA DOMICILIAR',
-                               tempo.dt_registro, 'HOME_VISIT', {adpc_selects}
-                        FROM tb_fat_atendimento_domiciliar fad
-                        LEFT JOIN tb_dim_profissional prof ON fad.co_dim_profissional_1 = prof.co_seq_dim_profissional
-                        LEFT JOIN tb_dim_cbo cbo ON fad.co_dim_cbo_1 = cbo.co_seq_dim_cbo
-                        LEFT JOIN tb_fat_cidadao_pec cid ON fad.co_fat_cidadao_pec = cid.co_seq_fat_cidadao_pec
-                        LEFT JOIN tb_dim_unidade_saude unid ON fad.co_dim_unidade_saude_1 = unid.co_seq_dim_unidade_saude
-                        LEFT JOIN tb_dim_tempo tempo ON fad.co_dim_tempo = tempo.co_seq_dim_tempo
-                        LEFT JOIN tb_dim_sexo sex ON fad.co_dim_sexo = sex.co_seq_dim_sexo
-                        {adpc_join}
-                        WHERE tempo.dt_registro >= %s
-                    """
-                    cur.execute(sql_domiciliar, (start_date.date(),))
-                    rows = cur.fetchall()
-                    yield ('INFO', f"   -> Found {len(rows)} home visits.", mun_id)
-                    all_rows.extend(rows)
-                except Exception as e:
-                    conn.rollback()
-                    yield ('WARNING', f"Skipping Home Visits (Error): {e}", mun_id)
-
-                # QUERY 7: ATIVIDADE COLETIVA
-                if self.aborted: return
-                yield ('INFO', "[7/7] Querying Collective Activity...", mun_id)
-                try:
-                    fac_cols = self.get_table_columns(cur, 'tb_fat_atividade_coletiva')
-                    part_cols = self.get_table_columns(cur, 'tb_fat_atvdd_coletiva_part')
-
-                    if fac_cols and part_cols:
-                        fac_pk = 'co_seq_fat_atvdd_coletiva' if 'co_seq_fat_atvdd_coletiva' in fac_cols else 'co_seq_fat_atividade_coletiva'
-                        part_fk = 'co_fat_atvdd_coletiva' if 'co_fat_atvdd_coletiva' in part_cols else 'co_fat_atividade_coletiva'
-                        
-                        possible_prof_cols = ['co_dim_profissional_responsavel', 'co_dim_profissional_1', 'co_dim_profissional']
-                        prof_col = next((c for c in possible_prof_cols if c in fac_cols), None)
-                        
-                        proc_col = 'co_dim_procedimento' if 'co_dim_procedimento' in fac_cols else None
-                        proc_join = ""
-                        proc_select_code = "'ATIV_COLETIVA'"
-                        proc_select_name = "'ATIVIDADE COLETIVA'"
-                        
-                        if proc_col:
-                            proc_join = f"LEFT JOIN tb_dim_procedimento proc ON fac.{proc_col} = proc.co_seq_dim_procedimento"
-                            proc_select_code = "COALESCE(proc.co_proced, 'ATIV_COLETIVA')"
-                            proc_select_name = "COALESCE(proc.ds_proced, 'ATIVIDADE COLETIVA')"
-                        
-                        if not prof_col:
-                             yield ('WARNING', "Skipping Collective: Could not find professional column.", mun_id)
+                            has_error = True
+                            yield ('ERROR', f"Falha ao consultar {query['label']}: {e}", mun_id)
+                        continue
+                    
+                    if fetch_size is not None:
+                        for member in members:
+                            yield ('INFO', f"   -> Found {found[member['collection']]} {member['noun']}{estimated}.", mun_id)
+                    for name, (rows_in, records_out) in rolled.items():
+                        if rows_in > records_out:
+                            yield ('INFO', f"   -> {rows_in} diagnosis rows rolled up into {records_out} {name} records.", mun_id)
+                    if skipped[0]:
+                        yield ('INFO', f"   -> {skipped[0]} unchanged since last upload, not re-sent.", mun_id)
+                    total_records += sum(found.values())
+                    
+                    if self.aborted: return
+                    for member in members:
+                        if sent_ok[member['collection']]:
+                            # Only this collection moves forward; a failure elsewhere no longer forces it to be redone
+                            sequence = (table, sequences[table][1]) if table in sequences else None
+                            self.config.set_collection_watermark(mun_id, member['collection'], collection_started.isoformat(), signature, sequence)
                         else:
-                            sql_collective = f"""
-                                SELECT fac.nu_uuid_ficha, prof.no_profissional, prof.nu_cns, NULL,
-                                       cid.no_cidadao, cid.nu_cns, sex.ds_sexo, cid.nu_cpf_cidadao, 
-                                       tempo_nasc.dt_registro, NULL, {proc_select_code}, {proc_select_name},
-                                       tempo.dt_registro, 'COLLECTIVE_ACTIVITY', NULL, NULL
-                                FROM tb_fat_atividade_coletiva fac
-                                JOIN tb_fat_atvdd_coletiva_part part ON fac.{fac_pk} = part.{part_fk}
-                                LEFT JOIN tb_dim_profissional prof ON fac.{prof_col} = prof.co_seq_dim_profissional
-                                LEFT JOIN tb_fat_cidadao_pec cid ON part.co_fat_cidadao_pec = cid.co_seq_fat_cidadao_pec
-                                LEFT JOIN tb_dim_tempo tempo ON fac.co_dim_tempo = tempo.co_seq_dim_tempo
-                                LEFT JOIN tb_dim_sexo sex ON cid.co_dim_sexo = sex.co_seq_dim_sexo
-                                LEFT JOIN tb_dim_tempo tempo_nasc ON cid.co_dim_tempo_nascimento = tempo_nasc.co_seq_dim_tempo
-                                {proc_join}
-                                WHERE tempo.dt_registro >= %s
-                            """
-                            cur.execute(sql_collective, (start_date.date(),))
-                            rows = cur.fetchall()
-                            yield ('INFO', f"   -> Found {len(rows)} collective participants.", mun_id)
-                            all_rows.extend(rows)
-                except Exception as e:
-                    conn.rollback()
-                    yield ('WARNING', f"Skipping Collective Activity (Error/Schema): {e}", mun_id)
-
-                # --- SENDING ---
-                if self.aborted: return
-                yield ('INFO', f"[TOTAL] Processing {len(all_rows)} records for {mun_name}...", mun_id)
-                
-                for msg in self._send_batch(all_rows, mun):
-                    if msg[0] == 'ERROR': has_error = True
-                    yield msg
+                            has_error = True
+
+                if feed is not None and cdc_lsn and not self.aborted and not has_error:
+                    # Everything the changes touched was acknowledged: release them from the slot
+                    feed.advance(cdc_lsn)
+
+                yield ('INFO', f"[TOTAL] Processed {total_records} records for {mun_name}.", mun_id)
                 
                 if not self.aborted and not has_error:
                     self.config.set_municipality_last_run(mun_id, datetime.now().isoformat())
                     yield ('INFO', f"=== Extração Finalizada com Sucesso para {mun_name} ===", mun_id)
+                elif not self.aborted:
+                    yield ('ERROR', f"Erro de extração em {mun_name}: uma ou mais coleções falharam (as demais avançaram normalmente).", mun_id)
 
             except Exception as e:
                 has_error = True
@@ -377,7 +417,11 @@ class PecConnectorEngine:
                 if conn: conn.rollback()
             finally:
                 self.config.set_municipality_last_attempt(mun_id, datetime.now().isoformat())
-                if conn: conn.close()
+                self._active_conn = None
+                if self._load_monitor:
+                    self._load_monitor.close()
+                    self._load_monitor = None
+                if conn: connection_pool.release(mun, conn)
                 if self.aborted:
                     yield ('WARNING', "Processo abortado pelo usuário durante a iteração.", mun_id)
                     break
@@ -385,60 +429,635 @@ class PecConnectorEngine:
         if not self.aborted:
             yield ('SUCCESS', "Ciclo de Extração Centralizada Completo.", None)
 
+    def _throttle(self, mun, mun_id):
+        """
+        Load check before each query and between fetches: yields a message when the PEC load
+        level changes and sleeps while it is saturated, for at most 'load_pause_max' seconds
+        in a row (then carries on at the busy pace, so the run still finishes).
+        """
+        monitor = self._load_monitor
+        if monitor is None:
+            return
+        started = time.monotonic()
+        previous = monitor.last[0]
+        while not self.aborted:
+            try:
+                level, active, lock_waits = monitor.sample()
+            except Exception as e:
+                monitor.close()
+                self._load_monitor = None
+                yield ('WARNING', f"Load control unavailable (pg_stat_activity): {e}", mun_id)
+                return
+            if level != previous:
+                yield ('INFO', f"   -> PEC {LEVEL_NAMES[level]}: {active} active sessions, {lock_waits} waiting for locks.", mun_id)
+                previous = level
+            if level < SATURATED:
+                return
+            if time.monotonic() - started >= mun.get('load_pause_max', LOAD_PAUSE_MAX_SECONDS):
+                yield ('WARNING', "   -> PEC still saturated: resuming at a reduced pace.", mun_id)
+                return
+            time.sleep(1)
+
+    def _set_query_limits(self, cur, mun):
+        # Transaction-local (is_local = true), so the pooled connection goes back without them
+        cur.execute(
+            "SELECT set_config('statement_timeout', %s, true), set_config('lock_timeout', %s, true)",
+            (f"{int(mun.get('statement_timeout', DEFAULT_STATEMENT_TIMEOUT))}s",
+             f"{int(mun.get('lock_timeout', DEFAULT_LOCK_TIMEOUT))}s")
+        )
+
+    def _explain(self, cur, sql, params):
+        """
+        Preflight for one query: EXPLAIN (FORMAT JSON) without running it.
+        Returns {'rows', 'cost', 'width'} or None when the plan is not available.
+        """
+        try:
+            cur.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+            plan = cur.fetchone()[0][0]['Plan']
+            return {'rows': plan['Plan Rows'], 'cost': plan['Total Cost'], 'width': plan['Plan Width']}
+        except Exception:
+            cur.connection.rollback()
+            return None
+
+    def _fetch_size(self, estimate):
+        # Multiple of the upload batch (100) so every fetch turns into full batches
+        rows = PREFLIGHT_FETCH_BYTES // max(estimate['width'], 1)
+        return max(1000, min(20000, rows // 100 * 100))
+
+    def _iter_rows(self, conn, cur, sql, params, fetch_size=None):
+        """
+        Yields the query result: all at once (fetch_size None, as before) or in chunks of
+        fetch_size rows through a server-side cursor, so large collections never sit whole in memory.
+        """
+        if fetch_size is None:
+            cur.execute(sql, params)
+            yield cur.fetchall()
+            return
+        with conn.cursor(name=f"probpa_{os.getpid()}_{id(self)}") as named:
+            named.itersize = fetch_size
+            named.execute(sql, params)
+            while True:
+                rows = named.fetchmany(fetch_size)
+                if not rows:
+                    break
+                yield rows
+
+    def _collection_start(self, mun, collection, default_start):
+        """
+        Start date for one collection: its own watermark, else the legacy municipality-wide
+        last_run_success, else the configured days_back window.
+        """
+        watermark = (mun.get("collection_watermarks") or {}).get(collection) or mun.get("last_run_success")
+        if watermark:
+            try:
+                return datetime.fromisoformat(watermark)
+            except ValueError:
+                pass
+        return default_start
+
+    @staticmethod
+    def _driving_table(sql):
+        """(table, alias) of the fact table the query starts FROM, or (None, None)."""
+        m = re.search(r"\bFROM\s+(tb_fat_\w+)\s+(\w+)", sql or "")
+        return m.groups() if m else (None, None)
+
+    def _primary_keys(self, cur, tables):
+        """Single-column primary key of each table: {table: column}."""
+        cur.execute("""
+            SELECT c.relname, a.attname
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indrelid
+            JOIN pg_namespace n ON n.oid = c.relnamespace AND n.nspname = 'public'
+            JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = i.indkey[0]
+            WHERE i.indisprimary AND i.indnatts = 1 AND c.relname = ANY(%s)
+        """, (list(tables),))
+        return dict(cur.fetchall())
+
+    def _current_sequences(self, cur, sqls):
+        """
+        {table: (primary key, current max)} for the fact table each query is driven by. Only
+        queries that still carry DATE_FILTER can be switched to the sequence filter.
+        """
+        tables = sorted({self._driving_table(sql)[0] for sql in sqls if sql and DATE_FILTER in sql} - {None})
+        if not tables:
+            return {}
+        sequences = {}
+        for table, column in self._primary_keys(cur, tables).items():
+            cur.execute(f"SELECT COALESCE(max({column}), 0) FROM {table}")
+            sequences[table] = (column, int(cur.fetchone()[0]))
+        return sequences
+
+    def _cdc_changes(self, cur, events):
+        """
+        Groups slot events into {fact table: {key column: set(values)}} to re-read, and counts
+        deletes (the API has no removals). A child row (CDC_PARENT_KEYS) also marks its parent;
+        for a deleted child that needs REPLICA IDENTITY FULL, otherwise only its key is logged.
+        """
+        keys = self._primary_keys(cur, sorted({table for table, _, _ in events}))
+        changes = {}
+        deleted = 0
+        for table, operation, columns in events:
+            key = keys.get(table)
+            if operation == 'DELETE':
+                deleted += table not in CDC_PARENT_KEYS
+            elif key and columns.get(key) is not None:
+                changes.setdefault(table, {}).setdefault(key, set()).add(int(columns[key]))
+            parent = CDC_PARENT_KEYS.get(table)
+            if parent and columns.get(parent[0]) is not None:
+                changes.setdefault(parent[1], {}).setdefault(parent[2], set()).add(int(columns[parent[0]]))
+        return changes, deleted
+
+    @staticmethod
+    def _sequence_since(mun, members, table):
+        """
+        Lowest uploaded sequence of `table` among the members, or None while any of them has
+        none yet (first load, or last uploaded from another table): those run by date.
+        """
+        stored = [((mun.get("collection_sequences") or {}).get(m['collection']) or {}).get(table) for m in members]
+        return None if any(v is None for v in stored) else min(stored)
+
+    @staticmethod
+    def _source_tables(sql):
+        """Fact tables a query reads."""
+        return sorted(set(re.findall(r"\btb_fat_\w+", sql)))
+
+    @classmethod
+    def _probed_tables(cls, sql):
+        """Source tables whose changes the change probe looks at (LOOKUP_FACT_TABLES left out)."""
+        return [t for t in cls._source_tables(sql) if t not in LOOKUP_FACT_TABLES]
+
+    def _table_signatures(self, cur, tables):
+        """
+        Change signature per table: ['stat', inserts, updates, deletes] from pg_stat_user_tables,
+        or ['max', max primary key] when the server does not track counts (inserts only).
+        Any difference from the acknowledged signature means the table changed.
+        """
+        if not tables:
+            return {}
+        cur.execute("SELECT current_setting('track_counts')")
+        signatures = {}
+        if cur.fetchone()[0] == 'on':
+            cur.execute("""
+                SELECT relname, n_tup_ins, n_tup_upd, n_tup_del
+                FROM pg_stat_user_tables
+                WHERE schemaname = 'public' AND relname = ANY(%s)
+            """, (tables,))
+            signatures = {row[0]: ['stat', row[1], row[2], row[3]] for row in cur.fetchall()}
+
+        missing = [t for t in tables if t not in signatures]
+        if missing:
+            for table, column in self._primary_keys(cur, missing).items():
+                cur.execute(f"SELECT max({column})::text FROM {table}")
+                signatures[table] = ['max', cur.fetchone()[0]]
+        return signatures
 
-    def _send_batch(self, rows, mun_config):
+    def _plan_shared_scans(self, queries, mun, default_start, sequences=None):
+        """
+        Returns the extraction units: the queries, with each SHARED_SCANS group whose members are
+        all present, supported by this schema and due from the same point (start date, or all
+        of them by insert sequence) replaced by a single shared query (at the position of its
+        first member).
+        """
+        by_collection = {q['collection']: q for q in queries}
+        units = list(queries)
+        for scan in SHARED_SCANS:
+            members = [by_collection.get(c) for c in scan['collections']]
+            if any(m is None or m['sql'] is None or m.get('warning') for m in members):
+                continue
+            table = self._driving_table(scan['sql'])[0]
+            by_sequence = {self._sequence_since(mun, [m], table) is not None for m in members} if table in (sequences or {}) else {False}
+            if len(by_sequence) > 1:
+                continue
+            # By date, the start dates are what must match; by sequence the lowest one is read
+            # (rows a member already has are dropped by the row store)
+            if by_sequence == {False} and len({self._collection_start(mun, m['collection'], default_start).date() for m in members}) > 1:
+                continue
+            units[units.index(members[0])] = {
+                'collection': '+'.join(scan['collections']),
+                'collections': scan['collections'],
+                'label': scan['label'],
+                'noun': 'rows',
+                'sql': scan['sql'],
+                'optional': False,
+                'fan_out': scan['fan_out'],
+                'members': members,
+            }
+            for member in members[1:]:
+                units.remove(member)
+        return units
+
+    def _fan_out_odonto(self, rows, seen):
+        """
+        Splits the shared odonto scan: every row with a procedure is an ODONTO_PROCEDURE record
+        and each attendance yields one ODONTOLOGY record (`seen` keeps the attendance keys
+        already emitted across fetches).
+        """
+        attendances, procedures = [], []
+        for row in rows:
+            if row[17]:
+                procedures.append(row[:16])
+            if row[16] not in seen:
+                seen.add(row[16])
+                attendances.append(row[:10] + ('ODONTO', 'ATENDIMENTO ODONTOLOGICO', row[12], 'ODONTOLOGY', None, None))
+        return {'odontology': attendances, 'odonto_procedures': procedures}
+
+    def _sync_dimensions(self, cur, mun, mun_id, plans, synced):
+        """
+        Uploads each synced dimension the plans use whose version differs from the one in the
+        municipality's ledger (dimension_versions) and adds to `synced` those the API has at
+        their current version. A dimension that fails to upload is joined as usual this run.
+        """
+        ledger = mun.get('dimension_versions') or {}
+        try:
+            versions = dimension_cache.versions(cur, plans.values())
+            for table, info in versions.items():
+                if ledger.get(table) == info['version']:
+                    synced.add(table)
+                    continue
+                document = dimension_cache.document(cur, table, info)
+                if self._post_document(document, mun):
+                    self.config.set_dimension_version(mun_id, table, info['version'])
+                    synced.add(table)
+                    yield ('INFO', f"   -> Dimension {document['dimension']}: version {info['version'][:8]} uploaded ({len(document['rows'])} rows).", mun_id)
+                else:
+                    yield ('WARNING', f"Dimension {document['dimension']} upload failed: its values stay in the records this run.", mun_id)
+        except Exception as e:
+            cur.connection.rollback()
+            synced.clear()
+            yield ('WARNING', f"Dimension sync unavailable, records carry the dimension values: {e}", mun_id)
+            return
+        if synced:
+            yield ('INFO', f"Dimension sync: records carry the keys of {', '.join(SYNCED_DIMENSIONS[t] for t in sorted(synced))}.", mun_id)
+
+    @staticmethod
+    def _dimension_refs(mun, plan, layout, synced):
+        """
+        RecordBatch refs of a collection: positions that keep a synced dimension's key after
+        `plan` was applied and that the collection's own plan (`layout`) also joins.
+        """
+        if not plan or not layout or not synced:
+            return None
+        joined = {(join['table'], index) for join in layout['joins'] for index, _, _ in join['columns']}
+        refs = {}
+        for join in plan['joins']:
+            if join['table'] in synced:
+                for index, column, _ in join['columns']:
+                    if (join['table'], index) not in joined:
+                        continue
+                    # Only the procedure code is looked up (the externalId keeps it)
+                    values = dimension_cache.lookup(mun, join['table'], column) if index == PROC_CODE else None
+                    refs[index] = (join['table'], column, values)
+        return refs or None
+
+    def _roll_up_diagnoses(self, rows, emitted):
+        """
+        Folds the rows of each ficha (one per CID/CIAP, columns 14-15) into a single row carrying
+        the distinct codes as sorted tuples. `emitted` keeps the codes already sent per ficha
+        across fetches: a ficha whose rows straddle two fetches is sent again with all of them.
+        """
+        groups = {}
+        for row in rows:
+            group = groups.get(row[0])
+            if group is None:
+                group = groups[row[0]] = (row, set(), set())
+            if row[14]: group[1].add(row[14])
+            if row[15]: group[2].add(row[15])
+        rolled = []
+        for ficha, (row, cids, ciaps) in groups.items():
+            previous = emitted.get(ficha)
+            if previous is not None:
+                if cids <= previous[0] and ciaps <= previous[1]:
+                    continue
+                cids |= previous[0]
+                ciaps |= previous[1]
+            if cids or ciaps:
+                emitted[ficha] = (cids, ciaps)
+            rolled.append(row[:14] + (tuple(sorted(cids)), tuple(sorted(ciaps))) + row[16:])
+        return rolled
+
+    def _load_queries(self, cur):
+        """
+        Returns (queries, from_cache). One catalog query fingerprints the probed tables; if the
+        SQL was already compiled for that fingerprint it comes from disk and no column probe
+        is sent. Otherwise all probed columns are read in a single query and the compiled
+        SQL is stored for the next municipality/cycle on the same PEC schema.
+        """
+        try:
+            cur.execute("""
+                SELECT md5(COALESCE(string_agg(table_name || '.' || column_name, ',' ORDER BY table_name, column_name), ''))
+                FROM information_schema.columns
+                WHERE table_schema = 'public'
+                AND table_name = ANY(%s)
+            """, (PROBED_TABLES,))
+            fingerprint = f"{__version__}:{QUERY_CACHE_VERSION}:{cur.fetchone()[0]}"
+
+            queries = schema_cache.get(fingerprint)
+            if queries is not None:
+                return queries, True
+
+            cur.execute("""
+                SELECT table_name, column_name
+                FROM information_schema.columns
+                WHERE table_schema = 'public'
+                AND table_name = ANY(%s)
+            """, (PROBED_TABLES,))
+            self._probed_columns = {}
+            for table_name, column_name in cur.fetchall():
+                self._probed_columns.setdefault(table_name, set()).add(column_name)
+        except Exception:
+            # Catalog not readable as expected: probe table by table, as before
+            cur.connection.rollback()
+            self._probed_columns = None
+            return self._build_queries(cur), False
+
+        try:
+            queries = self._build_queries(cur)
+        finally:
+            self._probed_columns = None
+        schema_cache.set(fingerprint, queries)
+        return queries, False
+
+    def _build_queries(self, cur):
+        """
+        Builds the seven extraction queries. The vaccination, home visit and collective activity
+        SQL is adapted to the columns available in this municipality's PEC version.
+        Returns a list of dicts: collection, label, noun (for the "Found N ..." log line),
+        sql (None when the schema does not support it), optional and an optional warning.
+        """
+        queries = []
+
+        # QUERY 1: PROCEDIMENTOS REALIZADOS
+        sql_proc = """
+            SELECT pap.nu_uuid_ficha as id, prof.no_profissional, prof.nu_cns, cbo.nu_cbo,
+                   cid.no_cidadao, cid.nu_cns, sex.ds_sexo, cid.nu_cpf_cidadao, 
+                   pap.dt_nascimento, unid.nu_cnes, proc.co_proced, proc.ds_proced,
+                   tempo.dt_registro, 'PROCEDURE' as type, NULL, NULL
+            FROM tb_fat_proced_atend_proced pap
+            LEFT JOIN tb_dim_profissional prof ON pap.co_dim_profissional = prof.co_seq_dim_profissional
+            LEFT JOIN tb_dim_cbo cbo ON pap.co_dim_cbo = cbo.co_seq_dim_cbo
+            LEFT JOIN tb_fat_cidadao_pec cid ON pap.co_fat_cidadao_pec = cid.co_seq_fat_cidadao_pec
+            LEFT JOIN tb_dim_unidade_saude unid ON pap.co_dim_unidade_saude = unid.co_seq_dim_unidade_saude
+            LEFT JOIN tb_dim_procedimento proc ON pap.co_dim_procedimento = proc.co_seq_dim_procedimento
+            LEFT JOIN tb_dim_tempo tempo ON pap.co_dim_tempo = tempo.co_seq_dim_tempo
+            LEFT JOIN tb_dim_sexo sex ON pap.co_dim_sexo = sex.co_seq_dim_sexo
+            WHERE tempo.dt_registro >= %s
+        """
+        queries.append({'collection': 'procedures', 'label': 'Procedures', 'noun': 'procedures', 'sql': sql_proc, 'optional': False})
+
+        # QUERY 2: CONSULTAS + DIAGNOSTICOS
+        sql_consult = """
+            SELECT fai.nu_uuid_ficha, prof.no_profissional, prof.nu_cns, cbo.nu_cbo,
+                   cid.no_cidadao, cid.nu_cns, sex.ds_sexo, cid.nu_cpf_cidadao, 
+                   fai.dt_nascimento, unid.nu_cnes, 'CONSULTA', 'ATENDIMENTO INDIVIDUAL',
+                   tempo.dt_registro, 'CONSULTATION', dim_cid.nu_cid, dim_ciap.nu_ciap
+            FROM tb_fat_atendimento_individual fai
+            LEFT JOIN tb_dim_profissional prof ON fai.co_dim_profissional_1 = prof.co_seq_dim_profissional
+            LEFT JOIN tb_dim_cbo cbo ON fai.co_dim_cbo_1 = cbo.co_seq_dim_cbo
+            LEFT JOIN tb_fat_cidadao_pec cid ON fai.co_fat_cidadao_pec = cid.co_seq_fat_cidadao_pec
+            LEFT JOIN tb_dim_unidade_saude unid ON fai.co_dim_unidade_saude_1 = unid.co_seq_dim_unidade_saude
+            LEFT JOIN tb_dim_tempo tempo ON fai.co_dim_tempo = tempo.co_seq_dim_tempo
+            LEFT JOIN tb_dim_sexo sex ON fai.co_dim_sexo = sex.co_seq_dim_sexo
+            LEFT JOIN tb_fat_atd_ind_problemas prob ON fai.co_seq_fat_atd_ind = prob.co_fat_atd_ind
+            LEFT JOIN tb_dim_cid dim_cid ON prob.co_dim_cid = dim_cid.co_seq_dim_cid
+            LEFT JOIN tb_dim_ciap dim_ciap ON prob.co_dim_ciap = dim_ciap.co_seq_dim_ciap
+            WHERE tempo.dt_registro >= %s
+        """
+        queries.append({'collection': 'consultations', 'label': 'Consultations', 'noun': 'consultations', 'sql': sql_consult, 'optional': False})
+
+        # QUERY 3: ODONTOLOGIA
+        sql_odonto = """
+            SELECT fao.nu_uuid_ficha, prof.no_profissional, prof.nu_cns, cbo.nu_cbo,
+                   cid.no_cidadao, cid.nu_cns, sex.ds_sexo, cid.nu_cpf_cidadao, 
+                   fao.dt_nascimento, unid.nu_cnes, 'ODONTO', 'ATENDIMENTO ODONTOLOGICO',
+                   tempo.dt_registro, 'ODONTOLOGY', NULL, NULL
+            FROM tb_fat_atendimento_odonto fao
+            LEFT JOIN tb_dim_profissional prof ON fao.co_dim_profissional_1 = prof.co_seq_dim_profissional
+            LEFT JOIN tb_dim_cbo cbo ON fao.co_dim_cbo_1 = cbo.co_seq_dim_cbo
+            LEFT JOIN tb_fat_cidadao_pec cid ON fao.co_fat_cidadao_pec = cid.co_seq_fat_cidadao_pec
+            LEFT JOIN tb_dim_unidade_saude unid ON fao.co_dim_unidade_saude_1 = unid.co_seq_dim_unidade_saude
+            LEFT JOIN tb_dim_tempo tempo ON fao.co_dim_tempo = tempo.co_seq_dim_tempo
+            LEFT JOIN tb_dim_sexo sex ON fao.co_dim_sexo = sex.co_seq_dim_sexo
+            WHERE tempo.dt_registro >= %s
+        """
+        queries.append({'collection': 'odontology', 'label': 'Odontology (Attendance)', 'noun': 'dental attendances', 'sql': sql_odonto, 'optional': False})
+
+        # QUERY 4: VACINAÇÃO
+        vac_cols = self.get_table_columns(cur, 'tb_fat_vacinacao_vacina')
+        via_join = ""
+        local_join = ""
+        details_concat = ""
+        has_via = False
+        if 'co_dim_via_adm_vacina' in vac_cols:
+            via_join = "LEFT JOIN tb_dim_via_administracao via ON vac_item.co_dim_via_adm_vacina = via.co_seq_dim_via_administracao"
+            has_via = True
+        elif 'co_dim_via_administracao' in vac_cols:
+            via_join = "LEFT JOIN tb_dim_via_administracao via ON vac_item.co_dim_via_administracao = via.co_seq_dim_via_administracao"
+            has_via = True
+
+        has_local = False
+        if 'co_dim_local_apl_vacina' in vac_cols:
+            local_join = "LEFT JOIN tb_dim_local_apl_vacina local ON vac_item.co_dim_local_apl_vacina = local.co_seq_dim_local_apl_vacina"
+            has_local = True
+
+        if has_via and has_local:
+            details_concat = ", ' (', COALESCE(via.no_via_administracao, '?'), ' / ', COALESCE(local.ds_local_apl_vacina, '?'), ')'"
+        elif has_via:
+            details_concat = ", ' (', COALESCE(via.no_via_administracao, '?'), ')'"
+        elif has_local:
+             details_concat = ", ' (', COALESCE(local.ds_local_apl_vacina, '?'), ')'"
+
+        sql_vac = f"""
+            SELECT vac.nu_uuid_ficha, prof.no_profissional, prof.nu_cns, cbo.nu_cbo,
+                   cid.no_cidadao, cid.nu_cns, sex.ds_sexo, cid.nu_cpf_cidadao, 
+                   vac.dt_nascimento, unid.nu_cnes, 
+                   imuno.nu_identificador, 
+                   CONCAT(imuno.no_imunobiologico, ' - ', dose.no_dose_imunobiologico {details_concat}),
+                   tempo.dt_registro, 'VACCINATION', NULL, NULL
+            FROM tb_fat_vacinacao vac
+            LEFT JOIN tb_dim_profissional prof ON vac.co_dim_profissional = prof.co_seq_dim_profissional
+            LEFT JOIN tb_dim_cbo cbo ON vac.co_dim_cbo = cbo.co_seq_dim_cbo
+            LEFT JOIN tb_fat_cidadao_pec cid ON vac.co_fat_cidadao_pec = cid.co_seq_fat_cidadao_pec
+            LEFT JOIN tb_dim_unidade_saude unid ON vac.co_dim_unidade_saude = unid.co_seq_dim_unidade_saude
+            LEFT JOIN tb_dim_tempo tempo ON vac.co_dim_tempo = tempo.co_seq_dim_tempo
+            LEFT JOIN tb_dim_sexo sex ON vac.co_dim_sexo = sex.co_seq_dim_sexo
+            JOIN tb_fat_vacinacao_vacina vac_item ON vac.co_seq_fat_vacinacao = vac_item.co_fat_vacinacao
+            LEFT JOIN tb_dim_imunobiologico imuno ON vac_item.co_dim_imunobiologico = imuno.co_seq_dim_imunobiologico
+            LEFT JOIN tb_dim_dose_imunobiologico dose ON vac_item.co_dim_dose_imunobiologico = dose.co_seq_dim_dose_imunobiologico
+            {via_join}
+            {local_join}
+            WHERE tempo.dt_registro >= %s
+        """
+        queries.append({'collection': 'vaccination', 'label': 'Vaccination (Detailed)', 'noun': 'vaccinations', 'sql': sql_vac, 'optional': False})
+
+        # QUERY 5: ODONTO PROCEDURES
+        sql_odonto_proc = """
+            SELECT fao.nu_uuid_ficha, prof.no_profissional, prof.nu_cns, cbo.nu_cbo,
+                   cid.no_cidadao, cid.nu_cns, sex.ds_sexo, cid.nu_cpf_cidadao, 
+                   fao.dt_nascimento, unid.nu_cnes, proc.co_proced, proc.ds_proced,
+                   tempo.dt_registro, 'ODONTO_PROCEDURE', NULL, NULL
+            FROM tb_fat_atend_odonto_proced faop
+            JOIN tb_fat_atendimento_odonto fao ON faop.co_fat_atd_odnt = fao.co_seq_fat_atd_odnt
+            LEFT JOIN tb_dim_procedimento proc ON faop.co_dim_procedimento = proc.co_seq_dim_procedimento
+            LEFT JOIN tb_dim_profissional prof ON fao.co_dim_profissional_1 = prof.co_seq_dim_profissional
+            LEFT JOIN tb_dim_cbo cbo ON fao.co_dim_cbo_1 = cbo.co_seq_dim_cbo
+            LEFT JOIN tb_fat_cidadao_pec cid ON fao.co_fat_cidadao_pec = cid.co_seq_fat_cidadao_pec
+            LEFT JOIN tb_dim_unidade_saude unid ON fao.co_dim_unidade_saude_1 = unid.co_seq_dim_unidade_saude
+            LEFT JOIN tb_dim_tempo tempo ON fao.co_dim_tempo = tempo.co_seq_dim_tempo
+            LEFT JOIN tb_dim_sexo sex ON fao.co_dim_sexo = sex.co_seq_dim_sexo
+            WHERE tempo.dt_registro >= %s
+        """
+        queries.append({'collection': 'odonto_procedures', 'label': 'Odonto Procedures', 'noun': 'dental procedures', 'sql': sql_odonto_proc, 'optional': True})
+
+        # QUERY 6: ATENDIMENTO DOMICILIAR
+        home_visit = {'collection': 'home_visits', 'label': 'Home Visits', 'noun': 'home visits', 'sql': None, 'optional': True}
+        dom_cols = self.get_table_columns(cur, 'tb_fat_atendimento_domiciliar')
+        dom_pk = next((c for c in dom_cols if c.startswith('co_seq_')), 'co_seq_fat_atendimento_domiciliar')
+
+        adpc_join = ""
+        adpc_selects = "dim_cid.nu_cid, dim_ciap.nu_ciap"
+        adpc_cols = self.get_table_columns(cur, 'tb_fat_atend_dom_prob_cond')
+
+        if adpc_cols:
+            fk_candidates = ['co_fat_atendimento_domiciliar', 'co_fat_atd_dom', 'co_fat_atd_domiciliar']
+            adpc_fk = next((c for c in fk_candidates if c in adpc_cols), None)
+
+            if not adpc_fk:
+                 adpc_pk_guess = next((c for c in adpc_cols if c.startswith('co_seq_')), None)
+                 adpc_fk = next((c for c in adpc_cols if 'fat' in c and ('dom' in c or 'atd' in c) and c != adpc_pk_guess), None)
+
+            if adpc_fk:
+                adpc_join = f"""
+                    LEFT JOIN tb_fat_atend_dom_prob_cond adpc ON fad.{dom_pk} = adpc.{adpc_fk}
+                    LEFT JOIN tb_dim_cid dim_cid ON adpc.co_dim_cid = dim_cid.co_seq_dim_cid
+                    LEFT JOIN tb_dim_ciap dim_ciap ON adpc.co_dim_ciap = dim_ciap.co_seq_dim_ciap
+                """
+            else:
+                 home_visit['warning'] = f"Skipping Home Visit Details: FK not found. Avail: {str(list(adpc_cols))}"
+                 adpc_selects = "NULL as nu_cid, NULL as nu_ciap"
+        else:
+            adpc_selects = "NULL as nu_cid, NULL as nu_ciap"
+
+        sql_domiciliar = f"""
+            SELECT fad.nu_uuid_ficha, prof.no_profissional, prof.nu_cns, cbo.nu_cbo,
+                   cid.no_cidadao, cid.nu_cns, sex.ds_sexo, cid.nu_cpf_cidadao, 
+                   fad.dt_nascimento, unid.nu_cnes, 'DOMICILIAR', 'VISITA DOMICILIAR',
+                   tempo.dt_registro, 'HOME_VISIT', {adpc_selects}
+            FROM tb_fat_atendimento_domiciliar fad
+            LEFT JOIN tb_dim_profissional prof ON fad.co_dim_profissional_1 = prof.co_seq_dim_profissional
+            LEFT JOIN tb_dim_cbo cbo ON fad.co_dim_cbo_1 = cbo.co_seq_dim_cbo
+            LEFT JOIN tb_fat_cidadao_pec cid ON fad.co_fat_cidadao_pec = cid.co_seq_fat_cidadao_pec
+            LEFT JOIN tb_dim_unidade_saude unid ON fad.co_dim_unidade_saude_1 = unid.co_seq_dim_unidade_saude
+            LEFT JOIN tb_dim_tempo tempo ON fad.co_dim_tempo = tempo.co_seq_dim_tempo
+            LEFT JOIN tb_dim_sexo sex ON fad.co_dim_sexo = sex.co_seq_dim_sexo
+            {adpc_join}
+            WHERE tempo.dt_registro >= %s
+        """
+        home_visit['sql'] = sql_domiciliar
+        queries.append(home_visit)
+
+        # QUERY 7: ATIVIDADE COLETIVA
+        collective = {'collection': 'collective_activity', 'label': 'Collective Activity', 'noun': 'collective participants', 'sql': None, 'optional': True}
+        fac_cols = self.get_table_columns(cur, 'tb_fat_atividade_coletiva')
+        part_cols = self.get_table_columns(cur, 'tb_fat_atvdd_coletiva_part')
+
+        if fac_cols and part_cols:
+            fac_pk = 'co_seq_fat_atvdd_coletiva' if 'co_seq_fat_atvdd_coletiva' in fac_cols else 'co_seq_fat_atividade_coletiva'
+            part_fk = 'co_fat_atvdd_coletiva' if 'co_fat_atvdd_coletiva' in part_cols else 'co_fat_atividade_coletiva'
+
+            possible_prof_cols = ['co_dim_profissional_responsavel', 'co_dim_profissional_1', 'co_dim_profissional']
+            prof_col = next((c for c in possible_prof_cols if c in fac_cols), None)
+
+            proc_col = 'co_dim_procedimento' if 'co_dim_procedimento' in fac_cols else None
+            proc_join = ""
+            proc_select_code = "'ATIV_COLETIVA'"
+            proc_select_name = "'ATIVIDADE COLETIVA'"
+
+            if proc_col:
+                proc_join = f"LEFT JOIN tb_dim_procedimento proc ON fac.{proc_col} = proc.co_seq_dim_procedimento"
+                proc_select_code = "COALESCE(proc.co_proced, 'ATIV_COLETIVA')"
+                proc_select_name = "COALESCE(proc.ds_proced, 'ATIVIDADE COLETIVA')"
+
+            if not prof_col:
+                 collective['warning'] = "Skipping Collective: Could not find professional column."
+            else:
+                collective['sql'] = f"""
+                    SELECT fac.nu_uuid_ficha, prof.no_profissional, prof.nu_cns, NULL,
+                           cid.no_cidadao, cid.nu_cns, sex.ds_sexo, cid.nu_cpf_cidadao, 
+                           tempo_nasc.dt_registro, NULL, {proc_select_code}, {proc_select_name},
+                           tempo.dt_registro, 'COLLECTIVE_ACTIVITY', NULL, NULL
+                    FROM tb_fat_atividade_coletiva fac
+                    JOIN tb_fat_atvdd_coletiva_part part ON fac.{fac_pk} = part.{part_fk}
+                    LEFT JOIN tb_dim_profissional prof ON fac.{prof_col} = prof.co_seq_dim_profissional
+                    LEFT JOIN tb_fat_cidadao_pec cid ON part.co_fat_cidadao_pec = cid.co_seq_fat_cidadao_pec
+                    LEFT JOIN tb_dim_tempo tempo ON fac.co_dim_tempo = tempo.co_seq_dim_tempo
+                    LEFT JOIN tb_dim_sexo sex ON cid.co_dim_sexo = sex.co_seq_dim_sexo
+                    LEFT JOIN tb_dim_tempo tempo_nasc ON cid.co_dim_tempo_nascimento = tempo_nasc.co_seq_dim_tempo
+                    {proc_join}
+                    WHERE tempo.dt_registro >= %s
+                """
+        else:
+            collective['warning'] = "Skipping Collective Activity: tables not found in this PEC version."
+        queries.append(collective)
+
+        return queries
+
+    def _send_batch(self, rows, mun_config, collection=None, probe=None, skipped=None, rolled_up=False, refs=None):
+        """
+        Builds the records of the chunk (RecordBatch; `rolled_up` for rows from
+        _roll_up_diagnoses, `refs` for synced dimension keys) and uploads them in batches of 100,
+        in the columnar format with 'columnar_payload'. With a probe (RowProbe of the
+        collection), records whose fingerprint was already acknowledged are dropped and
+        skipped[0] counts them; accepted batches are recorded in the row store, with every
+        fingerprint seen for their externalIds (sent or skipped).
+        """
         mun_id = mun_config.get('municipality_id')
         payload = []
+        seen = {}
+        batch_keys = set()
         BATCH_SIZE = 100
-        for row in rows:
-            row_id = row[0]
-            proc_code = row[10]
-            row_type = row[13]
-            
-            final_id = row_id
-            if row_type in ['PROCEDURE', 'ODONTO_PROCEDURE'] and proc_code:
-                 final_id = f"{row_id}_{proc_code}"
-            elif row_type == 'COLLECTIVE_ACTIVITY':
-                 pat_cns = row[5] or 'NOCNS'
-                 final_id = f"{row_id}_{pat_cns}"
-            elif row_type == 'HOME_VISIT':
-                 cid = row[14] if len(row) > 14 else None
-                 ciap = row[15] if len(row) > 15 else None
-                 suffix = ""
-                 if cid: suffix += f"_{cid}"
-                 if ciap: suffix += f"_{ciap}"
-                 if suffix: final_id = f"{row_id}{suffix}"
-
-            record = {
-                "externalId": final_id,
-                "professional": {"name": row[1], "cns": row[2], "cbo": row[3]},
-                "patient": {
-                    "name": row[4], "cns": row[5], "sex": row[6], 
-                    "cpf": row[7], "birthDate": str(row[8]) if row[8] else None
-                },
-                "unit": {"cnes": row[9]},
-                "procedure": {
-                    "code": proc_code, "name": row[11], "type": row_type,
-                    "cid": row[14], "ciap": row[15]
-                },
-                "productionDate": str(row[12])
-            }
-            payload.append(record)
+        batch = RecordBatch(rows, with_fingerprints=probe is not None, rolled_up=rolled_up, refs=refs,
+                            columnar=mun_config.get('columnar_payload', False))
+        for index, (final_id, fingerprint) in enumerate(batch):
+            if probe is not None:
+                seen.setdefault(final_id, set()).add(fingerprint)
+                if fingerprint in probe:
+                    skipped[0] += 1
+                    continue
+                batch_keys.add(final_id)
+            payload.append(index)
             
             if len(payload) >= BATCH_SIZE:
-                if self._post_to_api(payload, mun_config):
+                if self._post_to_api(batch.body(payload), mun_config):
+                    if probe is not None:
+                        row_store.acknowledge(mun_id, collection, {key: seen[key] for key in batch_keys})
                     yield ('INFO', f"   -> Batch of {len(payload)} sent.", mun_id)
                 else:
                     yield ('ERROR', "   -> Upload Failed.", mun_id)
                 payload = []
+                batch_keys = set()
         
         if payload:
-            if self._post_to_api(payload, mun_config):
+            if self._post_to_api(batch.body(payload), mun_config):
+                if probe is not None:
+                    row_store.acknowledge(mun_id, collection, {key: seen[key] for key in batch_keys})
                 yield ('INFO', f"   -> Final batch of {len(payload)} sent.", mun_id)
             else:
                  yield ('ERROR', "   -> Final Upload Failed.", mun_id)
 
-    def _post_to_api(self, data, mun_config):
+    def _post_document(self, document, mun_config):
+        """Uploads a dimension reference document (dimension sync mode)."""
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': f"Bearer {mun_config.get('api_key')}",
+            'X-Municipality-Id': mun_config.get('municipality_id')
+        }
+        try:
+            res = requests.post(DEFAULT_API_URL, data=json.dumps({'dimension': document}, default=str), headers=headers, timeout=60)
+            return res.status_code in [200, 201]
+        except Exception:
+            return False
+
+    def _post_to_api(self, body, mun_config):
         url = DEFAULT_API_URL
         headers = {
             'Content-Type': 'application/json',
@@ -446,7 +1065,7 @@ class PecConnectorEngine:
             'X-Municipality-Id': mun_config.get('municipality_id')
         }
         try:
-            res = requests.post(url, json={'records': data}, headers=headers, timeout=10)
+            res = requests.post(url, data=body, headers=headers, timeout=10)
             return res.status_code in [200, 201]
         except Exception:
             return False
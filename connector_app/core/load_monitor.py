@@ -0,0 +1,81 @@
+import time
+import psycopg2
+
+# Name the connector uses on the PEC server (pg_stat_activity.application_name): sessions with
+# this prefix are not counted as the clinicians' load
+APPLICATION_NAME = "ProBPA Connector"
+
+IDLE, BUSY, SATURATED = 0, 1, 2
+LEVEL_NAMES = {IDLE: "idle", BUSY: "busy", SATURATED: "saturated"}
+
+# PEC user sessions (the connector's own excluded) running something right now, and those
+# stuck waiting for a lock
+LOAD_SQL = """
+    SELECT
+        count(*) FILTER (WHERE state = 'active'),
+        count(*) FILTER (WHERE wait_event_type = 'Lock')
+    FROM pg_stat_activity
+    WHERE datname = current_database()
+      AND pid <> pg_backend_pid()
+      AND backend_type = 'client backend'
+      AND application_name NOT LIKE %s
+"""
+
+
+class SourceLoadMonitor:
+    """
+    Samples the municipality's PEC load from pg_stat_activity over its own autocommit
+    connection (outside the pool, so it never takes an extraction connection's slot).
+
+    - BUSY: `active` sessions running or any session waiting for a lock;
+    - SATURATED: twice `active`, or `locks` sessions waiting for a lock.
+
+    Samples are reused for `interval` seconds, so it can be checked on every fetch.
+    """
+    def __init__(self, mun_config, active=6, locks=3, interval=5):
+        self.mun_config = mun_config
+        self.active = active
+        self.locks = locks
+        self.interval = interval
+        self.conn = None
+        self.last = (IDLE, 0, 0)
+        self._sampled_at = None
+
+    def _sample(self):
+        if self.conn is None or self.conn.closed:
+            self.conn = psycopg2.connect(
+                host=self.mun_config.get('db_host'),
+                port=str(self.mun_config.get('db_port', '5432')),
+                dbname=self.mun_config.get('db_name', 'esus'),
+                user=self.mun_config.get('db_user', 'postgres'),
+                password=self.mun_config.get('db_pass', 'postgres'),
+                connect_timeout=10,
+                application_name=f"{APPLICATION_NAME} (load)"
+            )
+            self.conn.autocommit = True
+        with self.conn.cursor() as cur:
+            cur.execute(LOAD_SQL, (APPLICATION_NAME + "%",))
+            active, lock_waits = cur.fetchone()
+        if active >= 2 * self.active or lock_waits >= self.locks:
+            level = SATURATED
+        elif active >= self.active or lock_waits:
+            level = BUSY
+        else:
+            level = IDLE
+        return level, active, lock_waits
+
+    def sample(self):
+        """(level, active sessions, lock waits), sampled at most once every `interval` seconds."""
+        now = time.monotonic()
+        if self._sampled_at is None or now - self._sampled_at >= self.interval:
+            self.last = self._sample()
+            self._sampled_at = now
+        return self.last
+
+    def close(self):
+        if self.conn is not None and not self.conn.closed:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+        self.conn = None
@@ -0,0 +1,266 @@
+import hashlib
+import json
+from itertools import repeat
+from core.columnar_payload import columnar_body
+
+# Same string escaping as the default json.dumps (ensure_ascii=True)
+_string = json.encoder.encode_basestring_ascii
+
+# Column positions in the engine's query rows
+ID, PROF_NAME, PROF_CNS, PROF_CBO, PAT_NAME, PAT_CNS, PAT_SEX, PAT_CPF, PAT_BIRTH, UNIT_CNES, \
+    PROC_CODE, PROC_NAME, PROD_DATE, ROW_TYPE, CID, CIAP = range(16)
+
+
+def _value(value, sort_keys=False):
+    """A field as json.dumps(default=str) writes it."""
+    if value is None:
+        return "null"
+    if type(value) is str:
+        return _string(value)
+    return json.dumps(value, sort_keys=sort_keys, default=str)
+
+
+def _date(value):
+    # str(row[x]) of the original record builder
+    return _string(value if type(value) is str else str(value))
+
+
+# externalId of one row: the ficha id plus what tells apart the rows of the same ficha
+def _procedure_id(row_id, code, cns, cid, ciap):
+    return f"{row_id}_{code}" if code else row_id
+
+
+def _collective_id(row_id, code, cns, cid, ciap):
+    return f"{row_id}_{cns or 'NOCNS'}"
+
+
+def _home_visit_id(row_id, code, cns, cid, ciap):
+    suffix = ""
+    if cid: suffix += f"_{cid}"
+    if ciap: suffix += f"_{ciap}"
+    return f"{row_id}{suffix}" if suffix else row_id
+
+
+def _plain_id(row_id, code, cns, cid, ciap):
+    return row_id
+
+
+ID_RULES = {
+    'PROCEDURE': _procedure_id,
+    'ODONTO_PROCEDURE': _procedure_id,
+    'COLLECTIVE_ACTIVITY': _collective_id,
+    'HOME_VISIT': _home_visit_id,
+}
+
+
+class _Shape:
+    """
+    One nested object (professional, patient, unit, procedure) compiled to two format
+    strings: keys in upload order, and sorted (as json.dumps(sort_keys=True) writes them)
+    for the fingerprint.
+    """
+    def __init__(self, *keys):
+        self.keys = keys
+        self.text = "{{" + ", ".join(f'"{key}": {{{i}}}' for i, key in enumerate(keys)) + "}}"
+        self.canonical = "{{" + ", ".join(f'"{key}": {{{i}}}' for key, i in sorted(zip(keys, range(len(keys))))) + "}}"
+
+    def encode(self, values, canonical):
+        encoded = list(map(_value, values))
+        text = self.text.format(*encoded)
+        if not canonical:
+            return text, None
+        if any(type(value) not in _FLAT for value in values):
+            encoded = [_value(value, sort_keys=True) for value in values]
+        return text, self.canonical.format(*encoded)
+
+
+# Values json.dumps writes the same with or without sort_keys
+_FLAT = (str, type(None), int, float, bool)
+
+# Nested objects of the record, in upload order: record key, fields as (key, row position) and
+# the PEC dimension the object describes
+OBJECTS = (
+    ("professional", (("name", PROF_NAME), ("cns", PROF_CNS), ("cbo", PROF_CBO)), 'tb_dim_profissional'),
+    ("patient", (("name", PAT_NAME), ("cns", PAT_CNS), ("sex", PAT_SEX), ("cpf", PAT_CPF), ("birthDate", PAT_BIRTH)), None),
+    ("unit", (("cnes", UNIT_CNES),), 'tb_dim_unidade_saude'),
+    ("procedure", (("code", PROC_CODE), ("name", PROC_NAME), ("type", ROW_TYPE), ("cid", CID), ("ciap", CIAP)), 'tb_dim_procedimento'),
+)
+
+_layouts = {}
+
+
+def _layout(fields, dimension, refs):
+    """
+    (_Shape, row positions) of one object. Positions in `refs` hold a dimension key instead of
+    the value (dimension sync): the fields of the object's own dimension collapse into "id",
+    a field from another dimension becomes "<field>Id" (cbo -> cboId).
+    """
+    own = tuple((position, refs[position]) for _, position in fields if position in refs)
+    layout = _layouts.get((fields, own))
+    if layout is None:
+        keys, positions = [], []
+        for key, position in fields:
+            table = refs.get(position)
+            if table is None:
+                keys.append(key)
+            elif table != dimension:
+                keys.append(f"{key}Id")
+            elif "id" not in keys:
+                keys.append("id")
+            else:
+                continue
+            positions.append(position)
+        layout = _layouts[(fields, own)] = (_Shape(*keys), positions)
+    return layout
+
+
+def _fragments(shape, columns, canonical):
+    """
+    (upload text, fingerprint text) of one nested object per row. Built once per distinct
+    value within the chunk: rows of the same professional/unit/procedure share the text.
+    """
+    cache = {}
+    fragments = []
+    append = fragments.append
+    for values in zip(*columns):
+        pair = cache.get(values)
+        if pair is None:
+            pair = cache[values] = shape.encode(values, canonical)
+        append(pair)
+    return fragments
+
+
+def _encoded(column, encode=_value):
+    """JSON text of each value of a column, encoded once per distinct value."""
+    texts = {value: encode(value) for value in set(column)}
+    return list(map(texts.__getitem__, column))
+
+
+def _ref_fields(refs):
+    """
+    What the keys of a chunk stand for, sent along with its records:
+    {object: {record key: {"table", "fields": {field: dimension column}}}}. The API looks the
+    key up in the table's reference document and puts the fields back in the object.
+    """
+    described = {}
+    for name, fields, dimension in OBJECTS:
+        for key, position in fields:
+            if position not in refs:
+                continue
+            table, column, _ = refs[position]
+            ref_key = "id" if table == dimension else f"{key}Id"
+            ref = described.setdefault(name, {}).setdefault(ref_key, {"table": table, "fields": {}})
+            ref["fields"][key] = column
+    return described
+
+
+class RecordBatch:
+    """
+    Upload records of a chunk of query rows, built column by column straight to JSON text
+    instead of one dict tree per row. `records` hold the same text requests' json= would
+    send for the original record dicts, and `fingerprints` (with `with_fingerprints`) the
+    same values as row_store.row_fingerprint of those dicts.
+
+    `rolled_up` rows carry tuples of CID/CIAP codes (one row per ficha): their externalId is
+    the ficha id and the codes go out as arrays.
+
+    `refs` ({row position: (dimension table, dimension column, {key: value})}) marks the
+    positions that hold a synced dimension's key: the record carries the key (see _layout), and
+    the values are only looked up where the externalId needs them (procedure code). The bodies
+    then carry `ref_fields` (see _ref_fields) so the API can resolve the keys.
+
+    With `columnar`, `records` is not built: `fields` keeps the JSON text of each record field
+    (dotted names, see core.columnar_payload) and `body` sends batches in the columnar format.
+    """
+    def __init__(self, rows, with_fingerprints=False, rolled_up=False, refs=None, columnar=False):
+        self.external_ids = []
+        self.records = []
+        self.fingerprints = None
+        self.columnar = columnar
+        self.fields = []
+        self.ref_fields = _ref_fields(refs) if refs else None
+        if not rows:
+            if with_fingerprints:
+                self.fingerprints = []
+            return
+        columns = list(zip(*rows))
+        refs = refs or {}
+        ids = columns[ID]
+        codes, types = columns[PROC_CODE], columns[ROW_TYPE]
+        if PROC_CODE in refs:
+            values = refs[PROC_CODE][2]
+            codes = [values.get(key) for key in codes]
+        kinds = set(types)
+        if rolled_up:
+            external_ids = list(ids)
+        elif len(kinds) == 1:
+            # A collection's chunk has a single row type: one rule for the whole column
+            rule = ID_RULES.get(kinds.pop(), _plain_id)
+            external_ids = list(map(rule, ids, codes, columns[PAT_CNS], columns[CID], columns[CIAP]))
+        else:
+            external_ids = [ID_RULES.get(row_type, _plain_id)(row_id, code, cns, cid, ciap)
+                            for row_id, code, cns, cid, ciap, row_type
+                            in zip(ids, codes, columns[PAT_CNS], columns[CID], columns[CIAP], types)]
+        self.external_ids = external_ids
+
+        columns[PAT_BIRTH] = [str(birth) if birth else None for birth in columns[PAT_BIRTH]]
+        tables = {position: table for position, (table, _, _) in refs.items()}
+        layouts = [(name, _layout(fields, dimension, tables)) for name, fields, dimension in OBJECTS]
+        dates = _encoded(columns[PROD_DATE], _date)
+        encoded_ids = [_value(external_id) for external_id in external_ids]
+        if columnar:
+            self.fields = [("externalId", encoded_ids)]
+            for name, (shape, positions) in layouts:
+                self.fields.extend((f"{name}.{key}", _encoded(columns[position]))
+                                   for key, position in zip(shape.keys, positions))
+            self.fields.append(("productionDate", dates))
+            if not with_fingerprints:
+                return
+        professionals, patients, units, procedures = (
+            _fragments(shape, [columns[position] for position in positions], with_fingerprints)
+            for _, (shape, positions) in layouts
+        )
+        if not columnar:
+            self.records = [
+                f'{{"externalId": {eid}, "professional": {prof[0]}, "patient": {pat[0]}, "unit": {unit[0]}, '
+                f'"procedure": {proc[0]}, "productionDate": {date}}}'
+                for eid, prof, pat, unit, proc, date in zip(encoded_ids, professionals, patients, units, procedures, dates)
+            ]
+        if with_fingerprints:
+            blake2b = hashlib.blake2b
+            from_bytes = int.from_bytes
+            self.fingerprints = [
+                from_bytes(blake2b(
+                    f'{{"externalId": {eid}, "patient": {pat[1]}, "procedure": {proc[1]}, '
+                    f'"productionDate": {date}, "professional": {prof[1]}, "unit": {unit[1]}}}'.encode(),
+                    digest_size=8).digest(), "big", signed=True)
+                for eid, prof, pat, unit, proc, date in zip(encoded_ids, professionals, patients, units, procedures, dates)
+            ]
+
+    def __len__(self):
+        return len(self.external_ids)
+
+    def __iter__(self):
+        """(externalId, fingerprint or None) per row, in row order."""
+        return zip(self.external_ids, self.fingerprints if self.fingerprints is not None else repeat(None))
+
+    def body(self, indexes):
+        """Upload body for the rows at `indexes` (row positions in the chunk)."""
+        if not self.columnar:
+            records = self.records
+            return records_body([records[i] for i in indexes], self.ref_fields)
+        names = [name for name, _ in self.fields]
+        first, last = indexes[0], indexes[-1]
+        if last - first + 1 == len(indexes):
+            # Nothing dropped in between: the batch is a slice of each column
+            return columnar_body(names, [values[first:last + 1] for _, values in self.fields], self.ref_fields)
+        return columnar_body(names, [[values[i] for i in indexes] for _, values in self.fields], self.ref_fields)
+
+
+def records_body(records, ref_fields=None):
+    """
+    Upload body for prebuilt record texts, as requests.post(json={'records': [...]}) would send
+    it, plus "refs" (RecordBatch.ref_fields) when the records carry synced dimension keys.
+    """
+    refs = f', "refs": {json.dumps(ref_fields)}' if ref_fields else ""
+    return ('{"records": [' + ", ".join(records) + "]" + refs + "}").encode()
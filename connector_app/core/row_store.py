@@ -0,0 +1,96 @@
+import hashlib
+import json
+import sqlite3
+import threading
+from array import array
+from contextlib import closing, contextmanager
+from bisect import bisect_left
+from pathlib import Path
+
+
+def row_fingerprint(record):
+    """64-bit content hash of an upload record (signed, so it fits a SQLite INTEGER)."""
+    digest = hashlib.blake2b(json.dumps(record, sort_keys=True, default=str).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+class RowProbe:
+    """
+    Read-only set of the fingerprints already acknowledged for one collection: a sorted
+    array of 8-byte integers probed by binary search (a Python set costs ~10x the memory).
+    """
+    def __init__(self, fingerprints=()):
+        self._values = array("q", sorted(fingerprints))
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, fingerprint):
+        i = bisect_left(self._values, fingerprint)
+        return i < len(self._values) and self._values[i] == fingerprint
+
+
+class RowFingerprintStore:
+    """
+    Fingerprints of the last version of every record the API acknowledged, per municipality,
+    collection and externalId, kept in row_fingerprints.db (SQLite) next to the config.
+    Overlapping incremental windows re-read rows the cloud already has; those are dropped
+    before upload instead of being sent again.
+
+    An externalId can cover several rows (one per CID/CIAP of the same ficha), so each key
+    holds the set of fingerprints seen for it.
+    """
+    def __init__(self, app_name="ProBPA_Connector"):
+        self.store_dir = Path.home() / f".{app_name}"
+        self.db_file = self.store_dir / "row_fingerprints.db"
+        self._lock = threading.Lock()
+
+        if not self.store_dir.exists():
+            self.store_dir.mkdir(parents=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS rows (
+                    municipality TEXT NOT NULL,
+                    collection TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    fingerprints TEXT NOT NULL,
+                    PRIMARY KEY (municipality, collection, key)
+                )
+            """)
+
+    @contextmanager
+    def _connect(self):
+        # with sqlite3.connect() only ends the transaction: closing also closes the connection
+        with closing(sqlite3.connect(self.db_file, timeout=30)) as conn, conn:
+            yield conn
+
+    def load_probe(self, municipality_id, collection):
+        with self._lock, self._connect() as conn:
+            cur = conn.execute(
+                "SELECT fingerprints FROM rows WHERE municipality = ? AND collection = ?",
+                (str(municipality_id), collection)
+            )
+            return RowProbe(int(fp) for (fingerprints,) in cur for fp in fingerprints.split(","))
+
+    def acknowledge(self, municipality_id, collection, entries):
+        """Records {key: set(fingerprints)} of a batch the API accepted, replacing older versions."""
+        municipality = str(municipality_id)
+        with self._lock, self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO rows (municipality, collection, key, fingerprints) VALUES (?, ?, ?, ?)",
+                ((municipality, collection, str(key), ",".join(map(str, sorted(fps)))) for key, fps in entries.items())
+            )
+
+    def clear(self, municipality_id, collection=None):
+        with self._lock, self._connect() as conn:
+            if collection is None:
+                conn.execute("DELETE FROM rows WHERE municipality = ?", (str(municipality_id),))
+            else:
+                conn.execute(
+                    "DELETE FROM rows WHERE municipality = ? AND collection = ?",
+                    (str(municipality_id), collection)
+                )
+
+
+# Singleton instance
+row_store = RowFingerprintStore()
@@ -0,0 +1,56 @@
+import json
+import os
+import threading
+from pathlib import Path
+
+# Fingerprints kept on disk; older ones are dropped (one per PEC schema version in use)
+MAX_ENTRIES = 20
+
+
+class SchemaCache:
+    """
+    Extraction SQL already adapted to a PEC schema, keyed by the schema fingerprint.
+    Municipalities running the same PEC version share the entry, and an unchanged
+    fingerprint means the column probes can be skipped entirely.
+    """
+    def __init__(self, app_name="ProBPA_Connector"):
+        self.cache_dir = Path.home() / f".{app_name}"
+        self.cache_file = self.cache_dir / "schema_cache.json"
+        self._lock = threading.Lock()
+
+        if not self.cache_dir.exists():
+            self.cache_dir.mkdir(parents=True)
+
+    def get(self, fingerprint):
+        with self._lock:
+            entry = self._load_data().get(fingerprint)
+            return entry["queries"] if entry else None
+
+    def set(self, fingerprint, queries):
+        with self._lock:
+            data = self._load_data()
+            data.pop(fingerprint, None)
+            data[fingerprint] = {"queries": queries}
+            # Dicts keep insertion order: the first keys are the least recently compiled
+            while len(data) > MAX_ENTRIES:
+                data.pop(next(iter(data)))
+            self._save_data(data)
+
+    def _load_data(self):
+        if not self.cache_file.exists():
+            return {}
+        try:
+            with open(self.cache_file, "r") as f:
+                return json.load(f)
+        except Exception:
+            return {}
+
+    def _save_data(self, data):
+        tmp_file = self.cache_file.with_suffix(".tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_file, self.cache_file)
+
+
+# Singleton instance
+schema_cache = SchemaCache()
@@ -0,0 +1,98 @@
+"""
+Bytes on the wire and encode time of the upload bodies: row format ({"records": [...]}) x
+columnar format ('columnar_payload', core.columnar_payload). Both sides build the chunk's
+RecordBatch and its bodies of 100 records; the gzip column is what the bodies would be if the
+transport compressed them (for reference, the engine does not).
+
+Usage (from the connector_app folder):
+    python tools/benchmark_columnar_payload.py [--rows 200000] [--chunk 5000] [--rollup]
+
+Before timing, checks that decode_payload gives back the row format records, for whole
+chunks and for batches with rows dropped (skip_unchanged).
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark_record_builder import make_chunk, ROW_TYPES, UPLOAD_BATCH
+from core.columnar_payload import decode_payload
+from core.record_builder import RecordBatch
+
+
+def roll_up(rows):
+    """One row per ficha with tuples of CID/CIAP codes, as _roll_up_diagnoses sends them."""
+    fichas = {}
+    for row in rows:
+        ficha = fichas.setdefault(row[0], [row, set(), set()])
+        if row[14]: ficha[1].add(row[14])
+        if row[15]: ficha[2].add(row[15])
+    return [row[:14] + (tuple(sorted(cids)), tuple(sorted(ciaps))) for row, cids, ciaps in fichas.values()]
+
+
+def bodies(rows, columnar, rolled_up):
+    batch = RecordBatch(rows, rolled_up=rolled_up, columnar=columnar)
+    indexes = list(range(len(batch)))
+    return [batch.body(indexes[i:i + UPLOAD_BATCH]) for i in range(0, len(indexes), UPLOAD_BATCH)]
+
+
+def check(chunk, rolled_up):
+    rows = bodies(chunk, False, rolled_up)
+    columnar = bodies(chunk, True, rolled_up)
+    if [json.loads(body) for body in rows] != [decode_payload(json.loads(body)) for body in columnar]:
+        return False
+    # Batches with rows dropped in between, as after the row store probe
+    indexes = list(range(0, len(chunk), 3))
+    expected = json.loads(RecordBatch(chunk, rolled_up=rolled_up).body(indexes))
+    return decode_payload(json.loads(RecordBatch(chunk, rolled_up=rolled_up, columnar=True).body(indexes))) == expected
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares the row and columnar upload bodies.")
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--chunk", type=int, default=5000, help="rows per fetched chunk")
+    parser.add_argument("--rollup", action="store_true", help="rolled-up rows (one per ficha, arrays of codes)")
+    args = parser.parse_args()
+
+    chunks = [make_chunk(seed, args.chunk, ROW_TYPES[seed % len(ROW_TYPES)]) for seed in range(len(ROW_TYPES) * 2)]
+    if args.rollup:
+        chunks = [roll_up(chunk) for chunk in chunks]
+    for chunk in chunks:
+        if not check(chunk, args.rollup):
+            print("MISMATCH: decoded columnar bodies differ from the row format.")
+            return 1
+
+    print(f"{args.rows} rows in chunks of {args.chunk}, bodies of {UPLOAD_BATCH} records{' (rolled up)' if args.rollup else ''}")
+    print(f"{'format':<10} {'encode(s)':>10} {'records/s':>12} {'bytes/record':>13} {'wire(MB)':>9} {'gzip(MB)':>9}")
+    results = {}
+    for name, columnar in (("rows", False), ("columnar", True)):
+        done = size = compressed = 0
+        elapsed = 0.0
+        i = 0
+        while done < args.rows:
+            chunk = chunks[i % len(chunks)]
+            start = time.perf_counter()
+            encoded = bodies(chunk, columnar, args.rollup)
+            elapsed += time.perf_counter() - start
+            size += sum(map(len, encoded))
+            if i < len(chunks):
+                compressed += sum(len(gzip.compress(body)) for body in encoded)
+            done += len(chunk)
+            i += 1
+        compressed = compressed * done / sum(map(len, chunks[:i]))
+        results[name] = (elapsed, size)
+        print(f"{name:<10} {elapsed:>10.2f} {done / elapsed:>12,.0f} {size / done:>13.1f} "
+              f"{size / 2**20:>9.1f} {compressed / 2**20:>9.1f}")
+
+    (time_rows, size_rows), (time_columnar, size_columnar) = results["rows"], results["columnar"]
+    print(f"\ncolumnar: {100 * (1 - size_columnar / size_rows):.0f}% fewer bytes, "
+          f"{time_rows / time_columnar:.2f}x the encode speed; decoded records identical.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+"""
+Records per second of the upload record builder: the per-row dict builder _send_batch used
+before x core.record_builder.RecordBatch. Both sides include what the upload costs per
+record: the fingerprint (with --fingerprints) and the JSON body of the POST.
+
+Usage (from the connector_app folder):
+    python tools/benchmark_record_builder.py [--rows 200000] [--chunk 5000] [--fingerprints]
+
+Before timing, checks that both builders give the same externalIds, fingerprints and bodies.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from datetime import date, timedelta
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.record_builder import RecordBatch, records_body
+from core.row_store import row_fingerprint
+
+UPLOAD_BATCH = 100
+ROW_TYPES = ['PROCEDURE', 'CONSULTATION', 'HOME_VISIT', 'ODONTO_PROCEDURE', 'COLLECTIVE_ACTIVITY']
+
+
+def make_chunk(seed, size, row_type):
+    """Query rows shaped like the engine's, with the repetition real collections have."""
+    rnd = random.Random(seed)
+    professionals = [(f"Profissional {i}", f"7000000000{i:05d}", rnd.choice(["225142", "223505", None])) for i in range(40)]
+    units = [f"{2000000 + i}" for i in range(8)]
+    procedures = [(f"03010100{i:02d}", f"PROCEDIMENTO {i}") for i in range(30)]
+    rows = []
+    for i in range(size):
+        prof = rnd.choice(professionals)
+        proc = rnd.choice(procedures)
+        patient = rnd.randrange(5000)
+        birth = date(1950, 1, 1) + timedelta(days=patient * 3) if patient % 10 else None
+        cid = rnd.choice([None, None, "J11", "I10"])
+        ciap = rnd.choice([None, None, "A01"])
+        rows.append((
+            f"uuid-{seed}-{i}", prof[0], prof[1], prof[2],
+            f"Cidadão {patient}", f"7000000{patient:08d}" if patient % 7 else None, rnd.choice(["MASCULINO", "FEMININO"]),
+            f"{patient:011d}", birth, rnd.choice(units),
+            proc[0], proc[1], date(2024, 1, 1) + timedelta(days=i % 365), row_type, cid, ciap
+        ))
+    return rows
+
+
+def build_before(rows, fingerprints):
+    """The record loop _send_batch had before RecordBatch, plus the requests json= body."""
+    ids, payload, prints = [], [], []
+    for row in rows:
+        row_id = row[0]
+        proc_code = row[10]
+        row_type = row[13]
+        final_id = row_id
+        if row_type in ['PROCEDURE', 'ODONTO_PROCEDURE'] and proc_code:
+            final_id = f"{row_id}_{proc_code}"
+        elif row_type == 'COLLECTIVE_ACTIVITY':
+            pat_cns = row[5] or 'NOCNS'
+            final_id = f"{row_id}_{pat_cns}"
+        elif row_type == 'HOME_VISIT':
+            cid = row[14] if len(row) > 14 else None
+            ciap = row[15] if len(row) > 15 else None
+            suffix = ""
+            if cid: suffix += f"_{cid}"
+            if ciap: suffix += f"_{ciap}"
+            if suffix: final_id = f"{row_id}{suffix}"
+        record = {
+            "externalId": final_id,
+            "professional": {"name": row[1], "cns": row[2], "cbo": row[3]},
+            "patient": {
+                "name": row[4], "cns": row[5], "sex": row[6],
+                "cpf": row[7], "birthDate": str(row[8]) if row[8] else None
+            },
+            "unit": {"cnes": row[9]},
+            "procedure": {
+                "code": proc_code, "name": row[11], "type": row_type,
+                "cid": row[14], "ciap": row[15]
+            },
+            "productionDate": str(row[12])
+        }
+        if fingerprints:
+            prints.append(row_fingerprint(record))
+        ids.append(final_id)
+        payload.append(record)
+    bodies = [json.dumps({'records': payload[i:i + UPLOAD_BATCH]}, allow_nan=False).encode()
+              for i in range(0, len(payload), UPLOAD_BATCH)]
+    return ids, prints if fingerprints else None, bodies
+
+
+def build_after(rows, fingerprints):
+    batch = RecordBatch(rows, with_fingerprints=fingerprints)
+    bodies = [records_body(batch.records[i:i + UPLOAD_BATCH]) for i in range(0, len(batch), UPLOAD_BATCH)]
+    return batch.external_ids, batch.fingerprints, bodies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares the previous upload record builder with RecordBatch.")
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--chunk", type=int, default=5000, help="rows per fetched chunk")
+    parser.add_argument("--fingerprints", action="store_true", help="include the row store fingerprints (skip_unchanged)")
+    args = parser.parse_args()
+
+    chunks = [make_chunk(seed, args.chunk, ROW_TYPES[seed % len(ROW_TYPES)]) for seed in range(len(ROW_TYPES) * 2)]
+    for chunk in chunks:
+        if build_before(chunk, True) != build_after(chunk, True):
+            print("MISMATCH: the builders do not give the same records.")
+            return 1
+
+    print(f"{args.rows} rows in chunks of {args.chunk}{' (with fingerprints)' if args.fingerprints else ''}")
+    results = {}
+    for name, build in (("before", build_before), ("RecordBatch", build_after)):
+        done = 0
+        i = 0
+        start = time.perf_counter()
+        while done < args.rows:
+            build(chunks[i % len(chunks)], args.fingerprints)
+            done += args.chunk
+            i += 1
+        elapsed = time.perf_counter() - start
+        results[name] = done / elapsed
+        print(f"{name:<12} {elapsed:>7.2f}s {results[name]:>12,.0f} records/s")
+
+    print(f"\n{results['RecordBatch'] / results['before']:.1f}x the records per second; identical records and fingerprints.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,218 @@
+"""
+Check of the logical decoding mode ('cdc') against a test PostgreSQL with wal_level = logical:
+for each plugin (test_decoding and pgoutput) creates the slot with core.change_feed.LogicalChangeFeed,
+applies INSERT/UPDATE/DELETE to tb_fat_atendimento_individual and tb_fat_atd_ind_problemas and
+checks
+
+- the decoded events (table, operation and columns, quoted text and NULL included);
+- that an UPDATE with old-key (changed key, REPLICA IDENTITY FULL) yields the new tuple;
+- the engine's grouping (PecConnectorEngine._cdc_changes): a new or changed problem re-reads
+  its attendance through CDC_PARENT_KEYS, deletes of parent rows are counted;
+- that peek consumes nothing and advance moves the slot's confirmed_flush_lsn to the lsn read.
+
+Before the server, checks the decoding of ready-made test_decoding lines (array-typed columns,
+types with spaces, quoted text, NULL and old-key), which does not need the plugin installed.
+
+Usage (from the connector_app folder):
+    python tools/check_change_feed.py --host localhost --db esus_test --user postgres \
+        [--plugins test_decoding,pgoutput]
+
+Test databases only: the test rows are copies of existing rows with keys above the current
+ones and are deleted at the end, together with the slot and the publication. While it runs
+tb_fat_atd_ind_problemas has REPLICA IDENTITY FULL (set back to DEFAULT at the end), and other
+writes to the two tables at the same time show up as extra events.
+"""
+import os
+import sys
+import json
+import argparse
+
+import psycopg2
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.change_feed import PLUGINS, LogicalChangeFeed, decode_test_decoding
+from core.engine import CDC_PARENT_KEYS, PecConnectorEngine
+
+SLOT = "probpa_change_feed_check"
+ATTENDANCES = ("tb_fat_atendimento_individual", "co_seq_fat_atd_ind")
+PROBLEMS = ("tb_fat_atd_ind_problemas", "co_seq_fat_atend_ind_problemas")
+# Test keys start above the highest existing key
+KEY_OFFSET = 1_000_000_000
+
+# Copy of an existing row of the table with some columns replaced (values as JSON)
+COPY_ROW_SQL = """
+INSERT INTO {table}
+SELECT (jsonb_populate_record(NULL::{table}, to_jsonb(t) || %s::jsonb)).*
+FROM {table} t
+WHERE {key} = (SELECT min({key}) FROM {table})
+"""
+
+# test_decoding lines and what decoding must return
+TEST_DECODING_LINES = [
+    ("array column", "table public.tb_x: INSERT: id[integer]:1 tags[character varying[]]:'{a,b}' n[text]:'x'",
+     ("public", "tb_x", "INSERT", {"id": "1", "tags": "{a,b}", "n": "x"})),
+    ("NULL array, type with spaces and quotes", "table public.tb_x: UPDATE: id[bigint]:2 scores[integer[]]:null dt[timestamp without time zone]:'2024-01-02 03:04:05' n[text]:'O''Brien'",
+     ("public", "tb_x", "UPDATE", {"id": "2", "scores": None, "dt": "2024-01-02 03:04:05", "n": "O'Brien"})),
+    ("old-key with an array in the new tuple", "table public.tb_x: UPDATE: old-key: id[bigint]:3 new-tuple: id[bigint]:4 tags[text[]]:'{\"a b\",c}'",
+     ("public", "tb_x", "UPDATE", {"id": "4", "tags": '{"a b",c}'})),
+    ("BEGIN skipped", "BEGIN 1234", None),
+]
+
+
+def _max_key(cur, table, key):
+    cur.execute(f"SELECT COALESCE(max({key}), 0) FROM {table}")
+    return int(cur.fetchone()[0])
+
+
+def _copy_row(cur, table, key, columns):
+    cur.execute(COPY_ROW_SQL.format(table=table, key=key), (json.dumps(columns),))
+    if cur.rowcount != 1:
+        raise Exception(f"{table} is empty: the check copies an existing row")
+
+
+def _check(name, got, expected, failures):
+    if got == expected:
+        print(f"  OK      {name}")
+    else:
+        failures.append(name)
+        print(f"  FAILED  {name}\n          expected: {expected}\n          got:      {got}")
+
+
+def _clean_up(conn, limits):
+    with conn.cursor() as cur:
+        for (table, key), limit in zip((ATTENDANCES, PROBLEMS), limits):
+            cur.execute(f"DELETE FROM {table} WHERE {key} > %s", (limit,))
+    conn.commit()
+
+
+def check_decoding():
+    """Decodes TEST_DECODING_LINES, no server needed. Returns the names of the checks that failed."""
+    failures = []
+    for name, line, expected in TEST_DECODING_LINES:
+        _check(name, decode_test_decoding(line), expected, failures)
+    return failures
+
+
+def check(conn, plugin):
+    """Runs the scenario with one plugin. Returns the names of the checks that failed."""
+    table_a, key_a = ATTENDANCES
+    table_p, key_p = PROBLEMS
+    parent_column = CDC_PARENT_KEYS[table_p][0]
+    failures = []
+
+    with conn.cursor() as cur:
+        base_a = _max_key(cur, table_a, key_a) + KEY_OFFSET
+        base_p = _max_key(cur, table_p, key_p) + KEY_OFFSET
+        cur.execute("SELECT relreplident FROM pg_class WHERE oid = %s::regclass", (table_p,))
+        identity = cur.fetchone()[0]
+    conn.commit()
+    if identity not in ("d", "f"):
+        raise Exception(f"{table_p} has REPLICA IDENTITY '{identity}': the check expects DEFAULT or FULL")
+    a1, a2, a3, a4 = (base_a + i for i in range(1, 5))
+    p1, p2, p3 = (base_p + i for i in range(1, 4))
+
+    feed = LogicalChangeFeed(conn, SLOT, plugin, {table_a, table_p})
+    try:
+        # Initial state, written before the slot exists (not part of the changes)
+        with conn.cursor() as cur:
+            if identity == "d":
+                # A deleted problem only carries its attendance key with the whole old tuple
+                cur.execute(f"ALTER TABLE {table_p} REPLICA IDENTITY FULL")
+            _copy_row(cur, table_a, key_a, {key_a: a1})
+            _copy_row(cur, table_a, key_a, {key_a: a2})
+            _copy_row(cur, table_p, key_p, {key_p: p1, parent_column: a1})
+            _copy_row(cur, table_p, key_p, {key_p: p2, parent_column: a2})
+        conn.commit()
+
+        if feed.exists():
+            feed.drop()
+        _check("slot created", feed.ensure(), True, failures)
+
+        with conn.cursor() as cur:
+            _copy_row(cur, table_a, key_a, {key_a: a3, "nu_uuid_ficha": "O'Brien form 3"})
+            _copy_row(cur, table_p, key_p, {key_p: p3, parent_column: a3})
+            # REPLICA IDENTITY FULL: old-key carries the whole old tuple, the new one counts
+            cur.execute(f"UPDATE {table_p} SET {parent_column} = %s WHERE {key_p} = %s", (a2, p1))
+            # Changed primary key: old-key carries only the old key
+            cur.execute(f"UPDATE {table_a} SET {key_a} = %s WHERE {key_a} = %s", (a4, a1))
+            cur.execute(f"DELETE FROM {table_p} WHERE {key_p} = %s", (p2,))
+            cur.execute(f"DELETE FROM {table_a} WHERE {key_a} = %s", (a2,))
+        conn.commit()
+        with conn.cursor() as cur:
+            cur.execute(f"UPDATE {table_a} SET nu_uuid_ficha = NULL WHERE {key_a} = %s", (a3,))
+        conn.commit()
+
+        expected_events = [
+            (table_a, "INSERT", {key_a: str(a3), "nu_uuid_ficha": "O'Brien form 3"}),
+            (table_p, "INSERT", {key_p: str(p3), parent_column: str(a3)}),
+            (table_p, "UPDATE", {key_p: str(p1), parent_column: str(a2)}),
+            (table_a, "UPDATE", {key_a: str(a4)}),
+            (table_p, "DELETE", {key_p: str(p2), parent_column: str(a2)}),
+            (table_a, "DELETE", {key_a: str(a2)}),
+            (table_a, "UPDATE", {key_a: str(a3), "nu_uuid_ficha": None}),
+        ]
+        lsn, events = feed.peek(1000)
+        got = [(table, operation, {column: columns.get(column) for column in expected})
+               for (table, operation, columns), (_, _, expected) in zip(events, expected_events)]
+        _check("decoded events", got if len(events) == len(expected_events) else events, expected_events, failures)
+
+        with conn.cursor() as cur:
+            changes, deleted = PecConnectorEngine(None)._cdc_changes(cur, events)
+        conn.commit()
+        _check("rows to re-read", changes, {table_a: {key_a: {a2, a3, a4}}, table_p: {key_p: {p1, p3}}}, failures)
+        _check("deleted rows counted", deleted, 1, failures)
+
+        _check("peek consumes nothing", feed.peek(1000), (lsn, events), failures)
+        feed.advance(lsn)
+        with conn.cursor() as cur:
+            cur.execute("SELECT confirmed_flush_lsn >= %s::pg_lsn FROM pg_replication_slots WHERE slot_name = %s", (lsn, SLOT))
+            advanced = cur.fetchone()[0]
+        conn.commit()
+        _check(f"slot advanced to {lsn}", advanced, True, failures)
+        _check("nothing pending after advance", feed.peek(1000), (None, []), failures)
+    finally:
+        conn.rollback()
+        feed.drop()
+        _clean_up(conn, (base_a, base_p))
+        if identity == "d":
+            with conn.cursor() as cur:
+                cur.execute(f"ALTER TABLE {table_p} REPLICA IDENTITY DEFAULT")
+            conn.commit()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks the logical decoding mode against a test PostgreSQL (wal_level = logical).")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", default="5432")
+    parser.add_argument("--db", default="esus")
+    parser.add_argument("--user", default="postgres")
+    parser.add_argument("--password", default="")
+    parser.add_argument("--plugins", default=",".join(PLUGINS), help="comma-separated plugins")
+    args = parser.parse_args()
+
+    print("\ntest_decoding line decoding:")
+    failures = [f"decoding: {name}" for name in check_decoding()]
+    conn = psycopg2.connect(host=args.host, port=args.port, dbname=args.db, user=args.user, password=args.password)
+    try:
+        for plugin in args.plugins.split(","):
+            print(f"\n{plugin}:")
+            try:
+                failures += [f"{plugin}: {name}" for name in check(conn, plugin)]
+            except Exception as e:
+                conn.rollback()
+                print(f"  FAILED  {e}")
+                failures.append(f"{plugin}: {e}")
+    finally:
+        conn.close()
+
+    if failures:
+        print(f"\n{len(failures)} check(s) failed.")
+        return 1
+    print("\nAll checks passed.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,84 @@
+"""
+Stand-in for the ingestPecData endpoint: accepts the upload POSTs on localhost, decodes
+columnar bodies with core.columnar_payload.decode_payload (the reference decoder) and counts
+the records and bytes received. With --out, the decoded records go to a JSON Lines file.
+
+Usage (from the connector_app folder):
+    python tools/local_ingest_server.py [--port 8085] [--out records.jsonl]
+
+Point the engine at it by changing DEFAULT_API_URL in core/engine.py to
+http://127.0.0.1:<port>/ for the test run.
+"""
+import os
+import sys
+import json
+import argparse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.columnar_payload import decode_payload
+
+
+class IngestHandler(BaseHTTPRequestHandler):
+    out = None
+    totals = {"posts": 0, "bytes": 0, "records": 0, "documents": 0}
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            payload = json.loads(body)
+            columnar = "columnar" in payload
+            payload = decode_payload(payload)
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            self._reply(400, {"error": f"invalid body: {e}"})
+            return
+        records = payload.get("records") or []
+        totals = self.totals
+        totals["posts"] += 1
+        totals["bytes"] += len(body)
+        totals["records"] += len(records)
+        if payload.get("dimension"):
+            totals["documents"] += 1
+        if self.out is not None:
+            for record in records:
+                self.out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.out.flush()
+        print(f"{self.headers.get('X-Municipality-Id')}: {len(records)} records "
+              f"({'columnar' if columnar else 'rows'}, {len(body)} bytes) - total {totals['records']} records, "
+              f"{totals['bytes']} bytes in {totals['posts']} posts", flush=True)
+        self._reply(200, {"received": len(records)})
+
+    def _reply(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode())
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the ingestPecData endpoint.")
+    parser.add_argument("--port", type=int, default=8085)
+    parser.add_argument("--out", help="JSON Lines file for the decoded records")
+    args = parser.parse_args()
+
+    if args.out:
+        IngestHandler.out = open(args.out, "a", encoding="utf-8")
+    server = HTTPServer(("127.0.0.1", args.port), IngestHandler)
+    print(f"Listening on http://127.0.0.1:{args.port}/ (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if IngestHandler.out is not None:
+            IngestHandler.out.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
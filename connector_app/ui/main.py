@@ -5,6 +5,7 @@ from PIL import Image
 import pystray
 from pystray import MenuItem as item
 from core.config_manager import ConfigManager
+from core.db_pool import connection_pool
 from core.single_instance import SingleInstance
 from ui.screens.activation import ActivationScreen
 from ui.screens.dashboard import DashboardScreen
@@ -104,6 +105,7 @@ class MainWindow(ctk.CTk):
 
     def quit_app(self, icon, item):
         self.tray_icon.stop()
+        connection_pool.close_all()
         self.quit()
         sys.exit()
 
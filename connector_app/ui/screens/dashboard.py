@@ -3,7 +3,7 @@ import threading
 import time
 from datetime import datetime
 from core.config_manager import ConfigManager
-from core.engine import PecConnectorEngine
+from core.engine import PecConnectorEngine, CDC_INTERVAL_SECONDS
 from core.history_manager import HistoryManager
 
 from version import __version__
@@ -182,6 +182,7 @@ class DashboardScreen(ctk.CTkFrame):
 
     def scheduler_loop(self):
         while not self.stop_event.is_set():
+            muns = []
             try:
                 muns = self.config_manager.get_municipalities()
                 now = datetime.now()
@@ -201,6 +202,9 @@ class DashboardScreen(ctk.CTkFrame):
                     else:
                         try: minutes = int(interval_str)
                         except: pass
+                    if mun.get("cdc", False):
+                        # Logical decoding: short cycles that only read the pending changes
+                        minutes = mun.get("cdc_interval", CDC_INTERVAL_SECONDS) / 60
 
                     last_run_attempt = mun.get("last_run_attempt") or mun.get("last_run_success")
                     if not last_run_attempt:
@@ -230,7 +234,8 @@ class DashboardScreen(ctk.CTkFrame):
             except Exception as e:
                 print(f"Scheduler Error: {e}")
             
-            time.sleep(60) # Check every minute
+            # Check every minute (every CDC_INTERVAL_SECONDS while some municipality streams changes)
+            time.sleep(CDC_INTERVAL_SECONDS if any(m.get("cdc", False) for m in muns) else 60)
 
     def start_extraction_thread(self, force=True):
         if self.is_running: return
@@ -1,5 +1,7 @@
 import * as functions from "firebase-functions/v1";
 import * as admin from "firebase-admin";
+import { decodeColumns, nestColumns } from "./utils/columnarPayload";
+import { loadReferenceDimensions, referenceValue, saveReferenceDimension } from "./utils/referenceDimensions";
 
 const db = admin.firestore();
 
@@ -69,13 +71,65 @@ export const ingestPecData = functions
                 return;
             }
 
-            // 4. Process Records
-            const records = req.body.records;
+            // Dimension sync mode: a versioned reference document ({ dimension: {...} }) instead of records
+            const dimensionDoc = req.body.dimension;
+            if (dimensionDoc) {
+                if (!dimensionDoc.table || !dimensionDoc.version || !Array.isArray(dimensionDoc.columns) || !Array.isArray(dimensionDoc.rows)) {
+                    res.status(400).send('Bad Request: "dimension" needs table, version, columns and rows');
+                    return;
+                }
+                const stored = await saveReferenceDimension(
+                    munDoc.ref.collection('dimensions'),
+                    dimensionDoc.table,
+                    dimensionDoc.version,
+                    dimensionDoc.columns,
+                    dimensionDoc.rows,
+                    { dimension: dimensionDoc.dimension || dimensionDoc.table }
+                );
+                console.log(`[Ingestion] Stored ${stored} rows of dimension ${dimensionDoc.table} (${dimensionDoc.version}) for ${municipalityId}`);
+                res.status(200).send({ success: true, count: stored });
+                return;
+            }
+
+            // 4. Process Records (columnar batches are decoded back into records first)
+            let records = req.body.records;
+            if (req.body.columnar) {
+                try {
+                    records = decodeColumns(req.body.columnar).map(nestColumns);
+                } catch (e: any) {
+                    res.status(400).send(`Bad Request: invalid "columnar" block: ${e.message}`);
+                    return;
+                }
+            }
             if (!records || !Array.isArray(records)) {
                 res.status(400).send('Bad Request: "records" array is required');
                 return;
             }
 
+            // Dimension sync mode: nested objects carry a key ("id", "cboId") instead of some fields;
+            // refs tells which ({ professional: { id: { table, fields: { name: "no_profissional" } } } })
+            const refs: Record<string, Record<string, { table: string, fields: Record<string, string> }>> = req.body.refs || {};
+            const refTables = Array.from(new Set(Object.values(refs).flatMap((keys) => Object.values(keys).map((ref) => ref.table))));
+            if (refTables.length > 0) {
+                const dimensions = await loadReferenceDimensions(munDoc.ref.collection('dimensions'), refTables);
+                for (const [objectName, keys] of Object.entries(refs)) {
+                    for (const [refKey, ref] of Object.entries(keys)) {
+                        const dimension = dimensions.get(ref.table);
+                        if (!dimension) {
+                            console.warn(`[Ingestion] Dimension ${ref.table} not stored: ${objectName}.${refKey} kept as key only`);
+                            continue;
+                        }
+                        for (const record of records) {
+                            const target = record[objectName];
+                            if (!target) continue;
+                            for (const [field, column] of Object.entries(ref.fields)) {
+                                target[field] = referenceValue(dimension, target[refKey], column);
+                            }
+                        }
+                    }
+                }
+            }
+
             const batch = db.batch();
             let count = 0;
 
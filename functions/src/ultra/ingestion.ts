@@ -1,5 +1,7 @@
 import * as functions from "firebase-functions/v1";
 import * as admin from "firebase-admin";
+import { decodeColumns } from "../utils/columnarPayload";
+import { loadReferenceDimensions, referenceValue, saveReferenceDimension } from "../utils/referenceDimensions";
 
 const db = admin.firestore();
 
@@ -43,35 +45,95 @@ export const ingestUltraData = functions
                 return;
             }
 
-            // 2. Parse the payload
+            // 2. Connect to the dedicated database
+            const projectId = process.env.GCP_PROJECT || process.env.GCLOUD_PROJECT || admin.app().options.projectId;
+            
+            const dedicatedDb = new admin.firestore.Firestore({
+                projectId: projectId,
+                databaseId: dedicatedDatabaseId,
+            });
+
             const payload = req.body;
+
+            // Dimension sync mode: a versioned reference document ({ dimensao: {...} }) instead of records
+            if (payload && payload.dimensao) {
+                const documento = payload.dimensao;
+                if (!documento.tabela || !documento.versao || !Array.isArray(documento.colunas) || !Array.isArray(documento.linhas)) {
+                    res.status(400).send("Bad Request: Invalid dimension format. Expected { dimensao: { tabela, versao, colunas: string[], linhas: any[][] } }");
+                    return;
+                }
+                const stored = await saveReferenceDimension(
+                    dedicatedDb.collection("dimensoes"),
+                    documento.tabela,
+                    documento.versao,
+                    documento.colunas,
+                    documento.linhas,
+                    { dimensao: documento.dimensao || documento.tabela }
+                );
+                res.status(200).json({
+                    success: true,
+                    message: `Stored ${stored} rows of dimension ${documento.tabela} (version ${documento.versao}) for database ${dedicatedDatabaseId}`
+                });
+                return;
+            }
+
+            // 3. Parse the payload (columnar batches are decoded back into data rows first)
+            if (payload && payload.columnar) {
+                try {
+                    payload.data = decodeColumns(payload.columnar);
+                } catch (e: any) {
+                    res.status(400).send(`Bad Request: Invalid columnar block: ${e.message}`);
+                    return;
+                }
+            }
             if (!payload || !payload.collection || !Array.isArray(payload.data)) {
                 res.status(400).send("Bad Request: Invalid payload format. Expected { collection: string, data: any[] }");
                 return;
             }
 
+            // Optional: ids that disappeared from the source (delta mode); their documents are deleted
+            if (payload.tombstones !== undefined && !Array.isArray(payload.tombstones)) {
+                res.status(400).send("Bad Request: tombstones must be an array of document ids");
+                return;
+            }
+
             const targetCollection = payload.collection;
             const records = payload.data;
-
-            // 3. Connect to the dedicated database
-            const projectId = process.env.GCP_PROJECT || process.env.GCLOUD_PROJECT || admin.app().options.projectId;
-            
-            const dedicatedDb = new admin.firestore.Firestore({
-                projectId: projectId,
-                databaseId: dedicatedDatabaseId,
-            });
+            const tombstones: any[] = payload.tombstones || [];
+
+            // Dimension sync mode: records carry ref_* keys; refs tells which columns each one stands for
+            // ({ ref_profissional: { tabela, colunas: { nome_profissional: "no_profissional" } } })
+            const refs: Record<string, { tabela: string, colunas: Record<string, string> }> = payload.refs || {};
+            const refColumns = Object.keys(refs);
+            if (refColumns.length > 0) {
+                const dimensions = await loadReferenceDimensions(
+                    dedicatedDb.collection("dimensoes"),
+                    Array.from(new Set(refColumns.map((column) => refs[column].tabela)))
+                );
+                for (const column of refColumns) {
+                    const dimension = dimensions.get(refs[column].tabela);
+                    if (!dimension) {
+                        console.warn(`[UltraIngestion] Dimension ${refs[column].tabela} not stored: ${column} kept as key only`);
+                        continue;
+                    }
+                    for (const record of records) {
+                        for (const [field, dimensionColumn] of Object.entries(refs[column].colunas)) {
+                            const value = referenceValue(dimension, record[column], dimensionColumn);
+                            // The connector sends missing values as "" (fillna)
+                            record[field] = value === null ? "" : value;
+                        }
+                    }
+                }
+            }
 
             // 4. Batch write the records
-            // Firestore batches allow up to 500 operations
-            const batch = dedicatedDb.batch();
+            // Firestore batches allow up to 500 operations: a full batch is committed and a new one started
+            const batchLimit = 500;
+            let batch = dedicatedDb.batch();
+            let opCount = 0;
             let count = 0;
 
             for (const record of records) {
-                if (count >= 500) {
-                    // For now, we restrict payloads to 500. The connector should chunk.
-                    break; 
-                }
-                
                 // Dynamically identify the primary key to prevent duplication
                 const possibleIdFields = [
                     "id",
@@ -108,21 +170,45 @@ export const ingestUltraData = functions
                 };
 
                 batch.set(docRef, dataToSave, { merge: true });
+                opCount++;
                 count++;
+
+                if (opCount >= batchLimit) {
+                    await batch.commit();
+                    batch = dedicatedDb.batch();
+                    opCount = 0;
+                }
             }
 
-            await batch.commit();
+            // Tombstones come after the records, in the same sequence of batches
+            let removed = 0;
+            for (const id of tombstones) {
+                batch.delete(dedicatedDb.collection(targetCollection).doc(String(id)));
+                opCount++;
+                removed++;
+
+                if (opCount >= batchLimit) {
+                    await batch.commit();
+                    batch = dedicatedDb.batch();
+                    opCount = 0;
+                }
+            }
+
+            if (opCount > 0) {
+                await batch.commit();
+            }
 
             // 5. Update Sync Status
             await dedicatedDb.collection("config").doc("sync_status").set({
                 lastSync: admin.firestore.FieldValue.serverTimestamp(),
                 lastCollection: targetCollection,
-                recordsIngested: count
+                recordsIngested: count,
+                recordsRemoved: removed
             }, { merge: true });
 
             res.status(200).json({
                 success: true,
-                message: `Ingested ${count} records into ${targetCollection} for database ${dedicatedDatabaseId}`
+                message: `Ingested ${count} records (${removed} removed) into ${targetCollection} for database ${dedicatedDatabaseId}`
             });
 
         } catch (error: any) {
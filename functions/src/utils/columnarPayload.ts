@@ -0,0 +1,61 @@
+/**
+ * Columnar batches sent by the connectors (Ultra "extracao_payload_colunar", connector_app
+ * "columnar_payload"). Instead of repeating every key on every record, the body carries
+ *
+ *   { columnar: { count, columns: [...], data: [[...], ...], dictionaries: { column: [...] } } }
+ *
+ * with one array per column, in record order. A column listed in "dictionaries" holds indexes
+ * into its dictionary (null stays null). Port of decode_columns in core/columnar_payload.py of
+ * both connectors: the handlers decode the block and go on as with a row-format body.
+ */
+
+export interface ColumnarBlock {
+    count?: number;
+    columns: string[];
+    data: any[][];
+    dictionaries?: Record<string, any[]>;
+}
+
+/** Rows of a columnar block as flat objects ({ column name: value }), in order. */
+export const decodeColumns = (block: ColumnarBlock): Record<string, any>[] => {
+    if (!block || !Array.isArray(block.columns) || !Array.isArray(block.data) || block.data.length !== block.columns.length) {
+        throw new Error("columnar block needs columns and one data array per column");
+    }
+    const dictionaries = block.dictionaries || {};
+    const count = block.columns.length > 0 ? block.data[0].length : block.count || 0;
+
+    const columns = block.columns.map((name, i) => {
+        const values = block.data[i];
+        if (!Array.isArray(values) || values.length !== count) {
+            throw new Error(`columnar column ${name} does not have ${count} values`);
+        }
+        const dictionary = dictionaries[name];
+        return dictionary ? values.map((code) => (code === null ? null : dictionary[code])) : values;
+    });
+
+    const rows: Record<string, any>[] = [];
+    for (let row = 0; row < count; row++) {
+        const record: Record<string, any> = {};
+        block.columns.forEach((name, i) => {
+            record[name] = columns[i][row];
+        });
+        rows.push(record);
+    }
+    return rows;
+};
+
+/** Flat row with dotted column names ("professional.name") back into nested objects. */
+export const nestColumns = (row: Record<string, any>): Record<string, any> => {
+    const record: Record<string, any> = {};
+    for (const [name, value] of Object.entries(row)) {
+        const dot = name.indexOf(".");
+        if (dot < 0) {
+            record[name] = value;
+        } else {
+            const parent = name.slice(0, dot);
+            record[parent] = record[parent] || {};
+            record[parent][name.slice(dot + 1)] = value;
+        }
+    }
+    return record;
+};
@@ -0,0 +1,123 @@
+import * as admin from "firebase-admin";
+
+/**
+ * Reference dimensions uploaded by the connectors in dimension sync mode (professionals, units,
+ * CBOs, procedures, teams). Fact records then carry only the dimension key, and the ingest
+ * handlers put the values back with these documents before saving.
+ *
+ * Layout, under the collection each handler passes in:
+ *   {table}                  -> { table, version, columns, rowCount, parts, updatedAt, ... }
+ *   {table}/parts/{version}-{n} -> { version, rows: { key: [values of columns[1..]] } }
+ * The parts of a new version are written before the metadata points to it, and the parts of
+ * older versions are deleted afterwards.
+ */
+
+// Rows per part document (a part must stay well under Firestore's 1 MiB document limit)
+const ROWS_PER_PART = 1000;
+// Part documents per write batch
+const PARTS_PER_BATCH = 20;
+
+export interface ReferenceDimension {
+    version: string;
+    // Dimension columns after the key, in the order of each row's values
+    columns: string[];
+    rows: Map<string, any[]>;
+}
+
+// Dimensions already read by this instance, by document path; reused while the version holds
+const loadedDimensions = new Map<string, ReferenceDimension>();
+
+export const saveReferenceDimension = async (
+    collection: admin.firestore.CollectionReference,
+    table: string,
+    version: string,
+    columns: string[],
+    rows: any[][],
+    extra: Record<string, any> = {}
+): Promise<number> => {
+    const docRef = collection.doc(table);
+    const parts = Math.ceil(rows.length / ROWS_PER_PART);
+
+    for (let first = 0; first < parts; first += PARTS_PER_BATCH) {
+        const batch = collection.firestore.batch();
+        for (let part = first; part < Math.min(first + PARTS_PER_BATCH, parts); part++) {
+            const partRows: Record<string, any[]> = {};
+            for (const row of rows.slice(part * ROWS_PER_PART, (part + 1) * ROWS_PER_PART)) {
+                partRows[String(row[0])] = row.slice(1);
+            }
+            batch.set(docRef.collection("parts").doc(`${version}-${part}`), { version, rows: partRows });
+        }
+        await batch.commit();
+    }
+
+    await docRef.set({
+        ...extra,
+        table,
+        version,
+        columns,
+        rowCount: rows.length,
+        parts,
+        updatedAt: admin.firestore.FieldValue.serverTimestamp()
+    });
+
+    // Parts of the previous versions are no longer reachable from the metadata
+    const stale = await docRef.collection("parts").where("version", "!=", version).get();
+    for (let i = 0; i < stale.docs.length; i += 500) {
+        const batch = collection.firestore.batch();
+        stale.docs.slice(i, i + 500).forEach((doc) => batch.delete(doc.ref));
+        await batch.commit();
+    }
+    return rows.length;
+};
+
+export const loadReferenceDimensions = async (
+    collection: admin.firestore.CollectionReference,
+    tables: string[]
+): Promise<Map<string, ReferenceDimension>> => {
+    const dimensions = new Map<string, ReferenceDimension>();
+    if (tables.length === 0) {
+        return dimensions;
+    }
+
+    const metadata = await collection.firestore.getAll(...tables.map((table) => collection.doc(table)));
+    for (const meta of metadata) {
+        if (!meta.exists) {
+            continue;
+        }
+        const data = meta.data() || {};
+        let dimension = loadedDimensions.get(meta.ref.path);
+        if (!dimension || dimension.version !== data.version) {
+            const parts = await meta.ref.collection("parts").where("version", "==", data.version).get();
+            const rows = new Map<string, any[]>();
+            parts.forEach((part) => {
+                for (const [key, values] of Object.entries(part.data().rows || {})) {
+                    rows.set(key, values as any[]);
+                }
+            });
+            dimension = { version: data.version, columns: (data.columns || []).slice(1), rows };
+            loadedDimensions.set(meta.ref.path, dimension);
+        }
+        dimensions.set(meta.id, dimension);
+    }
+    return dimensions;
+};
+
+/**
+ * Value of `column` in the dimension row of `key`: undefined when the dimension is not stored,
+ * null when the key (or the value) is missing.
+ */
+export const referenceValue = (
+    dimension: ReferenceDimension | undefined,
+    key: any,
+    column: string
+): any => {
+    if (!dimension) {
+        return undefined;
+    }
+    const row = key === null || key === undefined ? undefined : dimension.rows.get(String(key));
+    const index = dimension.columns.indexOf(column);
+    if (!row || index < 0 || row[index] === undefined) {
+        return null;
+    }
+    return row[index];
+};